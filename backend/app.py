@@ -1,17 +1,30 @@
 import os
+import time
 
 from flask import Flask
 from flask_migrate import Migrate
 
 from utils.db import db
-from utils.rate_limits import RateLimitExceeded, rate_limit_error_handler
+from utils.metric_partitions import partition_metric_table
+from utils.metric_payloads import validate_payload_mode
+from utils.prometheus import instrument_sqlalchemy
+from utils.rate_limits import (
+    RateLimitExceeded,
+    ReplicaRateLimitExceeded,
+    TokenQuotaExceeded,
+    rate_limit_error_handler,
+    replica_rate_limit_error_handler,
+    token_quota_error_handler,
+)
 
 
 def create_app(app_name=__name__):
     # Initialize and configure the Flask app
     app = Flask(app_name)
     app.config.from_object(os.getenv('APP_SETTINGS', 'config.LocalConfig'))
+    validate_payload_mode(app.config['METRICS_PAYLOAD_MODE'])
     db.init_app(app)
+    instrument_sqlalchemy()
 
     # Initialize database and migration modules into the app
     Migrate(app, db)
@@ -32,6 +45,25 @@ def handle_rate_limit_exceeded(error):
     return rate_limit_error_handler(error)
 
 
+@app.errorhandler(ReplicaRateLimitExceeded)
+def handle_replica_rate_limit_exceeded(error):
+    return replica_rate_limit_error_handler(error)
+
+
+@app.errorhandler(TokenQuotaExceeded)
+def handle_token_quota_exceeded(error):
+    return token_quota_error_handler(error)
+
+
+@app.cli.command("partition-metrics")
+def partition_metrics():
+    """
+    Partition the metric table by month (MySQL only), see `utils.metric_partitions`.
+    """
+    with db.engine.connect() as connection:
+        partition_metric_table(connection, time.time(), app.config["METRICS_PARTITIONS_AHEAD"])
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     """
@@ -0,0 +1,175 @@
+"""
+ASGI entrypoint of the backend.
+
+`POST /api/v1/chat/completions` is proxied natively on asyncio with pooled keep-alive connections to the replicas, so
+that a few workers can multiplex thousands of concurrent long-lived streams. Admission (API key, rate limits,
+validation and routing) reuses the Flask code in a worker thread, and every other endpoint is served by the Flask app.
+
+Run with: gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+"""
+
+import asyncio
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.test import EnvironBuilder
+
+from app import app as flask_app
+from blueprints.v1.apis import AdmittedChatCompletion, admit_chat_completion
+from utils.async_request_handlers import (
+    close_async_clients,
+    handle_async_cached_request,
+    handle_async_coalesced_request,
+    handle_async_non_streaming_request,
+    handle_async_streaming_request,
+    send_response,
+)
+from utils.rate_limits import add_rate_limit_headers
+from utils.single_flight import FLIGHT_ABORTED
+
+CHAT_COMPLETIONS_PATH = '/api/v1/chat/completions'
+
+wsgi_application = WsgiToAsgi(flask_app)
+
+# Admissions run in threads of their own, as requests waiting in the admission queue would otherwise starve the default
+# executor that the handlers rely on
+admission_executor = ThreadPoolExecutor(
+    max_workers=flask_app.config['ADMISSION_THREADS'], thread_name_prefix='admission'
+)
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+def make_environ(scope: typing.Dict[str, typing.Any], body: bytes) -> typing.Dict[str, typing.Any]:
+    return EnvironBuilder(
+        path=scope['path'],
+        method=scope['method'],
+        headers=[(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']],
+        query_string=scope.get('query_string', b'').decode('latin-1'),
+        data=body,
+    ).get_environ()
+
+
+def admit(environ: typing.Dict[str, typing.Any]):
+    """
+    Run the Flask admission of a chat completion request, returning the admitted request or an error response.
+    """
+    with flask_app.request_context(environ):
+        try:
+            rv = admit_chat_completion()
+        except Exception as e:
+            try:
+                rv = flask_app.handle_user_exception(e)
+            except Exception as e:
+                rv = flask_app.handle_exception(e)
+
+        if isinstance(rv, AdmittedChatCompletion):
+            return rv
+        return add_rate_limit_headers(flask_app.make_response(rv))
+
+
+async def chat_completions(scope, receive, send):
+    body = await read_body(receive)
+    admitted = await asyncio.get_running_loop().run_in_executor(
+        admission_executor, admit, make_environ(scope, body)
+    )
+    if not isinstance(admitted, AdmittedChatCompletion):
+        await send_response(send, admitted)
+        return
+
+    if admitted.cached is not None:
+        await handle_async_cached_request(
+            flask_app=flask_app,
+            send=send,
+            api_key_id=admitted.api_key_id,
+            start_time=admitted.start_time,
+            chat_completion_payload=admitted.payload,
+            raw=admitted.raw,
+            cached=admitted.cached,
+            headers=admitted.headers,
+        )
+        return
+    if admitted.in_flight is None:
+        await handle_async_coalesced_request(
+            flask_app=flask_app,
+            send=send,
+            api_key_id=admitted.api_key_id,
+            start_time=admitted.start_time,
+            chat_completion_payload=admitted.payload,
+            raw=admitted.raw,
+            flight=admitted.flight,
+            headers=admitted.headers,
+        )
+        return
+
+    try:
+        if admitted.payload['stream']:
+            await handle_async_streaming_request(
+                flask_app=flask_app,
+                send=send,
+                receive=receive,
+                api_key_id=admitted.api_key_id,
+                in_flight=admitted.in_flight,
+                start_time=admitted.start_time,
+                chat_completion_payload=admitted.payload,
+                raw=admitted.raw,
+                headers=admitted.headers,
+                token_debit=admitted.token_debit,
+                cache_key=admitted.cache_key,
+                flight=admitted.flight,
+            )
+        else:
+            await handle_async_non_streaming_request(
+                flask_app=flask_app,
+                send=send,
+                api_key_id=admitted.api_key_id,
+                in_flight=admitted.in_flight,
+                start_time=admitted.start_time,
+                chat_completion_payload=admitted.payload,
+                headers=admitted.headers,
+                token_debit=admitted.token_debit,
+                cache_key=admitted.cache_key,
+                flight=admitted.flight,
+            )
+    finally:
+        if admitted.flight is not None:
+            admitted.flight.finish(error=FLIGHT_ABORTED)
+        await asyncio.to_thread(admitted.in_flight.release)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if (
+        scope['type'] == 'http'
+        and scope['method'] == 'POST'
+        and scope['path'] == CHAT_COMPLETIONS_PATH
+        # Mock LLM calls are served by the Flask app
+        and not flask_app.config['MOCK_LLM']
+    ):
+        await chat_completions(scope, receive, send)
+        return
+
+    await wsgi_application(scope, receive, send)
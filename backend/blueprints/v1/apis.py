@@ -3,36 +3,82 @@ import time
 import uuid
 
 from flask import Blueprint, request
-from flask import jsonify, Response, current_app as app
+from flask import jsonify, make_response, Response, current_app as app
+from marshmallow import ValidationError
 from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
 from config import Config
-from utils.db import db, with_session
+from utils.admission import AdmissionQueue, resolve_priority
+from utils.batches import COMPLETION_WINDOWS
+from utils.cache import get_model_by_name, get_model_replicas, invalidate_caches
+from utils.circuit_breaker import ReplicaCircuitBreaker
+from utils.db import db, session_scope, with_session
 from utils.rest import validate_request, ensure_api_key, ensure_admin_api_key
-from utils.rate_limits import ensure_api_key_rate_limits
+from utils.rate_limits import (
+    add_rate_limit_headers,
+    ensure_api_key_rate_limits,
+    estimate_default_completion_tokens,
+    estimate_request_tokens,
+    get_rate_limit_headers,
+    ReplicaRateLimitManager,
+    TokenDebit,
+    TokenQuotaManager,
+)
 from utils.request_handlers import (
+    handle_cached_request,
+    handle_coalesced_request,
     handle_streaming_request,
     handle_non_streaming_request,
+    refund_tokens,
 )
+from utils.response_cache import ResponseCache
+from utils.metric_exports import DEFAULT_EXPORT_COLUMNS, EXPORT_ARGS, ExportFormat, export_metrics
+from utils.metrics_writer import get_metrics_writer
 from utils.mock import handle_mock_streaming_request, handle_mock_non_streaming_request
+from utils.prometheus import RateLimit, generate_metrics, observe_rate_limit_rejection
+from utils.latency_sketches import (
+    LatencyMetric,
+    get_latency_sketches,
+    query_latency_sketches,
+    summarize_sketch,
+)
+from utils.redis import get_redis_client
+from utils.rollups import query_rollups
+from utils.routing import get_router, InFlightRequest
+from utils.single_flight import (
+    FLIGHT_ABORTED,
+    Flight,
+    get_flight,
+    join_flight,
+    make_flight_key,
+)
+from utils.table_queries import get_columns, get_filters, query_table
+from utils.upstream import get_upstream_pool_stats
 from tables.api_key import APIKey, APIKeySchema
 from tables.llm_model import LLMModel, LLMModelSchema
 from tables.replicas import Replica, ReplicaSchema, ReplicaVMStatus
 from tables.metrics import Metric
 from tables.replica_security_rule import ReplicaSecurityRule
-from worker.tasks import create_vm_on_hyperstack
+from tables.file import File, FilePurpose, FileSchema
+from tables.batch import Batch, BatchSchema, BatchStatus
+from worker.tasks import create_vm_on_hyperstack, run_batch
 
 from .schemas import (
     ChatCompletionRequestSchema,
+    CreateBatchRequestSchema,
     GenerateAPIKeyRequestSchema,
+    LatencyQuerySchema,
     ReplicaRequestSchema,
     LLMModeLRequestSchema,
     ReplicaUpdateSchema,
     DeleteAPIKeyRequestSchema,
+    UploadFileRequestSchema,
+    UsageQuerySchema,
 )
 
 v1_bp = Blueprint("v1", __name__)
+v1_bp.after_request(add_rate_limit_headers)
 
 
 @v1_bp.route("/generate_api_key", methods=["POST"])
@@ -46,9 +92,17 @@ def generate_api_key(
     Generate an API key for a user.
     """
     user_id = validated_data["user_id"]
-    api_key = APIKey(user_id=user_id, api_key=str(uuid.uuid4()), enabled=True)
+    quotas = {
+        field: validated_data[field]
+        for field in ("allowed_rpm", "allowed_tpm", "daily_token_budget", "priority")
+        if field in validated_data
+    }
+    api_key = APIKey(
+        user_id=user_id, api_key=str(uuid.uuid4()), enabled=True, **quotas
+    )
     session.add(api_key)
     session.commit()
+    invalidate_caches("api_key")
     api_key_schema = APIKeySchema(only=("api_key", "id", "enabled"))
     return jsonify(api_key_schema.dump(api_key)), 200
 
@@ -84,75 +138,597 @@ def delete_api_key(
     if metrics_entry:
         api_key.enabled = False
         session.commit()
+        invalidate_caches("api_key")
         return jsonify({"message": "API key disabled successfully"}), 200
 
     session.delete(api_key)
     session.commit()
+    invalidate_caches("api_key")
     return jsonify({"message": "API key deleted successfully"}), 200
 
 
-@v1_bp.route("/chat/completions", methods=["POST"])
+class AdmittedChatCompletion(typing.NamedTuple):
+    """
+    A chat completion request that passed validation and was routed to a
+    replica, or that is served from the response cache (`cached` is set and
+    `in_flight` is None), or that follows the flight of an identical request
+    in progress (`flight` is set and `in_flight` is None).
+    """
+
+    api_key_id: int
+    payload: typing.Dict[str, typing.Any]
+    raw: bool
+    start_time: float
+    in_flight: typing.Optional[InFlightRequest]
+    headers: typing.Dict[str, str]
+    token_debit: typing.Optional[TokenDebit]
+    cache_key: typing.Optional[str] = None
+    cached: typing.Optional[bytes] = None
+    flight: typing.Optional[Flight] = None
+
+
 @ensure_api_key(include_api_key=True)
 @ensure_api_key_rate_limits
 @validate_request(ChatCompletionRequestSchema)
-@with_session
-def chat_completions(
-    session: Session, validated_data: typing.Dict[str, typing.Any], key: APIKey
-) -> Response:
+def admit_chat_completion(
+    validated_data: typing.Dict[str, typing.Any], key: APIKey
+) -> typing.Union[AdmittedChatCompletion, Response]:
     """
-    Handle a chat completion request from the LLM endpoint API,
-    stream the response back to the client and update the API
-    key usage metrics.
+    Authenticate, rate limit and validate a chat completion request, then
+    route it to a ready replica of the requested model.
+
+    Returns the admitted request, or an error response. Shared by the
+    `chat_completions` view and the ASGI proxy (see `asgi.py`).
     """
     raw = validated_data.pop("raw_stream_response")
+    priority = resolve_priority(key.priority, validated_data.pop("priority"))
     start_time = time.time()
-    model = (
-        session.query(LLMModel).filter_by(name=validated_data["model"]).one_or_none()
-    )
+    model = get_model_by_name(validated_data["model"])
     if not model:
         return jsonify({"error": "Invalid Model"}), 400
 
-    replica = (
-        session.query(Replica)
-        .filter_by(model_id=model.id, vm_status=ReplicaVMStatus.SUCCESS)
-        .first()
-    )
-    if not replica:
+    # Deterministic requests already answered are served from the response
+    # cache, without being routed to a replica nor debited from the token
+    # quotas as they don't use the GPU
+    response_cache = ResponseCache()
+    cache_key = response_cache.make_key(validated_data)
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return AdmittedChatCompletion(
+                api_key_id=key.id,
+                payload=validated_data,
+                raw=raw,
+                start_time=start_time,
+                in_flight=None,
+                headers=get_rate_limit_headers(),
+                token_debit=None,
+                cache_key=cache_key,
+                cached=cached,
+            )
+
+    # Identical deterministic requests in flight in this worker share the
+    # upstream call of the first one, following its flight
+    flight_key = make_flight_key(validated_data)
+    if flight_key:
+        flight = get_flight(flight_key)
+        if flight is not None:
+            return AdmittedChatCompletion(
+                api_key_id=key.id,
+                payload=validated_data,
+                raw=raw,
+                start_time=start_time,
+                in_flight=None,
+                headers=get_rate_limit_headers(),
+                token_debit=None,
+                flight=flight,
+            )
+
+    replicas = [
+        replica
+        for replica in get_model_replicas(model.id)
+        if replica.vm_status == ReplicaVMStatus.SUCCESS
+    ]
+    if not replicas:
         return jsonify({"error": "No Replica available / ready."}), 400
 
-    if not replica.endpoint:
+    replicas = [replica for replica in replicas if replica.endpoint]
+    if not replicas:
         return jsonify({"error": "Missing endpoint url."}), 400
 
-    llm_api_url = replica.endpoint
+    # Skip the replicas whose circuit breaker is open, failing fast instead of
+    # waiting on a replica that is down
+    replicas = ReplicaCircuitBreaker().available(replicas)
+    if not replicas:
+        return jsonify({"error": "No healthy replica available."}), 503
+
+    # Debit the estimated tokens of the request from the token quotas of the
+    # API key, they are reconciled with the actual usage in `update_metrics`
+    token_quotas = TokenQuotaManager()
+    default_max_tokens = app.config["TOKEN_QUOTA_DEFAULT_MAX_TOKENS"]
+    token_debit = token_quotas.debit(
+        key,
+        estimate_request_tokens(validated_data, default_max_tokens),
+        estimate_default_completion_tokens(validated_data, default_max_tokens),
+    )
 
-    if app.config["MOCK_LLM"]:
-        # Mock LLM Calls during testing
-        if validated_data["stream"]:
-            response = handle_mock_streaming_request()
-        else:
-            response = handle_mock_non_streaming_request()
-    else:
-        if validated_data["stream"]:
-            response = handle_streaming_request(
-                session=session,
+    # Queue the request until the model has a free slot, letting requests in by
+    # weighted fair queuing across API keys so that batch workloads don't
+    # starve interactive ones. The session is closed first, so that queued
+    # requests don't hold a database connection
+    admission = None
+    admission_queue = AdmissionQueue(model.id)
+    try:
+        if admission_queue.enabled:
+            db.session.close()
+            admission = admission_queue.wait(key.id, priority, len(replicas))
+            if admission is None:
+                if token_debit:
+                    token_quotas.settle(token_debit, 0)
+                observe_rate_limit_rejection(RateLimit.ADMISSION_QUEUE)
+                return jsonify({"error": "Timed out in the admission queue."}), 503
+
+        # Spread the requests across the replicas of the model, skipping
+        # replicas at their rate limit. The request is tracked as in-flight on
+        # the chosen replica until the response is closed
+        router = get_router()
+        in_flight = router.route(
+            replicas,
+            rate_limits=ReplicaRateLimitManager(),
+            affinity_key=router.get_affinity_key(validated_data),
+            model=model.name,
+        )
+        in_flight.admission = admission
+    except Exception:
+        if admission:
+            admission.release()
+        if token_debit:
+            token_quotas.settle(token_debit, 0)
+        raise
+
+    # Lead the flight of the request, unless an identical request started one
+    # since it was looked up
+    flight = None
+    if flight_key:
+        flight, leader = join_flight(flight_key)
+        if not leader:
+            in_flight.release()
+            if token_debit:
+                token_quotas.settle(token_debit, 0)
+            return AdmittedChatCompletion(
                 api_key_id=key.id,
-                endpoint=llm_api_url,
-                start_time=start_time,
-                chat_completion_payload=validated_data,
+                payload=validated_data,
                 raw=raw,
-            )
-        else:
-            response = handle_non_streaming_request(
-                session=session,
-                api_key_id=key.id,
-                endpoint=llm_api_url,
                 start_time=start_time,
-                chat_completion_payload=validated_data,
+                in_flight=None,
+                headers=get_rate_limit_headers(),
+                token_debit=None,
+                flight=flight,
             )
 
+    return AdmittedChatCompletion(
+        api_key_id=key.id,
+        payload=validated_data,
+        raw=raw,
+        start_time=start_time,
+        in_flight=in_flight,
+        headers=get_rate_limit_headers(),
+        token_debit=token_debit,
+        cache_key=cache_key,
+        flight=flight,
+    )
+
+
+@v1_bp.route("/chat/completions", methods=["POST"])
+def chat_completions() -> Response:
+    """
+    Handle a chat completion request from the LLM endpoint API,
+    stream the response back to the client and update the API
+    key usage metrics.
+    """
+    # Every database read happens during admission: the session is closed
+    # afterwards, so that the connection goes back to the pool instead of being
+    # held while waiting for the LLM endpoint. The metrics are written in a
+    # unit of work of their own
+    with session_scope():
+        admitted = admit_chat_completion()
+    if not isinstance(admitted, AdmittedChatCompletion):
+        return admitted
+
+    validated_data = admitted.payload
+    if admitted.cached is not None:
+        return handle_cached_request(
+            api_key_id=admitted.api_key_id,
+            start_time=admitted.start_time,
+            chat_completion_payload=validated_data,
+            raw=admitted.raw,
+            cached=admitted.cached,
+        )
+    if admitted.in_flight is None:
+        return handle_coalesced_request(
+            api_key_id=admitted.api_key_id,
+            start_time=admitted.start_time,
+            chat_completion_payload=validated_data,
+            raw=admitted.raw,
+            flight=admitted.flight,
+        )
+
+    in_flight = admitted.in_flight
+    flight = admitted.flight
+    try:
+        if app.config["MOCK_LLM"]:
+            # Mock LLM Calls during testing, no tokens are used
+            refund_tokens(app._get_current_object(), admitted.token_debit)
+            if validated_data["stream"]:
+                response = handle_mock_streaming_request()
+            else:
+                response = handle_mock_non_streaming_request()
+        else:
+            if validated_data["stream"]:
+                response = handle_streaming_request(
+                    api_key_id=admitted.api_key_id,
+                    in_flight=in_flight,
+                    start_time=admitted.start_time,
+                    chat_completion_payload=validated_data,
+                    raw=admitted.raw,
+                    token_debit=admitted.token_debit,
+                    cache_key=admitted.cache_key,
+                    flight=flight,
+                )
+            else:
+                response = handle_non_streaming_request(
+                    api_key_id=admitted.api_key_id,
+                    in_flight=in_flight,
+                    start_time=admitted.start_time,
+                    chat_completion_payload=validated_data,
+                    token_debit=admitted.token_debit,
+                    cache_key=admitted.cache_key,
+                    flight=flight,
+                )
+        response = make_response(response)
+    except Exception:
+        in_flight.release()
+        refund_tokens(app._get_current_object(), admitted.token_debit)
+        if flight is not None:
+            flight.finish(error=FLIGHT_ABORTED)
+        raise
+
+    response.call_on_close(in_flight.release)
+    if flight is not None:
+        # Never leave the followers waiting, e.g. if the stream isn't consumed
+        response.call_on_close(lambda: flight.finish(error=FLIGHT_ABORTED))
     return response
 
 
+@v1_bp.route("/files", methods=["POST"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def upload_file(session: Session, key: APIKey) -> Response:
+    """
+    Upload a JSONL file, e.g. the input file of a batch.
+    """
+    try:
+        validated_data = UploadFileRequestSchema().load(request.form)
+    except ValidationError as err:
+        return jsonify({"errors": err.messages}), 400
+
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"errors": {"file": ["Missing data for required field."]}}), 400
+    content = upload.read(app.config["FILES_MAX_BYTES"] + 1)
+    if len(content) > app.config["FILES_MAX_BYTES"]:
+        return jsonify({"error": "File too large."}), 413
+    try:
+        content = content.decode("utf-8")
+    except UnicodeDecodeError:
+        return jsonify({"error": "The file must be UTF-8 encoded."}), 400
+
+    file = File.create(
+        session,
+        api_key_id=key.id,
+        filename=upload.filename,
+        purpose=validated_data["purpose"],
+        content=content,
+    )
+    return jsonify(FileSchema().dump(file)), 200
+
+
+@v1_bp.route("/files/<string:file_id>", methods=["GET"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def get_file(session: Session, key: APIKey, file_id: str) -> Response:
+    """
+    Get the details of a file of the API key.
+    """
+    file = (
+        session.query(File)
+        .filter_by(id=File.parse_id(file_id), api_key_id=key.id)
+        .one_or_none()
+    )
+    if not file:
+        return jsonify({"error": "File not found"}), 404
+    return jsonify(FileSchema().dump(file)), 200
+
+
+@v1_bp.route("/files/<string:file_id>/content", methods=["GET"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def get_file_content(session: Session, key: APIKey, file_id: str) -> Response:
+    """
+    Download the content of a file of the API key, e.g. the output file of a batch.
+    """
+    file = (
+        session.query(File)
+        .filter_by(id=File.parse_id(file_id), api_key_id=key.id)
+        .one_or_none()
+    )
+    if not file:
+        return jsonify({"error": "File not found"}), 404
+    return Response(file.content, mimetype="application/jsonl")
+
+
+@v1_bp.route("/batches", methods=["POST"])
+@ensure_api_key(include_api_key=True)
+@validate_request(CreateBatchRequestSchema)
+@with_session
+def create_batch(
+    session: Session, validated_data: typing.Dict[str, typing.Any], key: APIKey
+) -> Response:
+    """
+    Create a batch of chat completion requests from an uploaded JSONL file, run
+    by the worker.
+    """
+    input_file = (
+        session.query(File)
+        .filter_by(id=File.parse_id(validated_data["input_file_id"]), api_key_id=key.id)
+        .one_or_none()
+    )
+    if not input_file:
+        return jsonify({"error": "Input file not found"}), 404
+    if input_file.purpose != FilePurpose.BATCH:
+        return jsonify({"error": "The input file must have the batch purpose."}), 400
+
+    now = int(time.time())
+    batch = Batch(
+        api_key_id=key.id,
+        endpoint=validated_data["endpoint"],
+        input_file_id=input_file.id,
+        completion_window=validated_data["completion_window"],
+        status=BatchStatus.VALIDATING,
+        batch_metadata=validated_data["metadata"],
+        created_at=now,
+        expires_at=now + COMPLETION_WINDOWS[validated_data["completion_window"]],
+    )
+    session.add(batch)
+    session.commit()
+    run_batch.delay(batch.id)
+    return jsonify(BatchSchema().dump(batch)), 200
+
+
+@v1_bp.route("/batches", methods=["GET"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def list_batches(session: Session, key: APIKey) -> Response:
+    """
+    List the batches of the API key, most recent first. Paginated with the
+    `limit` (1 to 100) and `after` (ID of the last batch of the previous page)
+    query parameters.
+    """
+    limit = min(max(request.args.get("limit", default=20, type=int), 1), 100)
+    batches = session.query(Batch).filter_by(api_key_id=key.id)
+    if after := request.args.get("after"):
+        batches = batches.filter(Batch.id < (Batch.parse_id(after) or 0))
+    batches = batches.order_by(Batch.id.desc()).limit(limit + 1).all()
+
+    data = BatchSchema(many=True).dump(batches[:limit])
+    return jsonify(
+        {
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(batches) > limit,
+        }
+    ), 200
+
+
+@v1_bp.route("/batches/<string:batch_id>", methods=["GET"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def get_batch(session: Session, key: APIKey, batch_id: str) -> Response:
+    """
+    Get the status and progress of a batch of the API key.
+    """
+    batch = (
+        session.query(Batch)
+        .filter_by(id=Batch.parse_id(batch_id), api_key_id=key.id)
+        .one_or_none()
+    )
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(BatchSchema().dump(batch)), 200
+
+
+@v1_bp.route("/batches/<string:batch_id>/cancel", methods=["POST"])
+@ensure_api_key(include_api_key=True)
+@with_session
+def cancel_batch(session: Session, key: APIKey, batch_id: str) -> Response:
+    """
+    Cancel a batch of the API key. The worker stops sending its requests, and
+    the batch is cancelled once the requests in progress are done.
+    """
+    batch = (
+        session.query(Batch)
+        .filter_by(id=Batch.parse_id(batch_id), api_key_id=key.id)
+        .one_or_none()
+    )
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+
+    # Only update the batch if the worker didn't finish it in the meantime
+    cancelled = (
+        session.query(Batch)
+        .filter(Batch.id == batch.id, Batch.status.in_(BatchStatus.ACTIVE))
+        .update(
+            {"status": BatchStatus.CANCELLING, "cancelling_at": int(time.time())},
+            synchronize_session=False,
+        )
+    )
+    session.commit()
+    session.refresh(batch)
+    if not cancelled:
+        return jsonify({"error": f"A batch {batch.status} can't be cancelled."}), 409
+    return jsonify(BatchSchema().dump(batch)), 200
+
+
+@v1_bp.route("/stats", methods=["GET"])
+@ensure_admin_api_key()
+def get_stats() -> Response:
+    """
+    Get the runtime stats of this worker process.
+    """
+    return jsonify(
+        {
+            "metrics_writer": (
+                get_metrics_writer().stats()
+                if app.config["METRICS_ASYNC_WRITES"]
+                else None
+            ),
+            "upstream_pools": get_upstream_pool_stats(),
+        }
+    )
+
+
+@v1_bp.route("/metrics", methods=["GET"])
+@ensure_admin_api_key()
+def get_prometheus_metrics() -> Response:
+    """
+    Get the Prometheus metrics of the proxy, aggregated across the worker
+    processes in multiprocess mode (see `utils.prometheus`).
+    """
+    data, content_type = generate_metrics()
+    return Response(data, content_type=content_type)
+
+
+@v1_bp.route("/metrics/export", methods=["GET"])
+@ensure_admin_api_key()
+def export_metric_data() -> Response:
+    """
+    Stream the metrics as NDJSON (default), CSV or Parquet according to the
+    `format` query parameter, by ascending ID. Filtered and projected like
+    `/tables/metric`, e.g. `created__gte`/`created__lt`, `model` and
+    `api_key_id`, without the payloads of the completions unless their
+    columns are listed in `fields` (see `utils.metric_exports`).
+    """
+    export_format = request.args.get("format", ExportFormat.NDJSON)
+    if export_format not in ExportFormat.CHOICES:
+        return jsonify(
+            {"errors": {"format": [f"Must be one of: {', '.join(ExportFormat.CHOICES)}."]}}
+        ), 400
+    try:
+        columns = get_columns(
+            Metric.__table__,
+            request.args.get("fields") or ",".join(DEFAULT_EXPORT_COLUMNS),
+        )
+        filters = get_filters(Metric.__table__, request.args, reserved=EXPORT_ARGS)
+    except ValidationError as err:
+        return jsonify({"errors": err.messages}), 400
+
+    if export_format == ExportFormat.PARQUET:
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            return jsonify({"error": "Parquet exports require pyarrow."}), 501
+
+    chunks = export_metrics(
+        db.engine, export_format, columns, filters, app.config["METRICS_EXPORT_BATCH_SIZE"]
+    )
+    return Response(
+        chunks,
+        mimetype=ExportFormat.MIMETYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="metrics.{export_format}"'},
+    )
+
+
+@v1_bp.route("/usage", methods=["GET"])
+@ensure_admin_api_key()
+@with_session
+def get_usage(session: Session) -> Response:
+    """
+    Get the usage of the proxy per bucket of a granularity (minute, hour or
+    day) from the metric rollups, over the last 24 hours by default.
+    Filtered by the `model` and `api_key_id` query parameters, and grouped by
+    the dimensions of `group_by`.
+    """
+    try:
+        validated_data = UsageQuerySchema().load(request.args)
+    except ValidationError as err:
+        return jsonify({"errors": err.messages}), 400
+
+    data = query_rollups(
+        session,
+        validated_data["granularity"],
+        validated_data["start"],
+        validated_data["end"],
+        app.config["METRICS_SKETCH_RELATIVE_ACCURACY"],
+        model=validated_data.get("model"),
+        api_key_id=validated_data.get("api_key_id"),
+        group_by=validated_data["group_by"],
+    )
+    return jsonify(
+        {
+            "granularity": validated_data["granularity"],
+            "start": validated_data["start"],
+            "end": validated_data["end"],
+            "data": data,
+        }
+    ), 200
+
+
+@v1_bp.route("/latency", methods=["GET"])
+@ensure_admin_api_key()
+def get_latency() -> Response:
+    """
+    Get the p50, p95 and p99 of the duration, the time to first token and the
+    output tokens per second of the chat completions over the last `window`
+    seconds, per value of a `dimension` (model, replica or API key), from the
+    latency sketches merged in Redis by the workers.
+    """
+    try:
+        validated_data = LatencyQuerySchema().load(request.args)
+    except ValidationError as err:
+        return jsonify({"errors": err.messages}), 400
+
+    # Include the latencies of this worker not flushed yet
+    get_latency_sketches().flush()
+    end = time.time()
+    sketches = query_latency_sketches(
+        get_redis_client(),
+        validated_data["dimension"],
+        end - validated_data["window"],
+        end,
+        app.config["LATENCY_SKETCH_BUCKET_SECONDS"],
+        app.config["METRICS_SKETCH_RELATIVE_ACCURACY"],
+        value=validated_data.get("value"),
+    )
+    return jsonify(
+        {
+            "dimension": validated_data["dimension"],
+            "window": validated_data["window"],
+            "data": [
+                {
+                    "value": value,
+                    **{
+                        metric: summarize_sketch(metric_sketches.get(metric))
+                        for metric in LatencyMetric.CHOICES
+                    },
+                }
+                for value, metric_sketches in sorted(sketches.items())
+            ],
+        }
+    ), 200
+
+
 @v1_bp.route("/tables", methods=["GET"])
 @ensure_admin_api_key()
 def list_tables() -> Response:
@@ -164,24 +740,27 @@ def list_tables() -> Response:
 @with_session
 def get_table_data(session: Session, table_name: str) -> Response:
     """
-    Retrieve the first 100 rows of data for a given table.
-    FIXME: Limit is top 100 for now, need to add pagination before
-           elevating the limit.
-    """
-    if table_name in db.metadata.tables:
-        table_class = db.metadata.tables[table_name]
-        query = (
-            session.query(table_class)
-            .order_by(table_class.columns.id.desc())
-            .limit(100)
-            .all()
-        )
-        return jsonify(
-            {"data": [dict(zip(table_class.columns.keys(), row)) for row in query]}
-        )
-    else:
+    Retrieve the rows of a table, most recent first. Paginated with the
+    `limit` (1 to 1000, 100 by default) and `after_id` (`next_after_id` of the
+    previous page) query parameters, filtered by `<column>=<value>` and
+    `<column>__gte`/`__gt`/`__lte`/`__lt` ranges, and projected on the
+    comma-separated columns of `fields` (see `utils.table_queries`).
+    """
+    if table_name not in db.metadata.tables:
         return jsonify({"error": "Detail not found"}), 404
 
+    try:
+        data, next_after_id = query_table(session, db.metadata.tables[table_name], request.args)
+    except ValidationError as err:
+        return jsonify({"errors": err.messages}), 400
+    return jsonify(
+        {
+            "data": data,
+            "has_more": next_after_id is not None,
+            "next_after_id": next_after_id,
+        }
+    )
+
 
 @v1_bp.route("/models", methods=["GET"])
 @ensure_admin_api_key()
@@ -233,6 +812,7 @@ def create_model(
     model = LLMModel(name=model_name)
     session.add(model)
     session.commit()
+    invalidate_caches("model", "replicas")
     return jsonify({"model_name": model_name, "id": model.id}), 201
 
 
@@ -254,6 +834,7 @@ def delete_model(session: Session, model_id: int) -> Response:
     (session.query(Replica).filter_by(model_id=model_id).delete())
     session.query(LLMModel).filter_by(id=model_id).delete()
     session.commit()
+    invalidate_caches("model", "replicas")
     return jsonify({}), 204
 
 
@@ -302,6 +883,7 @@ def create_models_replicas(
     }
 
     replica = Replica.create(session, **validated_data)
+    invalidate_caches("replicas")
 
     if create_vm:
         validated_data["security_rules"] = [
@@ -349,6 +931,7 @@ def update_replica(
     if not replica:
         return jsonify({"error": "Replica not found"}), 404
     replica = Replica.update(session, replica, **validated_data)
+    invalidate_caches("replicas")
     return jsonify({}), 204
 
 
@@ -363,4 +946,5 @@ def delete_replica(session: Session, replica_id: int) -> Response:
     session.query(ReplicaSecurityRule).filter_by(replica_id=replica_id).delete()
     session.query(Replica).filter_by(id=replica_id).delete()
     session.commit()
+    invalidate_caches("replicas")
     return jsonify({}), 204
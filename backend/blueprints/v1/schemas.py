@@ -1,12 +1,20 @@
-from flask import request
-from marshmallow import Schema, fields, validate, validates_schema, ValidationError
+import time
+
+from flask import current_app, request
+from marshmallow import Schema, fields, post_load, validate, validates_schema, ValidationError
 from marshmallow_union import Union
 
-from utils.db import db
+from utils.cache import get_api_key_by_value, get_model_by_name, get_model_replicas
 from utils.rest import get_api_key
-from tables.api_key import APIKey
-from tables.llm_model import LLMModel
-from tables.replicas import Replica
+from tables.api_key import APIKeyPriority
+from tables.file import FilePurpose
+from tables.metric_rollup import RollupGranularity
+from utils.batches import BATCH_ENDPOINTS, COMPLETION_WINDOWS
+from utils.latency_sketches import SketchDimension
+from utils.rollups import MAX_QUERY_BUCKETS, ROLLUP_GROUPS
+
+# Range of the usage queries without `start`, in seconds
+USAGE_DEFAULT_RANGE = 24 * 60 * 60
 
 
 class GenerateAPIKeyRequestSchema(Schema):
@@ -16,6 +24,28 @@ class GenerateAPIKeyRequestSchema(Schema):
 
     user_id = fields.Str(required=True, validate=validate.Length(min=1))
     allowed_rpm = fields.Int()
+    allowed_tpm = fields.Int(validate=validate.Range(min=1))
+    daily_token_budget = fields.Int(validate=validate.Range(min=1))
+    priority = fields.Str(validate=validate.OneOf(APIKeyPriority.CHOICES))
+
+
+class UploadFileRequestSchema(Schema):
+    """
+    Upload file request schema which is what is expected (as form fields, along with the file) by the files endpoint.
+    """
+
+    purpose = fields.Str(required=True, validate=validate.OneOf([FilePurpose.BATCH]))
+
+
+class CreateBatchRequestSchema(Schema):
+    """
+    Create batch request schema which is what is expected by the batches endpoint.
+    """
+
+    input_file_id = fields.Str(required=True)
+    endpoint = fields.Str(required=True, validate=validate.OneOf(list(BATCH_ENDPOINTS)))
+    completion_window = fields.Str(required=True, validate=validate.OneOf(list(COMPLETION_WINDOWS)))
+    metadata = fields.Dict(keys=fields.Str(), values=fields.Str(), load_default=None)
 
 
 class DeleteAPIKeyRequestSchema(Schema):
@@ -27,6 +57,65 @@ class DeleteAPIKeyRequestSchema(Schema):
     api_key_id = fields.Int(required=True)
 
 
+class UsageQuerySchema(Schema):
+    """
+    Usage query schema which is what is expected (as query parameters) by the usage endpoint. `start` and `end` are
+    unix timestamps, the last 24 hours by default, and `group_by` a comma-separated list of dimensions.
+    """
+
+    granularity = fields.Str(
+        load_default=RollupGranularity.HOUR, validate=validate.OneOf(RollupGranularity.CHOICES)
+    )
+    start = fields.Int(validate=validate.Range(min=0))
+    end = fields.Int(validate=validate.Range(min=0))
+    model = fields.Str()
+    api_key_id = fields.Int()
+    group_by = fields.Str(load_default="")
+
+    @validates_schema
+    def validate_range(self, data, **kwargs):
+        for group in filter(None, data["group_by"].split(",")):
+            if group not in ROLLUP_GROUPS:
+                raise ValidationError(
+                    f"Must be a comma-separated list of {', '.join(ROLLUP_GROUPS)}.", field_name="group_by"
+                )
+
+        end = data.get("end", int(time.time()))
+        start = data.get("start", end - USAGE_DEFAULT_RANGE)
+        if start >= end:
+            raise ValidationError("start must be less than end.", field_name="start")
+        if (end - start) / RollupGranularity.SECONDS[data["granularity"]] > MAX_QUERY_BUCKETS:
+            raise ValidationError(
+                f"The range can't span more than {MAX_QUERY_BUCKETS} buckets of the granularity.",
+                field_name="start",
+            )
+
+    @post_load
+    def make_range(self, data, **kwargs):
+        data["group_by"] = [group for group in data["group_by"].split(",") if group]
+        data.setdefault("end", int(time.time()))
+        data.setdefault("start", data["end"] - USAGE_DEFAULT_RANGE)
+        return data
+
+
+class LatencyQuerySchema(Schema):
+    """
+    Latency query schema which is what is expected (as query parameters) by the latency endpoint. `window` is the
+    number of seconds before now to get the percentiles of, up to the TTL of the sketches.
+    """
+
+    dimension = fields.Str(load_default=SketchDimension.MODEL, validate=validate.OneOf(SketchDimension.CHOICES))
+    value = fields.Str()
+    window = fields.Int(load_default=60 * 60, validate=validate.Range(min=1))
+
+    @validates_schema
+    def validate_window(self, data, **kwargs):
+        if data["window"] > current_app.config["LATENCY_SKETCH_TTL"]:
+            raise ValidationError(
+                f"Must be at most {current_app.config['LATENCY_SKETCH_TTL']} seconds.", field_name="window"
+            )
+
+
 class ContentItemSchema(Schema):
     type = fields.Str(
         required=True,
@@ -323,6 +412,13 @@ class ChatCompletionRequestSchema(Schema):
         load_default=True,
         metadata={"description": "Flag to return raw stream response"},
     )
+    priority = fields.Str(
+        load_default=None,
+        validate=validate.OneOf(APIKeyPriority.CHOICES),
+        metadata={
+            "description": "Priority class of the request, can only lower the priority of the API key."
+        },
+    )
 
     @validates_schema
     def validate_model(self, data, **kwargs):
@@ -330,20 +426,13 @@ class ChatCompletionRequestSchema(Schema):
         if not model_name:
             raise ValidationError("Model must not be empty.", field_name="model")
 
-        models = (
-            db.session.query(LLMModel)
-            .join(Replica, Replica.model_id == LLMModel.id)
-            .all()
-        )
-        models = [model.name for model in models]
-        if model_name not in models:
+        model = get_model_by_name(model_name)
+        if not model or not get_model_replicas(model.id):
             raise ValidationError(
                 f"Model name {model_name!r} is not supported.", field_name="model"
             )
 
-        is_valid = (
-            db.session.query(APIKey).filter_by(api_key=get_api_key(request)).first()
-        )
+        is_valid = get_api_key_by_value(get_api_key(request))
         if not is_valid:
             raise ValidationError("Invalid API key.", field_name="model")
 
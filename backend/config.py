@@ -18,11 +18,96 @@ class Config:
     MOCK_LLM = False
     LLM_MOCK_DATA_STREAM_PATH = os.getenv('LLM_MOCK_DATA_STREAM_PATH', '/app/data/streamed.txt')
 
+    # Upstream connections to the replicas
+    UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', default=100))
+    UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', default=60))
+    UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', default=5))
+    UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', default=900))
+    UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', default=2))
+    UPSTREAM_RETRY_BACKOFF_MS = int(os.getenv('UPSTREAM_RETRY_BACKOFF_MS', default=100))
+    UPSTREAM_RETRY_MAX_BACKOFF_MS = int(os.getenv('UPSTREAM_RETRY_MAX_BACKOFF_MS', default=1000))
+
+    # Metrics writer
+    METRICS_ASYNC_WRITES = os.getenv('METRICS_ASYNC_WRITES', default='true').lower() == 'true'
+    METRICS_BATCH_SIZE = int(os.getenv('METRICS_BATCH_SIZE', default=500))
+    METRICS_FLUSH_INTERVAL_MS = int(os.getenv('METRICS_FLUSH_INTERVAL_MS', default=200))
+    METRICS_QUEUE_MAXSIZE = int(os.getenv('METRICS_QUEUE_MAXSIZE', default=10000))
+    METRICS_QUEUE_PUT_TIMEOUT_MS = int(os.getenv('METRICS_QUEUE_PUT_TIMEOUT_MS', default=10))
+    # Payloads of the chat completions stored in their metrics: full, compressed, hash or off
+    METRICS_PAYLOAD_MODE = os.getenv('METRICS_PAYLOAD_MODE', default='full')
+    METRICS_PAYLOAD_SAMPLE_RATE = float(os.getenv('METRICS_PAYLOAD_SAMPLE_RATE', default=1.0))
+    METRICS_PAYLOAD_COMPRESSION_LEVEL = int(os.getenv('METRICS_PAYLOAD_COMPRESSION_LEVEL', default=3))
+    # Retention of the metric table (0 keeps the metrics forever), run by the worker every interval in seconds
+    METRICS_RETENTION_DAYS = int(os.getenv('METRICS_RETENTION_DAYS', default=0))
+    METRICS_RETENTION_INTERVAL = float(os.getenv('METRICS_RETENTION_INTERVAL', default=3600))
+    METRICS_RETENTION_BATCH_SIZE = int(os.getenv('METRICS_RETENTION_BATCH_SIZE', default=10000))
+    # Monthly partitions of the metric table created ahead of time, once partitioned
+    METRICS_PARTITIONS_AHEAD = int(os.getenv('METRICS_PARTITIONS_AHEAD', default=3))
+    # Rows of the metric exports read and encoded at a time
+    METRICS_EXPORT_BATCH_SIZE = int(os.getenv('METRICS_EXPORT_BATCH_SIZE', default=10000))
+    # Rollups of the metrics per minute, hour and day, run by the worker every interval in seconds
+    METRICS_ROLLUP_INTERVAL = float(os.getenv('METRICS_ROLLUP_INTERVAL', default=60))
+    METRICS_ROLLUP_BATCH_SIZE = int(os.getenv('METRICS_ROLLUP_BATCH_SIZE', default=10000))
+    # Relative accuracy of the latency quantiles of the rollups, fixed once rollups exist
+    METRICS_SKETCH_RELATIVE_ACCURACY = float(os.getenv('METRICS_SKETCH_RELATIVE_ACCURACY', default=0.01))
+    # Latency sketches of the workers, flushed to Redis every interval and kept per bucket for the TTL, in seconds
+    LATENCY_SKETCH_BUCKET_SECONDS = int(os.getenv('LATENCY_SKETCH_BUCKET_SECONDS', default=60))
+    LATENCY_SKETCH_TTL = int(os.getenv('LATENCY_SKETCH_TTL', default=86400))
+    LATENCY_SKETCH_FLUSH_INTERVAL = float(os.getenv('LATENCY_SKETCH_FLUSH_INTERVAL', default=10))
+
     # Redis
     REDIS_HOST = os.getenv('REDIS_HOST', default='redis')
     REDIS_PORT = os.getenv('REDIS_PORT', default=6379)
     REDIS_DB = os.getenv('REDIS_DB', default=0)
 
+    # Lookup caches (API keys, models and replicas), a TTL of 0 disables them
+    LOOKUP_CACHE_TTL = int(os.getenv('LOOKUP_CACHE_TTL', default=30))
+    LOOKUP_CACHE_MAXSIZE = int(os.getenv('LOOKUP_CACHE_MAXSIZE', default=1024))
+
+    # Response cache of the deterministic chat completions, a TTL of 0 disables it
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', default=0))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', default=10000))
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY_BYTES', default=1048576))
+
+    # Coalescing of the identical deterministic chat completions in flight in a worker
+    SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', default='false').lower() == 'true'
+
+    # Routing
+    REPLICA_ROUTING_STRATEGY = os.getenv('REPLICA_ROUTING_STRATEGY', default='least_outstanding_requests')
+    REPLICA_INFLIGHT_TIMEOUT = int(os.getenv('REPLICA_INFLIGHT_TIMEOUT', default=900))
+    PREFIX_AFFINITY_TOKENS = int(os.getenv('PREFIX_AFFINITY_TOKENS', default=512))
+    PREFIX_AFFINITY_LOAD_FACTOR = float(os.getenv('PREFIX_AFFINITY_LOAD_FACTOR', default=1.25))
+
+    # Admission queue of the chat completions of a model, a max in-flight of 0 disables it
+    ADMISSION_MAX_IN_FLIGHT_PER_REPLICA = int(os.getenv('ADMISSION_MAX_IN_FLIGHT_PER_REPLICA', default=0))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', default=30))
+    ADMISSION_INTERACTIVE_WEIGHT = float(os.getenv('ADMISSION_INTERACTIVE_WEIGHT', default=10))
+    ADMISSION_BATCH_WEIGHT = float(os.getenv('ADMISSION_BATCH_WEIGHT', default=1))
+    # Threads of an ASGI worker running the admissions, each queued request holds one
+    ADMISSION_THREADS = int(os.getenv('ADMISSION_THREADS', default=256))
+
+    # Circuit breaking and health probes of the replicas
+    CIRCUIT_BREAKER_WINDOW = int(os.getenv('CIRCUIT_BREAKER_WINDOW', default=30))
+    CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv('CIRCUIT_BREAKER_MIN_REQUESTS', default=10))
+    CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv('CIRCUIT_BREAKER_ERROR_RATE', default=0.5))
+    CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', default=30))
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_SECONDS', default=0))
+    CIRCUIT_BREAKER_PROBE_FAILURES = int(os.getenv('CIRCUIT_BREAKER_PROBE_FAILURES', default=2))
+    REPLICA_HEALTH_CHECK_INTERVAL = float(os.getenv('REPLICA_HEALTH_CHECK_INTERVAL', default=10))
+    REPLICA_HEALTH_CHECK_TIMEOUT = float(os.getenv('REPLICA_HEALTH_CHECK_TIMEOUT', default=2))
+
+    # Token quotas, the completion tokens debited for requests without `max_tokens`
+    TOKEN_QUOTA_DEFAULT_MAX_TOKENS = int(os.getenv('TOKEN_QUOTA_DEFAULT_MAX_TOKENS', default=1024))
+
+    # Batches, run by the worker through the chat completions endpoint of the backend
+    BATCH_API_BASE_URL = os.getenv('BATCH_API_BASE_URL', default='http://app:5001/api/v1')
+    BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', default=8))
+    BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', default=50000))
+    BATCH_REQUEST_TIMEOUT = float(os.getenv('BATCH_REQUEST_TIMEOUT', default=600))
+    BATCH_REQUEST_RETRIES = int(os.getenv('BATCH_REQUEST_RETRIES', default=5))
+    BATCH_PROGRESS_INTERVAL = float(os.getenv('BATCH_PROGRESS_INTERVAL', default=5))
+    FILES_MAX_BYTES = int(os.getenv('FILES_MAX_BYTES', default=52428800))
+
     # Celery
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', default='redis://redis:6379')
     CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', default='redis://redis:6379')
@@ -60,6 +145,7 @@ class TestConfig(Config):
     LLM_ENDPOINTS_CONFIG = make_test_llm_config()
     CELERY_TASK_ALWAYS_EAGER = True
     MOCK_LLM = True
+    METRICS_ASYNC_WRITES = False
     REDIS_DB = 1
 
 
@@ -0,0 +1,15 @@
+"""
+Gunicorn settings of the backend, loaded from the working directory on top of the command line options.
+"""
+
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    """
+    Mark the Prometheus metrics of a dead worker as such, so that its live gauges are dropped from `/metrics`.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
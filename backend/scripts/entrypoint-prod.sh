@@ -9,5 +9,15 @@ source venv/bin/activate
 # Migrate database
 flask db upgrade
 
+# Collect the Prometheus metrics of every Gunicorn worker, see utils/prometheus.py
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+
 # Run application using Gunicorn
-gunicorn -w 2 -b :5001 --log-level info --worker-class gevent --timeout 900 --keep-alive 750 app:app
+if [ "${SERVER_MODE}" = "asgi" ]; then
+    # Chat completions are proxied on asyncio, see asgi.py
+    gunicorn -w 2 -b :5001 --log-level info --worker-class uvicorn.workers.UvicornWorker --timeout 900 --keep-alive 750 asgi:application
+else
+    gunicorn -w 2 -b :5001 --log-level info --worker-class gevent --timeout 900 --keep-alive 750 app:app
+fi
@@ -10,6 +10,14 @@ from marshmallow import fields
 from utils.db import db
 
 
+class APIKeyPriority:
+    INTERACTIVE = 'interactive'
+    BATCH = 'batch'
+
+    # From the highest priority to the lowest
+    CHOICES = [INTERACTIVE, BATCH]
+
+
 class APIKey(db.Model):
     """
     A table to contain api keys for a user
@@ -25,6 +33,13 @@ class APIKey(db.Model):
         index=True,
     )
     allowed_rpm = db.Column(db.Integer, default=160)
+    # Token quotas, no limit when unset
+    allowed_tpm = db.Column(db.Integer, nullable=True)
+    daily_token_budget = db.Column(db.BigInteger, nullable=True)
+    # Priority class of the requests in the admission queue of a model
+    priority = db.Column(
+        db.String(32), default=APIKeyPriority.INTERACTIVE, server_default=APIKeyPriority.INTERACTIVE
+    )
     enabled = db.Column(db.Boolean, default=True)
 
     @classmethod
@@ -52,4 +67,7 @@ class APIKeySchema(SQLAlchemySchema):
     user_id = fields.String()
     api_key = fields.String()
     allowed_rpm = fields.Integer()
+    allowed_tpm = fields.Integer()
+    daily_token_budget = fields.Integer()
+    priority = fields.String()
     enabled = fields.Boolean()
@@ -0,0 +1,116 @@
+import typing
+
+from sqlalchemy import ForeignKey
+from sqlalchemy.orm import relationship
+from marshmallow_sqlalchemy import SQLAlchemySchema
+from marshmallow import fields
+
+from utils.db import db
+from tables.file import File
+
+
+class BatchStatus:
+    VALIDATING = 'validating'
+    FAILED = 'failed'
+    IN_PROGRESS = 'in_progress'
+    FINALIZING = 'finalizing'
+    COMPLETED = 'completed'
+    EXPIRED = 'expired'
+    CANCELLING = 'cancelling'
+    CANCELLED = 'cancelled'
+
+    CHOICES = [VALIDATING, FAILED, IN_PROGRESS, FINALIZING, COMPLETED, EXPIRED, CANCELLING, CANCELLED]
+    # Statuses of the batches that can be cancelled
+    ACTIVE = [VALIDATING, IN_PROGRESS]
+
+
+class Batch(db.Model):
+    """
+    A table to store the batches of chat completion requests, run by the worker
+    """
+
+    __tablename__ = "batch"
+
+    ID_PREFIX = "batch_"
+
+    id = db.Column(db.Integer, primary_key=True, index=True)
+    api_key_id = db.Column(db.Integer, ForeignKey('api_key.id'), index=True)
+    endpoint = db.Column(db.String(255))
+    input_file_id = db.Column(db.Integer, ForeignKey('file.id'))
+    output_file_id = db.Column(db.Integer, ForeignKey('file.id'), nullable=True)
+    error_file_id = db.Column(db.Integer, ForeignKey('file.id'), nullable=True)
+    completion_window = db.Column(db.String(16))
+    status = db.Column(db.String(32), default=BatchStatus.VALIDATING)
+    # Errors of the input file, e.g. invalid lines
+    errors = db.Column(db.JSON, nullable=True)
+    request_total = db.Column(db.Integer, default=0)
+    request_completed = db.Column(db.Integer, default=0)
+    request_failed = db.Column(db.Integer, default=0)
+    batch_metadata = db.Column("metadata", db.JSON, nullable=True)
+
+    # Unix timestamps of the status changes
+    created_at = db.Column(db.Integer)
+    in_progress_at = db.Column(db.Integer, nullable=True)
+    expires_at = db.Column(db.Integer)
+    finalizing_at = db.Column(db.Integer, nullable=True)
+    completed_at = db.Column(db.Integer, nullable=True)
+    failed_at = db.Column(db.Integer, nullable=True)
+    expired_at = db.Column(db.Integer, nullable=True)
+    cancelling_at = db.Column(db.Integer, nullable=True)
+    cancelled_at = db.Column(db.Integer, nullable=True)
+
+    # Relationships
+    api_key = relationship("APIKey", foreign_keys=[api_key_id])
+    input_file = relationship("File", foreign_keys=[input_file_id])
+
+    @classmethod
+    def format_id(cls, batch_id: int) -> str:
+        """
+        Returns the OpenAI style ID of a batch, e.g. `batch_42`.
+        """
+        return f"{cls.ID_PREFIX}{batch_id}"
+
+    @classmethod
+    def parse_id(cls, value: str) -> typing.Optional[int]:
+        """
+        Returns the ID of a batch from its OpenAI style ID, or None if it isn't one.
+        """
+        if not value.startswith(cls.ID_PREFIX) or not value[len(cls.ID_PREFIX):].isdigit():
+            return None
+        return int(value[len(cls.ID_PREFIX):])
+
+
+class BatchSchema(SQLAlchemySchema):
+    """
+    Dumps a batch as an OpenAI batch object.
+    """
+
+    class Meta:
+        model = Batch
+
+    id = fields.Function(lambda batch: Batch.format_id(batch.id))
+    object = fields.Constant("batch")
+    endpoint = fields.String()
+    errors = fields.Function(lambda batch: {"object": "list", "data": batch.errors} if batch.errors else None)
+    input_file_id = fields.Function(lambda batch: File.format_id(batch.input_file_id))
+    completion_window = fields.String()
+    status = fields.String()
+    output_file_id = fields.Function(lambda batch: File.format_id(batch.output_file_id))
+    error_file_id = fields.Function(lambda batch: File.format_id(batch.error_file_id))
+    created_at = fields.Integer()
+    in_progress_at = fields.Integer()
+    expires_at = fields.Integer()
+    finalizing_at = fields.Integer()
+    completed_at = fields.Integer()
+    failed_at = fields.Integer()
+    expired_at = fields.Integer()
+    cancelling_at = fields.Integer()
+    cancelled_at = fields.Integer()
+    request_counts = fields.Function(
+        lambda batch: {
+            "total": batch.request_total,
+            "completed": batch.request_completed,
+            "failed": batch.request_failed,
+        }
+    )
+    metadata = fields.Raw(attribute="batch_metadata")
@@ -0,0 +1,96 @@
+import time
+import typing
+
+from sqlalchemy import ForeignKey
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.orm import Session, relationship
+from marshmallow_sqlalchemy import SQLAlchemySchema
+from marshmallow import fields
+
+from utils.db import db
+
+
+class FilePurpose:
+    BATCH = 'batch'
+    BATCH_OUTPUT = 'batch_output'
+
+    CHOICES = [BATCH, BATCH_OUTPUT]
+
+
+class File(db.Model):
+    """
+    A table to store the files uploaded as batch inputs, and the batch output files
+    """
+
+    __tablename__ = "file"
+
+    ID_PREFIX = "file-"
+
+    id = db.Column(db.Integer, primary_key=True, index=True)
+    api_key_id = db.Column(db.Integer, ForeignKey('api_key.id'), index=True)
+    filename = db.Column(db.String(255))
+    purpose = db.Column(db.String(32))
+    bytes = db.Column(db.Integer)
+    created_at = db.Column(db.Integer)
+    # JSONL content
+    content = db.Column(db.Text().with_variant(LONGTEXT(), 'mysql'))
+
+    # Relationships
+    api_key = relationship("APIKey", foreign_keys=[api_key_id])
+
+    @classmethod
+    def create(
+        cls: typing.Self, session: Session, api_key_id: int, filename: str, purpose: str, content: str
+    ) -> typing.Self:
+        """
+        Create a file record in the database
+        """
+        file = cls(
+            api_key_id=api_key_id,
+            filename=filename,
+            purpose=purpose,
+            bytes=len(content.encode('utf-8')),
+            created_at=int(time.time()),
+            content=content,
+        )
+        session.add(file)
+        session.commit()
+        return file
+
+    @classmethod
+    def append(cls: typing.Self, session: Session, file_id: int, content: str) -> None:
+        """
+        Append content to a file record in the database, without loading the content it already has
+        """
+        session.query(cls).filter_by(id=file_id).update(
+            {"content": cls.content + content, "bytes": cls.bytes + len(content.encode('utf-8'))},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def format_id(cls, file_id: typing.Optional[int]) -> typing.Optional[str]:
+        """
+        Returns the OpenAI style ID of a file, e.g. `file-42`.
+        """
+        return f"{cls.ID_PREFIX}{file_id}" if file_id is not None else None
+
+    @classmethod
+    def parse_id(cls, value: str) -> typing.Optional[int]:
+        """
+        Returns the ID of a file from its OpenAI style ID, or None if it isn't one.
+        """
+        if not value.startswith(cls.ID_PREFIX) or not value[len(cls.ID_PREFIX):].isdigit():
+            return None
+        return int(value[len(cls.ID_PREFIX):])
+
+
+class FileSchema(SQLAlchemySchema):
+    class Meta:
+        model = File
+
+    id = fields.Function(lambda file: File.format_id(file.id))
+    object = fields.Constant("file")
+    bytes = fields.Integer()
+    created_at = fields.Integer()
+    filename = fields.String()
+    purpose = fields.String()
@@ -0,0 +1,59 @@
+from sqlalchemy import ForeignKey, UniqueConstraint
+
+from utils.db import db
+
+
+class RollupGranularity:
+    MINUTE = 'minute'
+    HOUR = 'hour'
+    DAY = 'day'
+
+    CHOICES = [MINUTE, HOUR, DAY]
+    # Length of the buckets of each granularity, in seconds
+    SECONDS = {MINUTE: 60, HOUR: 60 * 60, DAY: 24 * 60 * 60}
+
+
+class MetricRollup(db.Model):
+    """
+    A table to contain the metrics aggregated per time bucket, model and API key, maintained by the worker (see
+    `utils.rollups`)
+    """
+
+    __tablename__ = "metric_rollup"
+    __table_args__ = (
+        UniqueConstraint('granularity', 'bucket', 'model', 'api_key_id', name='uq_metric_rollup_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, index=True)
+    granularity = db.Column(db.String(8))
+    # Unix timestamp of the start of the bucket
+    bucket = db.Column(db.Integer)
+    model = db.Column(db.String(255))
+    api_key_id = db.Column(db.Integer, ForeignKey('api_key.id'))
+
+    request_count = db.Column(db.Integer, default=0)
+    cache_hits = db.Column(db.Integer, default=0)
+    # Token sums of the metrics with usage data
+    prompt_tokens = db.Column(db.BigInteger, default=0)
+    completion_tokens = db.Column(db.BigInteger, default=0)
+    total_tokens = db.Column(db.BigInteger, default=0)
+    duration_sum = db.Column(db.Float, default=0)
+    time_to_first_token_sum = db.Column(db.Float, default=0)
+    time_to_first_token_count = db.Column(db.Integer, default=0)
+    # Quantile sketches of the latencies (see `utils.sketches.DDSketch`)
+    duration_sketch = db.Column(db.JSON, nullable=True)
+    time_to_first_token_sketch = db.Column(db.JSON, nullable=True)
+
+
+class MetricRollupWatermark(db.Model):
+    """
+    A table to contain the progress of the rollup of the metrics, a single row
+    """
+
+    __tablename__ = "metric_rollup_watermark"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # ID of the last metric rolled up
+    last_metric_id = db.Column(db.Integer, default=0)
+    # Highest ID of the metrics at the previous run, rolled up by the next one
+    pending_metric_id = db.Column(db.Integer, default=0)
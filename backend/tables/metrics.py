@@ -1,6 +1,7 @@
 import typing
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, false, insert
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.orm import relationship, Session
 from marshmallow_sqlalchemy import SQLAlchemySchema
 from marshmallow import fields
@@ -15,6 +16,11 @@ class Metric(db.Model):
     """
 
     __tablename__ = "metric"
+    __table_args__ = (
+        # Usage of an API key or a model over time
+        db.Index('ix_metric_api_key_id_created', 'api_key_id', 'created'),
+        db.Index('ix_metric_model_created', 'model', 'created'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, index=True)
     api_key_id = db.Column(db.Integer, ForeignKey('api_key.id'))
@@ -27,6 +33,18 @@ class Metric(db.Model):
     total_tokens = db.Column(db.Integer)
     completion_tokens = db.Column(db.Integer)
     duration = db.Column(db.Float)
+    retries = db.Column(db.Integer, default=0, server_default='0')
+    cache_hit = db.Column(db.Boolean, default=False, server_default=false())
+    # Latency breakdown of the streamed completions, in seconds (see `utils.latency.StreamTimer`)
+    upstream_connect_time = db.Column(db.Float, nullable=True)
+    time_to_first_token = db.Column(db.Float, nullable=True)
+    time_per_output_token = db.Column(db.Float, nullable=True)
+    proxy_overhead = db.Column(db.Float, nullable=True)
+    chunk_count = db.Column(db.Integer, nullable=True)
+    # Payloads stored depending on `METRICS_PAYLOAD_MODE` (see `utils.metric_payloads`): the SHA-256 of the request,
+    # and the request with the final choices of the completion as zstd-compressed JSON
+    input_hash = db.Column(db.String(64), nullable=True)
+    payload = db.Column(db.LargeBinary().with_variant(LONGBLOB(), 'mysql'), nullable=True)
 
     # Relationships
     api_key = relationship("APIKey", foreign_keys=[api_key_id])
@@ -43,6 +61,18 @@ class Metric(db.Model):
         session.commit()
         return db_metric
 
+    @classmethod
+    def bulk_create(
+        cls: typing.Self,
+        session: Session,
+        data_list: typing.List[typing.Dict[str, typing.Any]]
+    ):
+        """
+        Create metric records in the database with a single multi-row insert
+        """
+        session.execute(insert(cls), data_list)
+        session.commit()
+
 
 class MetricSchema(SQLAlchemySchema):
     class Meta:
@@ -60,6 +90,15 @@ class MetricSchema(SQLAlchemySchema):
     total_tokens = fields.Integer()
     completion_tokens = fields.Integer()
     duration = fields.Float()
+    retries = fields.Integer()
+    cache_hit = fields.Boolean()
+    upstream_connect_time = fields.Float()
+    time_to_first_token = fields.Float()
+    time_per_output_token = fields.Float()
+    proxy_overhead = fields.Float()
+    chunk_count = fields.Integer()
+    input_hash = fields.String()
+    payload = fields.Raw()
 
     # Relationships
     api_key = fields.Nested(APIKeySchema)
@@ -6,7 +6,7 @@ import factory.fuzzy
 
 from utils.db import db
 from tables.metrics import Metric
-from tables.api_key import APIKey
+from tables.api_key import APIKey, APIKeyPriority
 from tables.llm_model import LLMModel
 from tables.replicas import Replica
 
@@ -29,6 +29,7 @@ class APIKeyFactory(factory.alchemy.SQLAlchemyModelFactory):
     user_id = factory.Faker("uuid4")
     api_key = factory.Faker("uuid4")
     allowed_rpm = factory.fuzzy.FuzzyInteger(low=50, high=100)
+    priority = APIKeyPriority.INTERACTIVE
     enabled = factory.Faker("boolean", chance_of_getting_true=75)
 
 
@@ -52,6 +53,8 @@ class MetricFactory(factory.alchemy.SQLAlchemyModelFactory):
     total_tokens = factory.Faker("random_int", min=0, max=100)
     completion_tokens = factory.Faker("random_int", min=0, max=100)
     duration = factory.fuzzy.FuzzyFloat(low=0.1, high=10.0, precision=1)
+    retries = 0
+    cache_hit = False
 
 
 class LLMModelFactory(factory.alchemy.SQLAlchemyModelFactory):
@@ -2,9 +2,17 @@ import pytest
 from sqlalchemy.sql import text
 
 from app import create_app
+from utils.cache import clear_caches
 from utils.db import db
 from utils.redis import flush_redis_db
-from utils.rate_limits import RateLimitExceeded, rate_limit_error_handler
+from utils.rate_limits import (
+    RateLimitExceeded,
+    ReplicaRateLimitExceeded,
+    TokenQuotaExceeded,
+    rate_limit_error_handler,
+    replica_rate_limit_error_handler,
+    token_quota_error_handler,
+)
 
 
 @pytest.fixture(scope="session")
@@ -13,8 +21,10 @@ def mock_app(request):
     Returns session-wide application.
     """
     app = create_app("testing")
-    # register the rate limit exceeded error handler for tests
+    # register the rate limit exceeded error handlers for tests
     app.errorhandler(RateLimitExceeded)(rate_limit_error_handler)
+    app.errorhandler(ReplicaRateLimitExceeded)(replica_rate_limit_error_handler)
+    app.errorhandler(TokenQuotaExceeded)(token_quota_error_handler)
     return app
 
 
@@ -52,6 +62,7 @@ def db_session(mock_app, init_db, request):
     - Truncates all tables to ensure a clean state.
     - Closes the session after the test is done.
     - Flushes the Redis test database.
+    - Clears the in-process lookup caches.
     """
     with mock_app.app_context():
         local_session = db.session(expire_on_commit=False)
@@ -72,3 +83,6 @@ def db_session(mock_app, init_db, request):
 
         # Flush redis test database
         flush_redis_db()
+
+        # Clear the lookup caches
+        clear_caches()
@@ -0,0 +1,67 @@
+import time
+import threading
+from unittest.mock import patch
+
+from tables.api_key import APIKeyPriority
+from utils.admission import AdmissionQueue, resolve_priority
+
+CONFIG = {"ADMISSION_MAX_IN_FLIGHT_PER_REPLICA": 1, "ADMISSION_QUEUE_TIMEOUT": 1}
+
+
+class TestAdmissionQueue:
+    """
+    Tests for the admission queue of the chat completion requests of a model.
+    """
+
+    def test_resolve_priority(self):
+        """
+        Test that a request can only lower the priority of its API key.
+        """
+        assert resolve_priority(APIKeyPriority.INTERACTIVE) == APIKeyPriority.INTERACTIVE
+        assert resolve_priority(APIKeyPriority.INTERACTIVE, APIKeyPriority.BATCH) == APIKeyPriority.BATCH
+        assert resolve_priority(APIKeyPriority.BATCH, APIKeyPriority.INTERACTIVE) == APIKeyPriority.BATCH
+
+    def test_weighted_fair_queuing(self, mock_app):
+        """
+        Test that an interactive request overtakes the batch requests queued before it, and that the queued
+        requests are only let in as slots are released.
+        """
+        with patch.dict(mock_app.config, CONFIG):
+            queue = AdmissionQueue(1)
+            slot = queue.wait(1, APIKeyPriority.BATCH, 1)
+            batch = [queue.enqueue(1, 1) for _ in range(3)]
+            interactive = queue.enqueue(2, 10)
+            assert [queue.acquire(ticket, 1) for ticket in (*batch, interactive)] == [0, 0, 0, 0]
+
+            slot.release()
+            assert queue.acquire(batch[0], 1) == 0
+            assert queue.acquire(interactive, 1) == 1
+            queue.cancel(batch[0])
+            assert queue.acquire(batch[0], 1) == -1
+            assert queue.acquire(batch[1], 2) == 1
+
+    def test_release_wakes_queued_request(self, mock_app):
+        """
+        Test that a queued request is let in as soon as a slot is released, without waiting for its timeout.
+        """
+        with patch.dict(mock_app.config, {**CONFIG, "ADMISSION_QUEUE_TIMEOUT": 5}):
+            queue = AdmissionQueue(1)
+            slot = queue.wait(1, APIKeyPriority.INTERACTIVE, 1)
+            admitted = []
+
+            def wait():
+                with mock_app.app_context():
+                    admitted.append((queue.wait(2, APIKeyPriority.INTERACTIVE, 1), time.monotonic()))
+
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            time.sleep(0.2)
+            assert not admitted
+            released_at = time.monotonic()
+            slot.release()
+            waiter.join(timeout=5)
+
+            next_slot, admitted_at = admitted[0]
+            assert next_slot is not None
+            assert admitted_at - released_at < 1
+            next_slot.release()
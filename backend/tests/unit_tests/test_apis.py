@@ -1,9 +1,19 @@
+import io
 import os
+import json
 import pytest
-from unittest.mock import patch
+import requests
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import event
+
+from utils.admission import AdmissionQueue
+from utils.db import db
+from utils.rate_limits import TokenQuotaManager
 
 from tables.metrics import Metric
-from tables.api_key import APIKey
+from tables.api_key import APIKey, APIKeyPriority
+from tables.batch import Batch
 from tables.llm_model import LLMModel
 from tables.replicas import Replica, ReplicaVMStatus
 
@@ -485,6 +495,418 @@ class TestChatCompletionsEndpoint:
             "message": f"Rate limit exceeded: allowed {allowed_rpm} requests per minute.",
         }
 
+    def test_api_rate_limit_headers(self, api_client):
+        """
+        Test case for the API key rate limit headers.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        key = APIKeyFactory(allowed_rpm=2)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {key.api_key}"}
+
+        for remaining in (1, 0):
+            response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+            assert response.status_code == 200
+            assert response.headers["X-RateLimit-Limit"] == "2"
+            assert response.headers["X-RateLimit-Remaining"] == str(remaining)
+            assert 0 < int(response.headers["X-RateLimit-Reset"]) <= 60
+
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 429
+        assert response.headers["X-RateLimit-Remaining"] == "0"
+        assert 0 < int(response.headers["Retry-After"]) <= 60
+
+    def test_token_quotas(self, mock_app, api_client):
+        """
+        Test case for the tokens per minute quota of an API key.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        key = APIKeyFactory(allowed_tpm=100)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "max_tokens": 60,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {key.api_key}"}
+        # The 3 prompt tokens and 60 completion tokens debited for the mock responses are refunded
+        for _ in range(2):
+            response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+            assert response.status_code == 200
+
+        with mock_app.app_context():
+            TokenQuotaManager().debit(key, 63)
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 429
+        assert response.json["error"] == "token_quota_exceeded"
+        assert response.json["period"] == "minute"
+        assert int(response.headers["Retry-After"]) > 0
+
+    def test_request_exceeding_token_quota(self, api_client):
+        """
+        Test case for a request estimated above the token quotas of its API key being rejected without being retryable.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        key = APIKeyFactory(allowed_tpm=1000, daily_token_budget=100)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "max_tokens": 200,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {key.api_key}"}
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 400
+        assert response.json["error"] == "request_exceeds_token_quota"
+        assert response.json["period"] == "day"
+        assert response.json["tokens"] == 203
+        assert "Retry-After" not in response.headers
+
+        # Nothing was debited from the quotas
+        payload["max_tokens"] = 60
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 200
+
+    def test_small_token_quota_without_max_tokens(self, mock_app, api_client):
+        """
+        Test case for a request without `max_tokens` to a key whose token quota is below the default `max_tokens`:
+        its estimate is capped at the tokens left instead of being rejected.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        key = APIKeyFactory(allowed_tpm=100)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {key.api_key}"}
+        with patch.dict(mock_app.config, {"TOKEN_QUOTA_DEFAULT_MAX_TOKENS": 1024}):
+            with mock_app.app_context():
+                debit = TokenQuotaManager().debit(key, 1027, 1024)
+                assert debit.tokens == 100
+                TokenQuotaManager().settle(debit, 0)
+
+            response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+            assert response.status_code == 200
+
+            with mock_app.app_context():
+                TokenQuotaManager().debit(key, 98)
+            # The 3 prompt tokens don't fit in the 2 tokens left
+            response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+            assert response.status_code == 429
+
+    def test_token_quotas_reconciled_with_usage(self, mock_app, api_client):
+        """
+        Test case for the tokens debited at admission being reconciled with the usage of the response.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        key = APIKeyFactory(allowed_tpm=100, daily_token_budget=1000)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "max_tokens": 90,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {key.api_key}"}
+
+        upstream = patch("utils.request_handlers.get_upstream_session").start()
+        upstream.return_value.post.return_value.status_code = 200
+        upstream.return_value.post.return_value.json.return_value = {
+            "choices": [{"index": 0, "message": {"content": "Hi"}}],
+            "usage": {"prompt_tokens": 3, "total_tokens": 5, "completion_tokens": 2},
+        }
+        try:
+            with patch.dict(mock_app.config, {"MOCK_LLM": False}):
+                # Without the reconciliation, the 93 tokens debited for the first request would exceed the quota
+                for _ in range(2):
+                    response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+                    assert response.status_code == 200
+        finally:
+            patch.stopall()
+
+    def test_replica_rate_limits(self, api_client):
+        """
+        Test case for replica rate limits.
+
+        1) create two replicas each allowing 1 request per minute.
+        2) the first two requests are spread across both replicas.
+        3) the third request is rejected as every replica is saturated.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory.create_batch(
+            2, llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=1
+        )
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        for _ in range(2):
+            response = api_client.post(
+                "/api/v1/chat/completions",
+                json=payload,
+                headers={"Authorization": f"Bearer {self.auth.api_key}"},
+            )
+            assert response.status_code == 200
+
+        response = api_client.post(
+            "/api/v1/chat/completions",
+            json=payload,
+            headers={"Authorization": f"Bearer {self.auth.api_key}"},
+        )
+        assert response.status_code == 429
+        assert response.json["error"] == "replica_rate_limit_exceeded"
+        assert int(response.headers["Retry-After"]) >= 1
+
+    def test_admission_queue_timeout(self, mock_app, api_client):
+        """
+        Test case for the admission queue of a model.
+
+        1) create a replica allowing 1 in-flight request, and take its slot.
+        2) a request is rejected once it timed out in the admission queue.
+        3) a request is admitted once the slot is released.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+            "priority": "batch",
+        }
+        config = {"ADMISSION_MAX_IN_FLIGHT_PER_REPLICA": 1, "ADMISSION_QUEUE_TIMEOUT": 0.1}
+        with patch.dict(mock_app.config, config):
+            slot = AdmissionQueue(model.id).wait(0, APIKeyPriority.INTERACTIVE, 1)
+            response = api_client.post(
+                "/api/v1/chat/completions",
+                json=payload,
+                headers={"Authorization": f"Bearer {self.auth.api_key}"},
+            )
+            assert response.status_code == 503
+            assert response.json["error"] == "Timed out in the admission queue."
+
+            slot.release()
+            response = api_client.post(
+                "/api/v1/chat/completions",
+                json=payload,
+                headers={"Authorization": f"Bearer {self.auth.api_key}"},
+            )
+            assert response.status_code == 200
+
+    def test_replica_update_invalidates_cache(self, api_client):
+        """
+        Test case for replica lookups being refreshed after a replica update.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        replica = ReplicaFactory(
+            llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=1
+        )
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {self.auth.api_key}"}
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 200
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 429
+
+        response = api_client.put(
+            f"/api/v1/models/replicas/{replica.id}",
+            json={"rate_limit": 10},
+            headers={"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'},
+        )
+        assert response.status_code == 204
+
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 200
+
+    def test_cached_lookups(self, api_client):
+        """
+        Test case for the chat completions hot path not querying the database once the lookups are cached.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {self.auth.api_key}"}
+        response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        assert response.status_code == 200
+
+        statements = []
+
+        def count_statements(*args, **kwargs):
+            statements.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count_statements)
+        try:
+            response = api_client.post("/api/v1/chat/completions", json=payload, headers=headers)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statements)
+        assert response.status_code == 200
+        assert statements == []
+
+    def test_streaming_releases_db_connection(self, mock_app, api_client):
+        """
+        Test case for no database connection being held while a response is streamed.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": True,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        checked_out = []
+
+        def iter_content(chunk_size=None):
+            checked_out.append(db.engine.pool.checkedout())
+            yield b'data: {"choices": [{"index": 0, "delta": {"content": "Hi"}}]}\n\n'
+            yield b'data: {"choices": [], "usage": {"prompt_tokens": 2, "total_tokens": 3, "completion_tokens": 1}}\n\n'
+
+        upstream = patch("utils.request_handlers.get_upstream_session").start()
+        upstream.return_value.post.return_value.status_code = 200
+        upstream.return_value.post.return_value.iter_content = iter_content
+        try:
+            with patch.dict(mock_app.config, {"MOCK_LLM": False}):
+                response = api_client.post(
+                    "/api/v1/chat/completions",
+                    json=payload,
+                    headers={"Authorization": f"Bearer {self.auth.api_key}"},
+                )
+                assert response.status_code == 200
+                # The usage chunk is relayed to raw clients
+                assert response.get_data() == (
+                    b'data: {"choices": [{"index": 0, "delta": {"content": "Hi"}}]}\n\n'
+                    b'data: {"choices": [], "usage": {"prompt_tokens": 2, "total_tokens": 3, "completion_tokens": 1}}'
+                    b'\n\n'
+                )
+        finally:
+            patch.stopall()
+
+        assert checked_out == [0]
+        metric = db.session.query(Metric).filter_by(api_key_id=self.auth.id).one()
+        assert metric.total_tokens == 3
+        assert metric.chunk_count == 1
+        assert metric.time_to_first_token is not None
+        assert metric.upstream_connect_time is not None
+        # A completion of a single token has no inter-token latency
+        assert metric.time_per_output_token is None
+        # The deltas of the stream are stored as the final message
+        assert json.loads(metric.choices) == [{"index": 0, "message": {"content": "Hi"}, "finish_reason": None}]
+        assert json.loads(metric.input)["messages"] == payload["messages"]
+
+    def test_retry_failover_before_first_byte(self, mock_app, api_client):
+        """
+        Test case for requests failing before the first byte being retried on another replica.
+
+        1) the first replica refuses the connection, the request fails over to the second one.
+        2) the second replica responds with a 503 and is the last one left, the request is retried on it.
+        3) the retries are recorded in the metrics.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory.create_batch(2, llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+
+        unavailable = MagicMock(status_code=503)
+        ok = MagicMock(status_code=200)
+        ok.json.return_value = {
+            "choices": [{"index": 0, "message": {"content": "Hi"}}],
+            "usage": {"prompt_tokens": 3, "total_tokens": 5, "completion_tokens": 2},
+        }
+        upstream = patch("utils.request_handlers.get_upstream_session").start()
+        upstream.return_value.post.side_effect = [requests.exceptions.ConnectionError(), unavailable, ok]
+        try:
+            with patch.dict(
+                mock_app.config, {"MOCK_LLM": False, "UPSTREAM_RETRIES": 2, "UPSTREAM_RETRY_BACKOFF_MS": 0}
+            ):
+                response = api_client.post(
+                    "/api/v1/chat/completions",
+                    json=payload,
+                    headers={"Authorization": f"Bearer {self.auth.api_key}"},
+                )
+        finally:
+            patch.stopall()
+
+        assert response.status_code == 200
+        endpoints = [call.args[0] for call in upstream.return_value.post.call_args_list]
+        assert endpoints[0] != endpoints[1] == endpoints[2]
+        metric = db.session.query(Metric).filter_by(api_key_id=self.auth.id).one()
+        assert metric.retries == 2
+
+    @pytest.mark.parametrize(
+        "stream, body",
+        [
+            (False, b'{"choices": [{"index": 0, "message": {"content": "Hi"}}], "usage": {"total_tokens": 5}}'),
+            (True, b'data: {"choices": [{"index": 0, "delta": {"content": "Hi"}}]}\n\n'
+                   b'data: {"choices": [], "usage": {"total_tokens": 5}}\n\ndata: [DONE]\n\n'),
+        ],
+    )
+    def test_response_cache(self, mock_app, api_client, stream, body):
+        """
+        Test case for the response cache.
+
+        1) a deterministic request is sent to the replica and its response cached.
+        2) the same request is served from the cache, the hit is recorded in the metrics.
+        3) a request with another temperature isn't served from the cache.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": stream,
+            "temperature": 0,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        headers = {"Authorization": f"Bearer {self.auth.api_key}"}
+
+        upstream = patch("utils.request_handlers.get_upstream_session").start()
+        upstream_response = upstream.return_value.post.return_value
+        upstream_response.status_code = 200
+        upstream_response.content = body
+        upstream_response.json.side_effect = lambda: json.loads(body)
+        upstream_response.iter_content.side_effect = lambda chunk_size=None: iter([body[:20], body[20:]])
+        try:
+            with patch.dict(mock_app.config, {"MOCK_LLM": False, "RESPONSE_CACHE_TTL": 60}):
+                responses = []
+                for _ in range(2):
+                    responses.append(api_client.post("/api/v1/chat/completions", json=payload, headers=headers))
+                    # Consume the stream, the response is cached once complete
+                    responses[-1].get_data()
+                assert upstream.return_value.post.call_count == 1
+
+                api_client.post(
+                    "/api/v1/chat/completions", json={**payload, "temperature": 0.5}, headers=headers
+                ).get_data()
+                assert upstream.return_value.post.call_count == 2
+        finally:
+            patch.stopall()
+
+        assert [response.status_code for response in responses] == [200, 200]
+        if stream:
+            assert responses[0].get_data() == responses[1].get_data()
+        else:
+            assert responses[0].json == responses[1].json
+        metrics = db.session.query(Metric).filter_by(api_key_id=self.auth.id).order_by(Metric.id).all()
+        assert [(metric.cache_hit, metric.total_tokens) for metric in metrics] == [(False, 5), (True, 5), (False, 5)]
+
     def test_non_streaming_response(self, api_client):
         """
         Test case for successful non-streamed chat completions.
@@ -530,6 +952,93 @@ class TestChatCompletionsEndpoint:
         assert response.mimetype == "text/event-stream"
 
 
+class TestBatchesEndpoints:
+    """
+    Tests for the /api/v1/files and /api/v1/batches endpoints.
+    """
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.auth = APIKeyFactory(enabled=True)
+        self.headers = {"Authorization": f"Bearer {self.auth.api_key}"}
+
+    def upload_file(self, api_client, content, purpose="batch"):
+        return api_client.post(
+            "/api/v1/files",
+            data={"purpose": purpose, "file": (io.BytesIO(content), "requests.jsonl")},
+            headers=self.headers,
+        )
+
+    def test_upload_file(self, api_client):
+        """
+        Test file upload, retrieval and download, only by the API key that uploaded it.
+        """
+        content = b'{"custom_id": "1", "method": "POST", "url": "/v1/chat/completions", "body": {}}\n'
+        response = self.upload_file(api_client, content)
+        assert response.status_code == 200
+        file_id = response.json["id"]
+        assert response.json["bytes"] == len(content)
+        assert response.json["purpose"] == "batch"
+
+        response = api_client.get(f"/api/v1/files/{file_id}", headers=self.headers)
+        assert response.status_code == 200
+        assert response.json["filename"] == "requests.jsonl"
+        response = api_client.get(f"/api/v1/files/{file_id}/content", headers=self.headers)
+        assert response.status_code == 200
+        assert response.data == content
+
+        other = APIKeyFactory(enabled=True)
+        response = api_client.get(
+            f"/api/v1/files/{file_id}", headers={"Authorization": f"Bearer {other.api_key}"}
+        )
+        assert response.status_code == 404
+
+        response = self.upload_file(api_client, content, purpose="batch_output")
+        assert response.status_code == 400
+
+    @patch("blueprints.v1.apis.run_batch")
+    def test_create_and_cancel_batch(self, run_batch, api_client):
+        """
+        Test that a batch is queued for the worker, can be listed and retrieved, and cancelled while active.
+        """
+        file_id = self.upload_file(api_client, b"{}\n").json["id"]
+        payload = {
+            "input_file_id": file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+            "metadata": {"job": "nightly"},
+        }
+        response = api_client.post("/api/v1/batches", json=payload, headers=self.headers)
+        assert response.status_code == 200
+        batch = response.json
+        assert batch["status"] == "validating"
+        assert batch["input_file_id"] == file_id
+        assert batch["request_counts"] == {"total": 0, "completed": 0, "failed": 0}
+        assert batch["metadata"] == {"job": "nightly"}
+        assert batch["expires_at"] == batch["created_at"] + 86400
+        run_batch.delay.assert_called_once_with(Batch.parse_id(batch["id"]))
+
+        response = api_client.post(
+            "/api/v1/batches", json={**payload, "input_file_id": "file-0"}, headers=self.headers
+        )
+        assert response.status_code == 404
+
+        response = api_client.get("/api/v1/batches?limit=1", headers=self.headers)
+        assert response.status_code == 200
+        assert [item["id"] for item in response.json["data"]] == [batch["id"]]
+        assert not response.json["has_more"]
+
+        response = api_client.post(f"/api/v1/batches/{batch['id']}/cancel", headers=self.headers)
+        assert response.status_code == 200
+        assert response.json["status"] == "cancelling"
+        response = api_client.post(f"/api/v1/batches/{batch['id']}/cancel", headers=self.headers)
+        assert response.status_code == 409
+
+        response = api_client.get(f"/api/v1/batches/{batch['id']}", headers=self.headers)
+        assert response.status_code == 200
+        assert response.json["cancelling_at"] is not None
+
+
 class TestTableMetadataEndpoint:
     """
     Tests for the /api/v1/tables/* endpoints.
@@ -548,9 +1057,13 @@ class TestTableMetadataEndpoint:
         assert response.json["tables"] == [
             "api_key",
             "metric",
+            "metric_rollup",
+            "metric_rollup_watermark",
             "llm_models",
             "replicas",
             "replica_security_rules",
+            "file",
+            "batch",
         ]
 
     @pytest.mark.parametrize(
@@ -559,7 +1072,16 @@ class TestTableMetadataEndpoint:
             (
                 APIKeyFactory,
                 "api_key",
-                ["id", "user_id", "api_key", "allowed_rpm", "enabled"],
+                [
+                    "id",
+                    "user_id",
+                    "api_key",
+                    "allowed_rpm",
+                    "allowed_tpm",
+                    "daily_token_budget",
+                    "priority",
+                    "enabled",
+                ],
             ),
             (
                 MetricFactory,
@@ -575,6 +1097,15 @@ class TestTableMetadataEndpoint:
                     "total_tokens",
                     "completion_tokens",
                     "duration",
+                    "retries",
+                    "cache_hit",
+                    "upstream_connect_time",
+                    "time_to_first_token",
+                    "time_per_output_token",
+                    "proxy_overhead",
+                    "chunk_count",
+                    "input_hash",
+                    "payload",
                 ],
             ),
         ],
@@ -597,6 +1128,105 @@ class TestTableMetadataEndpoint:
         assert len(response.json["data"]) == len(expected_data)
         assert response.json["data"] == sorted(expected_data, key=lambda x: -x["id"])
 
+    def test_get_table_data_pagination(self, api_client, db_session):
+        """
+        Test that the rows are paged through by descending ID with a cursor.
+        """
+        metrics = MetricFactory.create_batch(5)
+        db_session.commit()
+        ids = sorted((metric.id for metric in metrics), reverse=True)
+        headers = {"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'}
+
+        pages = []
+        query_string = {"limit": 2, "fields": "id"}
+        while True:
+            response = api_client.get("/api/v1/tables/metric", query_string=query_string, headers=headers)
+            assert response.status_code == 200
+            pages.append([row["id"] for row in response.json["data"]])
+            if not response.json["has_more"]:
+                break
+            query_string["after_id"] = response.json["next_after_id"]
+
+        assert pages == [ids[:2], ids[2:4], ids[4:]]
+
+    def test_get_table_data_filters(self, api_client, db_session):
+        """
+        Test the equality and range filters, and the projection of the columns.
+        """
+        api_key = APIKeyFactory()
+        MetricFactory(api_key=api_key, model="a", created=100, cache_hit=True)
+        expected = MetricFactory(api_key=api_key, model="a", created=200, cache_hit=False)
+        MetricFactory(api_key=api_key, model="b", created=200, cache_hit=False)
+        MetricFactory(api_key=api_key, model="a", created=300, cache_hit=False)
+        db_session.commit()
+
+        response = api_client.get(
+            "/api/v1/tables/metric?model=a&cache_hit=false&created__gte=150&created__lt=300&fields=model,created",
+            headers={"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'},
+        )
+        assert response.status_code == 200
+        assert response.json["data"] == [{"id": expected.id, "model": "a", "created": 200}]
+        assert response.json["has_more"] is False
+
+    @pytest.mark.parametrize(
+        "query, field",
+        [
+            ("fields=id,secret", "fields"),
+            ("limit=0", "limit"),
+            ("after_id=last", "after_id"),
+            ("unknown=1", "unknown"),
+            ("created__between=1", "created__between"),
+            ("created__gte=yesterday", "created__gte"),
+            ("payload=abc", "payload"),
+        ],
+    )
+    def test_get_table_data_errors(self, api_client, query, field):
+        """
+        Test that invalid pagination, projection and filter parameters are rejected.
+        """
+        response = api_client.get(
+            f"/api/v1/tables/metric?{query}",
+            headers={"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'},
+        )
+        assert response.status_code == 400
+        assert field in response.json["errors"]
+
+
+class TestStatsEndpoint:
+    """
+    Tests for the /api/v1/stats endpoint.
+    """
+
+    def test_get_stats(self, api_client):
+        """
+        Test stats retrieval.
+        """
+        response = api_client.get(
+            "/api/v1/stats",
+            headers={"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'},
+        )
+        assert response.status_code == 200
+        assert "metrics_writer" in response.json
+        assert "upstream_pools" in response.json
+
+    def test_get_prometheus_metrics(self, api_client):
+        """
+        Test the Prometheus metrics exposition, which requires the admin API key.
+        """
+        response = api_client.get("/api/v1/metrics")
+        assert response.status_code == 401
+
+        response = api_client.get(
+            "/api/v1/metrics",
+            headers={"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        body = response.get_data(as_text=True)
+        assert "# TYPE llm_proxy_request_duration_seconds histogram" in body
+        # The database queries of the fixtures are timed
+        assert "llm_proxy_db_query_duration_seconds_count" in body
+
 
 class TestLLMModelAPIs:
 
@@ -0,0 +1,107 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+
+from utils.async_request_handlers import handle_async_streaming_request
+
+PAYLOAD = {"model": "test-model", "stream": True, "messages": [{"role": "user", "content": "test message"}]}
+CHUNK = b'data: {"choices": [{"index": 0, "delta": {"content": "Hi"}}]}\n\n'
+
+
+class TestAsyncStreamingRequest:
+    """
+    Tests for the streamed chat completions of the ASGI proxy.
+    """
+
+    def stream(self, mock_app, response, send, receive, in_flight=None, token_debit=None):
+        """
+        Stream the `response` of a replica to the client, returns the mocks of the token refunds and the metrics.
+        """
+        patch(
+            "utils.async_request_handlers.send_async_upstream_request", AsyncMock(return_value=(response, 0))
+        ).start()
+        refund_tokens = patch("utils.async_request_handlers.refund_tokens").start()
+        record_async_metrics = patch("utils.async_request_handlers.record_async_metrics").start()
+        try:
+            asyncio.run(
+                asyncio.wait_for(
+                    handle_async_streaming_request(
+                        flask_app=mock_app,
+                        send=send,
+                        receive=receive,
+                        api_key_id=1,
+                        in_flight=in_flight or MagicMock(),
+                        start_time=0,
+                        chat_completion_payload=PAYLOAD,
+                        raw=True,
+                        token_debit=token_debit,
+                    ),
+                    timeout=5,
+                )
+            )
+        finally:
+            patch.stopall()
+        return refund_tokens, record_async_metrics
+
+    def test_stream_failure_after_start(self, mock_app):
+        """
+        Test that a stream failing once the response has started is ended early, and that the tokens debited for it
+        are refunded without recording its metrics.
+        """
+
+        async def aiter_bytes():
+            yield CHUNK
+            raise httpx.ReadError("connection reset")
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        response = MagicMock(is_error=False, aiter_bytes=aiter_bytes, aclose=AsyncMock())
+        token_debit = MagicMock()
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        refund_tokens, record_async_metrics = self.stream(mock_app, response, send, receive, token_debit=token_debit)
+
+        assert [message["type"] for message in messages] == [
+            "http.response.start",
+            "http.response.body",
+            "http.response.body",
+        ]
+        assert messages[1]["body"] == CHUNK
+        assert messages[2] == {"type": "http.response.body", "body": b""}
+        refund_tokens.assert_called_once_with(mock_app, token_debit)
+        record_async_metrics.assert_not_called()
+        response.aclose.assert_awaited_once()
+
+    def test_client_disconnect(self, mock_app):
+        """
+        Test that a client disconnecting in the middle of a stream cancels the request to the replica and releases
+        the request, without recording its metrics.
+        """
+        chunk_sent = asyncio.Event()
+
+        async def aiter_bytes():
+            yield CHUNK
+            # The replica keeps generating until the request is cancelled
+            await asyncio.Event().wait()
+
+        async def receive():
+            await chunk_sent.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message.get("body"):
+                chunk_sent.set()
+
+        response = MagicMock(is_error=False, aiter_bytes=aiter_bytes, aclose=AsyncMock())
+        in_flight = MagicMock()
+        refund_tokens, record_async_metrics = self.stream(mock_app, response, send, receive, in_flight=in_flight)
+
+        response.aclose.assert_awaited_once()
+        in_flight.release.assert_called_once()
+        record_async_metrics.assert_not_called()
+        refund_tokens.assert_not_called()
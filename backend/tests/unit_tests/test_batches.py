@@ -0,0 +1,166 @@
+import contextlib
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from config import Config
+from tables.batch import Batch, BatchStatus
+from tables.file import File, FilePurpose
+from utils.batches import BatchRequestSender, make_batch_output, parse_batch_input, run_concurrently
+from utils.upstream import RetryPolicy
+from worker.tasks import run_batch
+
+from .factories import APIKeyFactory
+
+
+def make_line(custom_id, **overrides):
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": "model", "messages": [{"role": "user", "content": "test message"}]},
+            **overrides,
+        }
+    )
+
+
+def make_response(status_code, body, headers=None):
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    response.json.return_value = body
+    return response
+
+
+class TestBatches:
+    """
+    Tests for the validation and execution of the requests of a batch.
+    """
+
+    def test_parse_batch_input(self):
+        """
+        Test that every invalid line of an input file is reported with its line number.
+        """
+        content = "\n".join([make_line("1"), make_line("2"), "", "not json", make_line("1"), make_line("3", url="/v1")])
+        batch_requests, errors = parse_batch_input(content, "/v1/chat/completions", max_requests=10)
+        assert [batch_request["custom_id"] for batch_request in batch_requests] == ["1", "2"]
+        assert [(error["code"], error["line"]) for error in errors] == [
+            ("invalid_json_line", 4),
+            ("duplicate_custom_id", 5),
+            ("mismatched_endpoint", 6),
+        ]
+
+        _, errors = parse_batch_input(make_line("1") + "\n" + make_line("2"), "/v1/chat/completions", max_requests=1)
+        assert [error["code"] for error in errors] == ["too_many_requests"]
+        _, errors = parse_batch_input("\n", "/v1/chat/completions", max_requests=1)
+        assert [error["code"] for error in errors] == ["empty_file"]
+
+    def test_send_batch_request(self):
+        """
+        Test that a request is sent at the batch priority, and retried while rate limited.
+        """
+        session = MagicMock()
+        session.post.side_effect = [
+            make_response(429, {"error": "rate_limit_exceeded"}, {"Retry-After": "0"}),
+            make_response(200, {"id": "chatcmpl"}),
+            make_response(400, {"errors": {"messages": ["Shorter than minimum length 1."]}}),
+        ]
+        sender = BatchRequestSender(
+            "http://backend/api/v1/",
+            "key",
+            RetryPolicy(retries=1, backoff=0, max_backoff=0),
+            timeout=1,
+            session=session,
+        )
+
+        output, succeeded = sender.send(json.loads(make_line("1", body={"model": "model", "stream": True})))
+        assert succeeded
+        assert output["custom_id"] == "1"
+        assert output["response"]["status_code"] == 200
+        assert output["response"]["body"] == {"id": "chatcmpl"}
+        url = session.post.call_args.args[0]
+        kwargs = session.post.call_args.kwargs
+        assert url == "http://backend/api/v1/chat/completions"
+        assert kwargs["json"] == {"model": "model", "stream": False, "priority": "batch"}
+        assert kwargs["headers"] == {"Authorization": "Bearer key"}
+
+        output, succeeded = sender.send(json.loads(make_line("2")))
+        assert not succeeded
+        assert output["response"]["status_code"] == 400
+        assert session.post.call_count == 3
+
+    def test_run_concurrently(self):
+        """
+        Test that at most `concurrency` items run at once, and that no item is started once stopped.
+        """
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def func(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        results = dict(run_concurrently(func, range(10), concurrency=3))
+        assert results == {index: index * 2 for index in range(10)}
+        assert max(peak) <= 3
+
+        results = []
+        for index, result in run_concurrently(func, range(10), concurrency=2, should_stop=lambda: len(results) >= 2):
+            results.append(result)
+        assert len(results) < 10
+
+    def test_run_expired_batch(self, db_session):
+        """
+        Test that the requests of a batch that expired before they were sent get a `batch_expired` error line, so that
+        its files and request counts account for every request.
+        """
+        api_key = APIKeyFactory()
+        content = "\n".join(make_line(str(index)) for index in range(5))
+        input_file = File.create(db_session, api_key.id, "input.jsonl", FilePurpose.BATCH, content)
+        batch = Batch(
+            api_key_id=api_key.id,
+            endpoint="/v1/chat/completions",
+            input_file_id=input_file.id,
+            completion_window="24h",
+            created_at=int(time.time()),
+            expires_at=int(time.time()),
+        )
+        db_session.add(batch)
+        db_session.commit()
+
+        @contextlib.contextmanager
+        def worker_session():
+            yield db_session
+            db_session.commit()
+
+        sender = MagicMock()
+        sender.return_value.send.side_effect = lambda batch_request: (
+            make_batch_output(batch_request["custom_id"], response={"status_code": 200, "body": {}}),
+            True,
+        )
+        patch("worker.tasks.db_session", worker_session).start()
+        patch("worker.tasks.BatchRequestSender", sender).start()
+        patch.object(Config, "BATCH_CONCURRENCY", 1).start()
+        patch.object(Config, "BATCH_PROGRESS_INTERVAL", 0).start()
+        # The error lines are appended in chunks
+        patch("worker.tasks.OUTPUT_CHUNK_SIZE", 2).start()
+        try:
+            run_batch(batch.id)
+        finally:
+            patch.stopall()
+
+        db_session.refresh(batch)
+        assert batch.status == BatchStatus.EXPIRED
+        assert (batch.request_total, batch.request_completed, batch.request_failed) == (5, 1, 4)
+        output_lines = [json.loads(line) for line in db_session.get(File, batch.output_file_id).content.splitlines()]
+        assert [line["custom_id"] for line in output_lines] == ["0"]
+        error_file = db_session.get(File, batch.error_file_id)
+        error_lines = [json.loads(line) for line in error_file.content.splitlines()]
+        assert [line["custom_id"] for line in error_lines] == ["1", "2", "3", "4"]
+        assert {line["error"]["code"] for line in error_lines} == {"batch_expired"}
+        assert error_file.bytes == len(error_file.content.encode("utf-8"))
@@ -0,0 +1,94 @@
+import pytest
+
+from tables.replicas import ReplicaVMStatus
+from utils.circuit_breaker import CircuitState, ReplicaCircuitBreaker
+
+from .factories import APIKeyFactory, LLMModelFactory, ReplicaFactory
+from .utils import AIModel
+
+
+class TestReplicaCircuitBreaker:
+    """
+    Tests for the replica circuit breaker.
+    """
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mock_app):
+        self.model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        self.replicas = ReplicaFactory.create_batch(
+            2, llm_model=self.model, vm_status=ReplicaVMStatus.SUCCESS, rate_limit=None
+        )
+        self.config = {
+            **mock_app.config,
+            "CIRCUIT_BREAKER_MIN_REQUESTS": 4,
+            "CIRCUIT_BREAKER_ERROR_RATE": 0.5,
+            "CIRCUIT_BREAKER_PROBE_FAILURES": 2,
+        }
+
+    def test_opens_on_error_rate(self):
+        """
+        Test that the circuit opens once the error rate is reached, and that its replica is skipped.
+        """
+        circuit_breaker = ReplicaCircuitBreaker(config=self.config)
+        replica = self.replicas[0]
+        for success in (True, False, True):
+            assert circuit_breaker.record(replica.id, success) == CircuitState.CLOSED
+        assert circuit_breaker.record(replica.id, False) == CircuitState.OPEN
+
+        assert circuit_breaker.available(self.replicas) == [self.replicas[1]]
+
+    def test_half_open_trial(self):
+        """
+        Test that a single trial request is let through once the circuit has been open long enough.
+        """
+        circuit_breaker = ReplicaCircuitBreaker(config={**self.config, "CIRCUIT_BREAKER_OPEN_SECONDS": 0})
+        replica = self.replicas[0]
+        for _ in range(4):
+            circuit_breaker.record(replica.id, False)
+
+        assert circuit_breaker.available([replica]) == [replica]
+        assert circuit_breaker.get_states([replica.id]) == {replica.id: CircuitState.HALF_OPEN}
+        assert circuit_breaker.record(replica.id, False) == CircuitState.OPEN
+
+        assert circuit_breaker.available([replica]) == [replica]
+        assert circuit_breaker.record(replica.id, True) == CircuitState.CLOSED
+
+    def test_health_probes(self):
+        """
+        Test that failed health probes open the circuit and that a successful one closes it.
+        """
+        circuit_breaker = ReplicaCircuitBreaker(config={**self.config, "CIRCUIT_BREAKER_OPEN_SECONDS": 0})
+        replica = self.replicas[0]
+        assert circuit_breaker.record(replica.id, False, probe=True) == CircuitState.CLOSED
+        assert circuit_breaker.record(replica.id, False, probe=True) == CircuitState.OPEN
+        assert circuit_breaker.record(replica.id, True, probe=True) == CircuitState.CLOSED
+
+    def test_slow_calls(self):
+        """
+        Test that slow responses count as errors when a slow call threshold is set.
+        """
+        circuit_breaker = ReplicaCircuitBreaker(
+            config={**self.config, "CIRCUIT_BREAKER_MIN_REQUESTS": 1, "CIRCUIT_BREAKER_SLOW_CALL_SECONDS": 5}
+        )
+        assert circuit_breaker.record(self.replicas[0].id, True, duration=1) == CircuitState.CLOSED
+        assert circuit_breaker.record(self.replicas[0].id, True, duration=10) == CircuitState.OPEN
+
+    def test_chat_completions_fail_fast(self, api_client):
+        """
+        Test that chat completions fail fast when the circuit of every replica is open.
+        """
+        circuit_breaker = ReplicaCircuitBreaker(config={**self.config, "CIRCUIT_BREAKER_MIN_REQUESTS": 1})
+        for replica in self.replicas:
+            circuit_breaker.record(replica.id, False)
+
+        response = api_client.post(
+            "/api/v1/chat/completions",
+            json={
+                "model": AIModel.PERPLEXITY,
+                "stream": False,
+                "messages": [{"role": "user", "content": "test message"}],
+            },
+            headers={"Authorization": f"Bearer {APIKeyFactory().api_key}"},
+        )
+        assert response.status_code == 503
+        assert response.json == {"error": "No healthy replica available."}
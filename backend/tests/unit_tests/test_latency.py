@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+from utils.latency import LATENCY_METRICS, StreamTimer
+
+
+class TestStreamTimer:
+    """
+    Tests for the latency breakdown of the streamed chat completions.
+    """
+
+    def test_get_metrics(self):
+        """
+        Test the latency metrics of a stream of 3 chunks and 5 completion tokens.
+        """
+        timer = StreamTimer(100.0)
+        with patch("utils.latency.time.time") as mock_time:
+            for now, step in [
+                (100.5, timer.request_sent),
+                (100.75, timer.headers_received),
+                (101.5, lambda: timer.observe(1)),
+                (101.5, lambda: timer.observe(1)),
+                (102.0, lambda: timer.observe(2)),
+                (103.5, lambda: timer.observe(3)),
+            ]:
+                mock_time.return_value = now
+                step()
+
+            mock_time.return_value = 104.0
+            metrics = timer.get_metrics({"completion_tokens": 5})
+
+        assert metrics == {
+            "upstream_connect_time": 0.25,
+            "time_to_first_token": 1.5,
+            "time_per_output_token": 0.5,
+            "proxy_overhead": 1.0,
+            "chunk_count": 3,
+        }
+
+    def test_get_metrics_without_chunks(self):
+        """
+        Test that only the measurable metrics are returned for a stream without chunks nor usage data.
+        """
+        timer = StreamTimer(100.0)
+        metrics = timer.get_metrics({})
+        assert set(metrics) == set(LATENCY_METRICS)
+        assert metrics["chunk_count"] == 0
+        assert all(metrics[key] is None for key in LATENCY_METRICS if key != "chunk_count")
@@ -0,0 +1,100 @@
+import os
+import time
+
+import pytest
+
+from utils.latency_sketches import (
+    LatencyMetric,
+    LatencySketches,
+    SketchDimension,
+    get_latency_sketches,
+    make_sketch_key,
+    query_latency_sketches,
+)
+from utils.redis import get_redis_client
+
+# Start of the current bucket, in seconds
+NOW = int(time.time()) // 60 * 60
+
+
+class TestLatencySketches:
+    """
+    Tests for the latency sketches of the workers, merged in Redis.
+    """
+
+    def make_sketches(self, mock_app, flush_interval=3600):
+        return LatencySketches(
+            mock_app, relative_accuracy=0.01, bucket_seconds=60, ttl=600, flush_interval=flush_interval
+        )
+
+    def test_merge_workers(self, mock_app):
+        """
+        Test that the sketches of several workers are merged per bucket and over a window, per dimension value.
+        """
+        workers = [self.make_sketches(mock_app), self.make_sketches(mock_app)]
+        for index in range(100):
+            workers[index % 2].record(
+                {LatencyMetric.DURATION: index + 1, LatencyMetric.TIME_TO_FIRST_TOKEN: None},
+                {SketchDimension.MODEL: "a" if index < 90 else "b", SketchDimension.REPLICA: None},
+                # Half of the latencies are in the following bucket
+                at=NOW + 60 * (index % 4 >= 2),
+            )
+        for worker in workers:
+            worker.flush()
+            assert worker.sketches == {}
+
+        with mock_app.app_context():
+            client = get_redis_client()
+            # The sketches expire with the TTL after the end of their bucket
+            assert 0 < client.ttl(make_sketch_key(NOW, SketchDimension.MODEL, "a", LatencyMetric.DURATION)) <= 660
+            sketches = query_latency_sketches(client, SketchDimension.MODEL, NOW, NOW + 120, 60, 0.01)
+            assert sketches["a"][LatencyMetric.DURATION].count == 90
+            assert sketches["a"][LatencyMetric.DURATION].quantile(0.5) == pytest.approx(45, rel=0.01)
+            assert sketches["b"][LatencyMetric.DURATION].quantile(0) == pytest.approx(91, rel=0.01)
+            assert LatencyMetric.TIME_TO_FIRST_TOKEN not in sketches["a"]
+
+            # Only the buckets of the window are merged, and only the requested value
+            sketches = query_latency_sketches(client, SketchDimension.MODEL, NOW, NOW + 60, 60, 0.01, value="b")
+            assert list(sketches) == ["b"]
+            assert sketches["b"][LatencyMetric.DURATION].count == 4
+            assert query_latency_sketches(client, SketchDimension.REPLICA, NOW, NOW + 120, 60, 0.01) == {}
+            # A window ending within the first second of a bucket includes it
+            sketches = query_latency_sketches(client, SketchDimension.MODEL, NOW - 60, NOW + 0.5, 60, 0.01)
+            assert LatencyMetric.DURATION in sketches["b"]
+
+    def test_flush_interval(self, mock_app):
+        """
+        Test that the latencies are flushed when recorded once the flush interval has passed.
+        """
+        sketches = self.make_sketches(mock_app, flush_interval=0)
+        sketches.record({LatencyMetric.DURATION: 1.0}, {SketchDimension.API_KEY: 1}, at=NOW)
+        assert sketches.sketches == {}
+        with mock_app.app_context():
+            key = make_sketch_key(NOW, SketchDimension.API_KEY, "1", LatencyMetric.DURATION)
+            assert get_redis_client().hgetall(key)
+
+    def test_get_latency(self, api_client, mock_app):
+        """
+        Test the latency endpoint, which requires the admin API key and validates its query parameters.
+        """
+        headers = {"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'}
+        with mock_app.app_context():
+            sketches = get_latency_sketches()
+        for duration in (1.0, 2.0, 3.0):
+            sketches.record(
+                {LatencyMetric.DURATION: duration, LatencyMetric.OUTPUT_TOKENS_PER_SECOND: 10 / duration},
+                {SketchDimension.MODEL: "latency-model"},
+            )
+
+        assert api_client.get("/api/v1/latency").status_code == 401
+
+        response = api_client.get("/api/v1/latency?dimension=model&value=latency-model&window=60", headers=headers)
+        assert response.status_code == 200
+        [data] = response.json["data"]
+        assert data["value"] == "latency-model"
+        assert data["duration"]["count"] == 3
+        assert data["duration"]["p50"] == pytest.approx(2.0, rel=0.01)
+        assert data["time_to_first_token"] == {"count": 0, "p50": None, "p95": None, "p99": None}
+
+        for query in ("dimension=user", "window=0", "window=999999999"):
+            assert api_client.get(f"/api/v1/latency?{query}", headers=headers).status_code == 400
@@ -0,0 +1,109 @@
+import io
+import os
+import csv
+import json
+
+import pytest
+
+from utils.metric_exports import DEFAULT_EXPORT_COLUMNS
+
+from .factories import APIKeyFactory, MetricFactory
+
+HEADERS = {"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'}
+
+
+class TestMetricExports:
+    """
+    Tests for the streaming exports of the metric table.
+    """
+
+    def create_metrics(self, db_session):
+        api_key = APIKeyFactory()
+        metrics = [
+            MetricFactory(api_key=api_key, model="a", created=100 + index, payload=b"\x00\x01")
+            for index in range(5)
+        ]
+        MetricFactory(api_key=api_key, model="b", created=100)
+        MetricFactory(api_key=api_key, model="a", created=200)
+        db_session.commit()
+        return metrics
+
+    def test_export_ndjson(self, api_client, db_session, mock_app):
+        """
+        Test that the metrics matching the filters are streamed by ascending ID, in batches, without their payloads.
+        """
+        metrics = self.create_metrics(db_session)
+        mock_app.config["METRICS_EXPORT_BATCH_SIZE"] = 2
+        try:
+            response = api_client.get(
+                "/api/v1/metrics/export?model=a&created__lt=200", headers=HEADERS, buffered=False
+            )
+            assert response.status_code == 200
+            assert response.mimetype == "application/x-ndjson"
+            assert response.headers["Content-Disposition"] == 'attachment; filename="metrics.ndjson"'
+            assert not response.is_sequence
+            chunks = list(response.response)
+        finally:
+            mock_app.config["METRICS_EXPORT_BATCH_SIZE"] = 10000
+
+        # A chunk per batch
+        assert len(chunks) == 3
+        rows = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        assert [row["id"] for row in rows] == [metric.id for metric in metrics]
+        assert list(rows[0]) == list(DEFAULT_EXPORT_COLUMNS)
+
+    def test_export_csv(self, api_client, db_session):
+        """
+        Test the CSV export of the columns of `fields`, binary values being base64 encoded.
+        """
+        metrics = self.create_metrics(db_session)
+        response = api_client.get(
+            f"/api/v1/metrics/export?format=csv&fields=model,payload&api_key_id={metrics[0].api_key_id}&model=a",
+            headers=HEADERS,
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "text/csv"
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        assert rows[0] == ["id", "model", "payload"]
+        assert rows[1] == [str(metrics[0].id), "a", "AAE="]
+        assert len(rows) == 1 + 6
+
+    def test_export_parquet(self, api_client, db_session):
+        """
+        Test the Parquet export, typed after the columns of the metric table.
+        """
+        pq = pytest.importorskip("pyarrow.parquet")
+        metrics = self.create_metrics(db_session)
+        response = api_client.get(
+            "/api/v1/metrics/export?format=parquet&fields=model,duration,cache_hit,payload&model=a&created__lt=200",
+            headers=HEADERS,
+        )
+        assert response.status_code == 200
+        table = pq.read_table(io.BytesIO(response.get_data()))
+        assert table.column_names == ["id", "model", "duration", "cache_hit", "payload"]
+        assert table.column("id").to_pylist() == [metric.id for metric in metrics]
+        assert table.column("payload").to_pylist() == [b"\x00\x01"] * 5
+        assert str(table.schema.field("duration").type) == "double"
+
+        # An export without rows is still a valid file
+        response = api_client.get("/api/v1/metrics/export?format=parquet&model=c", headers=HEADERS)
+        assert pq.read_table(io.BytesIO(response.get_data())).num_rows == 0
+
+    @pytest.mark.parametrize(
+        "query, field",
+        [
+            ("format=xml", "format"),
+            ("fields=secret", "fields"),
+            ("limit=10", "limit"),
+            ("created__gte=yesterday", "created__gte"),
+        ],
+    )
+    def test_export_errors(self, api_client, query, field):
+        """
+        Test that invalid formats, columns and filters are rejected, and that the export requires the admin API key.
+        """
+        assert api_client.get("/api/v1/metrics/export").status_code == 401
+
+        response = api_client.get(f"/api/v1/metrics/export?{query}", headers=HEADERS)
+        assert response.status_code == 400
+        assert field in response.json["errors"]
@@ -0,0 +1,82 @@
+import datetime
+from unittest.mock import MagicMock
+
+from tables.metrics import Metric
+from utils.db import db
+from utils.metric_partitions import (
+    add_metric_partitions,
+    delete_old_metrics,
+    drop_metric_partitions,
+    get_timestamp,
+    make_monthly_partitions,
+)
+
+from .factories import MetricFactory
+
+NOW = get_timestamp(datetime.date(2026, 12, 15))
+PARTITIONS = [
+    ("p202609", get_timestamp(datetime.date(2026, 10, 1))),
+    ("p202610", get_timestamp(datetime.date(2026, 11, 1))),
+    ("p202611", get_timestamp(datetime.date(2026, 12, 1))),
+    ("p202612", get_timestamp(datetime.date(2027, 1, 1))),
+    ("pfuture", None),
+]
+
+
+class TestMetricPartitions:
+    """
+    Tests for the monthly partitions and the retention of the metric table.
+    """
+
+    def test_make_monthly_partitions(self):
+        """
+        Test that every month holds the rows created before the start of the following one, across years.
+        """
+        assert make_monthly_partitions(datetime.date(2026, 12, 1), datetime.date(2027, 1, 1)) == [
+            f"PARTITION p202612 VALUES LESS THAN ({get_timestamp(datetime.date(2027, 1, 1))})",
+            f"PARTITION p202701 VALUES LESS THAN ({get_timestamp(datetime.date(2027, 2, 1))})",
+        ]
+        assert make_monthly_partitions(datetime.date(2027, 1, 1), datetime.date(2026, 12, 1)) == []
+
+    def test_add_metric_partitions(self):
+        """
+        Test that the future partition is split into the months missing until the months ahead.
+        """
+        connection = MagicMock()
+        assert add_metric_partitions(connection, PARTITIONS, NOW, months_ahead=2) == 2
+        statement = str(connection.execute.call_args.args[0])
+        assert statement.startswith("ALTER TABLE metric REORGANIZE PARTITION pfuture INTO (PARTITION p202701 ")
+        assert "PARTITION p202702 " in statement
+        assert statement.endswith("PARTITION pfuture VALUES LESS THAN MAXVALUE)")
+
+        connection = MagicMock()
+        assert add_metric_partitions(connection, PARTITIONS, NOW, months_ahead=0) == 0
+        connection.execute.assert_not_called()
+
+    def test_drop_metric_partitions(self):
+        """
+        Test that only the partitions past the retention are dropped, and never the last monthly one.
+        """
+        connection = MagicMock()
+        before = get_timestamp(datetime.date(2026, 11, 10))
+        assert drop_metric_partitions(connection, PARTITIONS, before) == ["p202609", "p202610"]
+        assert str(connection.execute.call_args.args[0]) == "ALTER TABLE metric DROP PARTITION p202609, p202610"
+
+        connection = MagicMock()
+        assert drop_metric_partitions(connection, PARTITIONS, NOW + 365 * 24 * 60 * 60) == [
+            "p202609", "p202610", "p202611"
+        ]
+
+    def test_delete_old_metrics(self, db_session):
+        """
+        Test that the rows created before the retention are deleted in batches.
+        """
+        old = MetricFactory.create_batch(5, created=NOW - 1000)
+        recent = MetricFactory.create_batch(2, created=NOW)
+        db_session.commit()
+
+        with db.engine.connect() as connection:
+            assert delete_old_metrics(connection, NOW - 10, batch_size=2) == len(old)
+
+        db_session.expire_all()
+        assert sorted(metric.id for metric in db_session.query(Metric)) == sorted(metric.id for metric in recent)
@@ -0,0 +1,113 @@
+import pytest
+
+from utils.metric_payloads import (
+    PayloadMode,
+    assemble_choices,
+    decompress_payload,
+    hash_input,
+    make_payload_columns,
+    should_store_payload,
+    validate_payload_mode,
+)
+
+INPUT_DATA = {"model": "model", "stream": True, "messages": [{"role": "user", "content": "Hello"}]}
+
+STREAMED_CHOICES = [
+    {"index": 0, "delta": {"role": "assistant", "content": ""}},
+    {"index": 0, "delta": {"content": "Hel"}},
+    {"index": 1, "delta": {"role": "assistant", "tool_calls": [
+        {"index": 0, "id": "call_1", "type": "function", "function": {"name": "get_weather", "arguments": ""}},
+    ]}},
+    {"index": 0, "delta": {"content": "lo"}, "finish_reason": "stop"},
+    {"index": 1, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": '{"city": '}}]}},
+    {"index": 1, "delta": {"tool_calls": [{"index": 0, "function": {"arguments": '"Paris"}'}}]}},
+    {"index": 1, "delta": {}, "finish_reason": "tool_calls"},
+]
+
+ASSEMBLED_CHOICES = [
+    {"index": 0, "message": {"role": "assistant", "content": "Hello"}, "finish_reason": "stop"},
+    {
+        "index": 1,
+        "message": {
+            "role": "assistant",
+            "tool_calls": [
+                {
+                    "id": "call_1",
+                    "type": "function",
+                    "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'},
+                },
+            ],
+        },
+        "finish_reason": "tool_calls",
+    },
+]
+
+
+class TestMetricPayloads:
+    """
+    Tests for the payloads of the chat completions stored in the metrics.
+    """
+
+    def test_assemble_choices(self):
+        """
+        Test that the deltas of a stream are merged into a message per choice, and that the choices of a
+        completion that wasn't streamed are kept as is.
+        """
+        assert assemble_choices(STREAMED_CHOICES) == ASSEMBLED_CHOICES
+        assert assemble_choices(ASSEMBLED_CHOICES) == ASSEMBLED_CHOICES
+        assert assemble_choices([]) == []
+
+    def test_hash_input(self):
+        """
+        Test that the hash of a request doesn't depend on the order of its keys.
+        """
+        assert hash_input(INPUT_DATA) == hash_input(dict(reversed(INPUT_DATA.items())))
+        assert hash_input(INPUT_DATA) != hash_input({**INPUT_DATA, "stream": False})
+
+    @pytest.mark.parametrize(
+        "mode, stored",
+        [
+            (PayloadMode.FULL, {"input", "choices", "input_hash"}),
+            (PayloadMode.COMPRESSED, {"payload", "input_hash"}),
+            (PayloadMode.HASH, {"input_hash"}),
+            (PayloadMode.OFF, set()),
+        ],
+    )
+    def test_make_payload_columns(self, mode, stored):
+        columns = make_payload_columns(INPUT_DATA, STREAMED_CHOICES, mode=mode)
+        assert {key for key, value in columns.items() if value is not None} == stored
+        if mode == PayloadMode.COMPRESSED:
+            assert decompress_payload(columns["payload"]) == {"input": INPUT_DATA, "choices": ASSEMBLED_CHOICES}
+
+    def test_make_payload_columns_sampled(self):
+        """
+        Test that the completions left out of the sample only store the hash of their request.
+        """
+        columns = make_payload_columns(INPUT_DATA, None, mode=PayloadMode.FULL)
+        assert columns == {"input": None, "choices": None, "payload": None, "input_hash": hash_input(INPUT_DATA)}
+
+    @pytest.mark.parametrize(
+        "mode, sample_rate, stored",
+        [
+            (PayloadMode.FULL, 1.0, True),
+            (PayloadMode.COMPRESSED, 1.0, True),
+            (PayloadMode.FULL, 0.0, False),
+            (PayloadMode.HASH, 1.0, False),
+            (PayloadMode.OFF, 1.0, False),
+        ],
+    )
+    def test_should_store_payload(self, mode, sample_rate, stored):
+        """
+        Test that the responses are only kept when their choices are stored.
+        """
+        config = {"METRICS_PAYLOAD_MODE": mode, "METRICS_PAYLOAD_SAMPLE_RATE": sample_rate}
+        assert should_store_payload(config) is stored
+
+    def test_validate_payload_mode(self):
+        """
+        Test that an unsupported mode is rejected.
+        """
+        for mode in PayloadMode.CHOICES:
+            validate_payload_mode(mode)
+        with pytest.raises(ValueError):
+            validate_payload_mode("compresed")
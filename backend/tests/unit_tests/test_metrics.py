@@ -0,0 +1,62 @@
+from tables.metrics import Metric
+from utils.metrics_writer import MetricsWriter
+
+from .factories import APIKeyFactory
+from .utils import AIModel
+
+
+def make_metric_data(api_key_id, **kwargs):
+    return {
+        "api_key_id": api_key_id,
+        "input": "{}",
+        "created": 1716838725,
+        "model": AIModel.MISTRALAI,
+        "choices": "[]",
+        "prompt_tokens": 7,
+        "total_tokens": 107,
+        "completion_tokens": 100,
+        "duration": 1.5,
+        **kwargs,
+    }
+
+
+class TestMetricsWriter:
+    """
+    Tests for the batched metrics writer.
+    """
+
+    def test_flush_writes_batches(self, mock_app, db_session):
+        """
+        Test that queued metrics are written in batches on flush.
+        """
+        api_key = APIKeyFactory()
+        # The writer inserts the metrics in its own session, the API key they reference must be committed
+        db_session.commit()
+        writer = MetricsWriter(
+            mock_app, batch_size=2, flush_interval=1, max_queue_size=10, put_timeout=0
+        )
+        for _ in range(5):
+            assert writer.submit(make_metric_data(api_key.id))
+
+        writer.flush()
+
+        assert db_session.query(Metric).filter_by(api_key_id=api_key.id).count() == 5
+        assert writer.stats() == {
+            "submitted": 5,
+            "written": 5,
+            "dropped": 0,
+            "failed": 0,
+            "queued": 0,
+        }
+
+    def test_full_queue_drops_metrics(self, mock_app):
+        """
+        Test that metrics are dropped and counted when the queue is full.
+        """
+        writer = MetricsWriter(
+            mock_app, batch_size=2, flush_interval=1, max_queue_size=1, put_timeout=0
+        )
+        assert writer.submit(make_metric_data(1))
+        assert not writer.submit(make_metric_data(1))
+        assert writer.stats()["dropped"] == 1
+        assert writer.stats()["queued"] == 1
@@ -0,0 +1,130 @@
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from tables.replicas import ReplicaVMStatus
+from utils.prometheus import get_db_operation, observe_completion
+from utils.redis import get_redis_client
+from utils.routing import RoundRobinRouter
+
+from .factories import APIKeyFactory, LLMModelFactory, ReplicaFactory
+from .utils import AIModel
+
+
+def get_sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestPrometheusMetrics:
+    """
+    Tests for the Prometheus metrics of the proxy.
+    """
+
+    def test_observe_completion(self):
+        """
+        Test that completions served from the response cache don't count towards the throughput of the model.
+        """
+        labels = {"model": "prometheus-test-model"}
+        count = get_sample("llm_proxy_output_tokens_per_second_count", **labels)
+
+        observe_completion("prometheus-test-model", True, False, 2.0, completion_tokens=50, time_to_first_token=0.5)
+        observe_completion("prometheus-test-model", True, True, 0.01, completion_tokens=50)
+
+        assert get_sample("llm_proxy_output_tokens_per_second_count", **labels) == count + 1
+        assert get_sample("llm_proxy_time_to_first_token_seconds_count", **labels) >= 1
+        assert get_sample(
+            "llm_proxy_request_duration_seconds_count", stream="true", cache_hit="true", **labels
+        ) >= 1
+
+    def test_in_flight_gauges(self):
+        """
+        Test that a request is counted in flight on its model until released, and on its replica until it fails
+        over to another one.
+        """
+        model = LLMModelFactory()
+        replicas = ReplicaFactory.create_batch(2, llm_model=model, vm_status=ReplicaVMStatus.SUCCESS)
+
+        in_flight = RoundRobinRouter().route(replicas, model=model.name)
+        first_replica = in_flight.replica
+        assert get_sample("llm_proxy_in_flight_requests", model=model.name) == 1
+        assert get_sample("llm_proxy_replica_in_flight_requests", model=model.name, replica=str(first_replica.id)) == 1
+
+        assert in_flight.failover()
+        assert get_sample("llm_proxy_replica_in_flight_requests", model=model.name, replica=str(first_replica.id)) == 0
+        assert get_sample(
+            "llm_proxy_replica_in_flight_requests", model=model.name, replica=str(in_flight.replica.id)
+        ) == 1
+
+        in_flight.release()
+        in_flight.release()
+        assert get_sample("llm_proxy_in_flight_requests", model=model.name) == 0
+        assert get_sample(
+            "llm_proxy_replica_in_flight_requests", model=model.name, replica=str(in_flight.replica.id)
+        ) == 0
+
+    def test_rate_limit_rejections(self, api_client):
+        """
+        Test that the requests rejected by the rate limit of their API key are counted.
+        """
+        model = LLMModelFactory(name=AIModel.PERPLEXITY)
+        ReplicaFactory(llm_model=model, vm_status=ReplicaVMStatus.SUCCESS)
+        key = APIKeyFactory(allowed_rpm=1)
+        payload = {
+            "model": AIModel.PERPLEXITY,
+            "stream": False,
+            "messages": [{"role": "user", "content": "test message"}],
+        }
+        rejections = get_sample("llm_proxy_rate_limit_rejections_total", limit="api_key")
+
+        for status_code in (200, 429):
+            response = api_client.post(
+                "/api/v1/chat/completions",
+                json=payload,
+                headers={"Authorization": f"Bearer {key.api_key}"},
+            )
+            assert response.status_code == status_code
+
+        assert get_sample("llm_proxy_rate_limit_rejections_total", limit="api_key") == rejections + 1
+
+    def test_redis_commands(self):
+        """
+        Test that the Redis commands and pipelines are timed.
+        """
+        set_count = get_sample("llm_proxy_redis_command_duration_seconds_count", command="SET")
+        pipeline_count = get_sample("llm_proxy_redis_command_duration_seconds_count", command="PIPELINE")
+
+        client = get_redis_client()
+        client.set("prometheus-test", 1)
+        pipe = client.pipeline()
+        pipe.get("prometheus-test")
+        pipe.delete("prometheus-test")
+        assert pipe.execute() == [b"1", 1]
+
+        assert get_sample("llm_proxy_redis_command_duration_seconds_count", command="SET") == set_count + 1
+        assert get_sample("llm_proxy_redis_command_duration_seconds_count", command="PIPELINE") == pipeline_count + 1
+
+    def test_db_queries(self, db_session):
+        """
+        Test that the database queries are timed, but not the failing ones.
+        """
+        select_count = get_sample("llm_proxy_db_query_duration_seconds_count", operation="SELECT")
+
+        with pytest.raises(DBAPIError):
+            db_session.execute(text("SELECT * FROM missing_table"))
+        db_session.rollback()
+        db_session.execute(text("SELECT 1"))
+
+        assert get_sample("llm_proxy_db_query_duration_seconds_count", operation="SELECT") == select_count + 1
+
+    @pytest.mark.parametrize(
+        "statement, operation",
+        [
+            ("SELECT api_key.id FROM api_key", "SELECT"),
+            ("\n  insert into metric VALUES (1)", "INSERT"),
+            ("SET FOREIGN_KEY_CHECKS = 0", "OTHER"),
+            ("", "OTHER"),
+        ],
+    )
+    def test_get_db_operation(self, statement, operation):
+        assert get_db_operation(statement) == operation
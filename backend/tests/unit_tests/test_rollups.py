@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+from tables.metric_rollup import MetricRollup, MetricRollupWatermark, RollupGranularity
+from utils.rollups import get_bucket, query_rollups, rollup_metrics
+
+from .factories import APIKeyFactory, MetricFactory
+
+# Start of a day, in seconds
+DAY = 1798761600
+
+
+class TestMetricRollups:
+    """
+    Tests for the rollups of the metric table.
+    """
+
+    def create_metrics(self, db_session):
+        api_key = APIKeyFactory()
+        metrics = [
+            MetricFactory(api_key=api_key, model="a", created=DAY + 10, duration=1.0, prompt_tokens=10,
+                          completion_tokens=20, total_tokens=30, time_to_first_token=0.5, cache_hit=False),
+            MetricFactory(api_key=api_key, model="a", created=DAY + 70, duration=3.0, prompt_tokens=-999,
+                          completion_tokens=-999, total_tokens=-999, time_to_first_token=None, cache_hit=True),
+            MetricFactory(api_key=api_key, model="b", created=DAY + 3600, duration=2.0, prompt_tokens=5,
+                          completion_tokens=5, total_tokens=10, time_to_first_token=None, cache_hit=False),
+        ]
+        db_session.commit()
+        return api_key, metrics
+
+    def test_get_bucket(self):
+        """
+        Test that timestamps are truncated to the start of their bucket.
+        """
+        assert get_bucket(DAY + 3661, RollupGranularity.MINUTE) == DAY + 3660
+        assert get_bucket(DAY + 3661, RollupGranularity.HOUR) == DAY + 3600
+        assert get_bucket(DAY + 3661, RollupGranularity.DAY) == DAY
+
+    def test_rollup_metrics(self, db_session):
+        """
+        Test that the metrics are rolled up one run after being seen, in batches, and only once.
+        """
+        api_key, metrics = self.create_metrics(db_session)
+
+        # The first run only records the metrics to roll up
+        assert rollup_metrics(db_session, batch_size=2, relative_accuracy=0.01) == 0
+        assert db_session.query(MetricRollup).count() == 0
+        assert rollup_metrics(db_session, batch_size=2, relative_accuracy=0.01) == len(metrics)
+        assert rollup_metrics(db_session, batch_size=2, relative_accuracy=0.01) == 0
+
+        watermark = db_session.query(MetricRollupWatermark).one()
+        assert watermark.last_metric_id == watermark.pending_metric_id == metrics[-1].id
+
+        day = db_session.query(MetricRollup).filter_by(granularity=RollupGranularity.DAY, model="a").one()
+        assert (day.bucket, day.api_key_id) == (DAY, api_key.id)
+        assert (day.request_count, day.cache_hits) == (2, 1)
+        # Metrics without usage data don't count towards the tokens
+        assert (day.prompt_tokens, day.completion_tokens, day.total_tokens) == (10, 20, 30)
+        assert day.duration_sum == pytest.approx(4.0)
+        assert (day.time_to_first_token_sum, day.time_to_first_token_count) == (0.5, 1)
+        assert db_session.query(MetricRollup).filter_by(granularity=RollupGranularity.MINUTE).count() == 3
+        assert db_session.query(MetricRollup).filter_by(granularity=RollupGranularity.HOUR).count() == 2
+
+        # New metrics are merged into the existing rollups
+        MetricFactory(api_key=api_key, model="a", created=DAY + 20, duration=5.0)
+        db_session.commit()
+        rollup_metrics(db_session, batch_size=2, relative_accuracy=0.01)
+        assert rollup_metrics(db_session, batch_size=2, relative_accuracy=0.01) == 1
+        db_session.refresh(day)
+        assert day.request_count == 3
+        assert day.duration_sketch["zero_count"] + sum(day.duration_sketch["bins"].values()) == 3
+
+    def test_query_rollups(self, db_session):
+        """
+        Test that the rollups are merged per bucket and group, with the quantiles of their latencies.
+        """
+        api_key, metrics = self.create_metrics(db_session)
+        rollup_metrics(db_session, batch_size=100, relative_accuracy=0.01)
+        rollup_metrics(db_session, batch_size=100, relative_accuracy=0.01)
+
+        [day] = query_rollups(db_session, RollupGranularity.DAY, DAY, DAY + 86400, 0.01)
+        assert day["bucket"] == DAY
+        assert day["request_count"] == 3
+        assert day["duration"]["avg"] == pytest.approx(2.0)
+        assert day["duration"]["p50"] == pytest.approx(2.0, rel=0.01)
+        assert day["time_to_first_token"]["p50"] == pytest.approx(0.5, rel=0.01)
+
+        hours = query_rollups(db_session, RollupGranularity.HOUR, DAY, DAY + 86400, 0.01, group_by=["model"])
+        assert [(hour["bucket"], hour["model"], hour["request_count"]) for hour in hours] == [
+            (DAY, "a", 2), (DAY + 3600, "b", 1)
+        ]
+        assert query_rollups(db_session, RollupGranularity.MINUTE, DAY, DAY + 86400, 0.01, model="b")[0][
+            "time_to_first_token"
+        ]["avg"] is None
+        assert query_rollups(db_session, RollupGranularity.DAY, DAY, DAY + 86400, 0.01, api_key_id=api_key.id + 1) == []
+
+    def test_get_usage(self, api_client, db_session):
+        """
+        Test the usage endpoint, which requires the admin API key and validates its query parameters.
+        """
+        headers = {"Authorization": f'Bearer {os.getenv("ADMIN_API_KEY")}'}
+        self.create_metrics(db_session)
+        rollup_metrics(db_session, batch_size=100, relative_accuracy=0.01)
+        rollup_metrics(db_session, batch_size=100, relative_accuracy=0.01)
+
+        assert api_client.get("/api/v1/usage").status_code == 401
+
+        response = api_client.get(
+            f"/api/v1/usage?granularity=minute&start={DAY}&end={DAY + 3600}&group_by=model,api_key_id",
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert response.json["granularity"] == "minute"
+        assert [(item["bucket"], item["model"]) for item in response.json["data"]] == [(DAY, "a"), (DAY + 60, "a")]
+
+        for query in ("granularity=week", "group_by=replica", f"start={DAY}&end={DAY}", f"start=0&end={DAY}"):
+            response = api_client.get(f"/api/v1/usage?{query}", headers=headers)
+            assert response.status_code == 400
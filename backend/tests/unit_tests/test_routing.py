@@ -0,0 +1,154 @@
+import pytest
+from unittest.mock import patch
+
+from tables.replicas import ReplicaVMStatus
+from utils.rate_limits import RateLimitResult, ReplicaRateLimitExceeded, ReplicaRateLimitManager
+from utils.routing import (
+    get_router,
+    ReplicaInFlightTracker,
+    RoundRobinRouter,
+    LeastOutstandingRequestsRouter,
+    PowerOfTwoChoicesRouter,
+    PrefixAffinityRouter,
+)
+
+from .factories import LLMModelFactory, ReplicaFactory
+
+
+class TestReplicaRouting:
+    """
+    Tests for the replica routing strategies.
+    """
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        model = LLMModelFactory()
+        self.replicas = ReplicaFactory.create_batch(
+            3, llm_model=model, vm_status=ReplicaVMStatus.SUCCESS
+        )
+
+    def test_round_robin(self):
+        """
+        Test that the round robin router cycles through all replicas.
+        """
+        router = RoundRobinRouter()
+        selected = []
+        for _ in range(6):
+            in_flight = router.route(self.replicas)
+            selected.append(in_flight.replica.id)
+            in_flight.release()
+
+        replica_ids = sorted(replica.id for replica in self.replicas)
+        assert selected == replica_ids * 2
+
+    def test_least_outstanding_requests(self):
+        """
+        Test that the least outstanding requests router avoids busy replicas.
+        """
+        router = LeastOutstandingRequestsRouter()
+        for replica in self.replicas[:2]:
+            router.tracker.acquire(replica.id)
+
+        in_flight = router.route(self.replicas)
+        assert in_flight.replica.id == self.replicas[2].id
+
+    def test_power_of_two_choices(self):
+        """
+        Test that the power of two choices router never picks the busiest replica.
+        """
+        router = PowerOfTwoChoicesRouter()
+        for _ in range(3):
+            router.tracker.acquire(self.replicas[0].id)
+
+        for _ in range(10):
+            in_flight = router.route(self.replicas)
+            assert in_flight.replica.id != self.replicas[0].id
+            in_flight.release()
+
+    def test_prefix_affinity(self):
+        """
+        Test that requests sharing a prefix are sent to the same replica, and that prefixes are spread.
+        """
+        router = PrefixAffinityRouter()
+
+        def route(*messages):
+            payload = {"messages": [{"role": "system", "content": "You are helpful."}, *messages]}
+            in_flight = router.route(self.replicas, affinity_key=router.get_affinity_key(payload))
+            in_flight.release()
+            return in_flight.replica.id
+
+        first_turn = {"role": "user", "content": "x" * router.prefix_chars}
+        assert route(first_turn) == route(first_turn, {"role": "assistant", "content": "Hi"})
+        assert len({route({"role": "user", "content": f"question {i}"}) for i in range(30)}) > 1
+
+    def test_prefix_affinity_bounded_load(self):
+        """
+        Test that requests spill over to another replica when the replica of their prefix is hot.
+        """
+        router = PrefixAffinityRouter()
+        affinity_key = router.get_affinity_key({"messages": [{"role": "user", "content": "test message"}]})
+        replica_id = router.route(self.replicas, affinity_key=affinity_key).replica.id
+        for _ in range(3):
+            router.tracker.acquire(replica_id)
+
+        assert router.route(self.replicas, affinity_key=affinity_key).replica.id != replica_id
+
+    def test_in_flight_release(self):
+        """
+        Test that in-flight requests are counted until released.
+        """
+        tracker = ReplicaInFlightTracker()
+        router = LeastOutstandingRequestsRouter(tracker)
+        in_flight = router.route(self.replicas)
+        assert tracker.get_counts([in_flight.replica.id]) == {in_flight.replica.id: 1}
+
+        in_flight.release()
+        in_flight.release()
+        assert tracker.get_counts([in_flight.replica.id]) == {in_flight.replica.id: 0}
+
+    @pytest.mark.parametrize("router_cls", [RoundRobinRouter, PrefixAffinityRouter])
+    def test_max_in_flight_per_replica(self, mock_app, router_cls):
+        """
+        Test that a replica gets no more in-flight requests than `ADMISSION_MAX_IN_FLIGHT_PER_REPLICA`, whatever the
+        routing strategy: the requests of a hot prefix spread over every replica, then are rejected.
+        """
+        with patch.dict(mock_app.config, {"ADMISSION_MAX_IN_FLIGHT_PER_REPLICA": 2}):
+            router = router_cls()
+            affinity_key = router.get_affinity_key({"messages": [{"role": "user", "content": "test message"}]})
+            requests = [router.route(self.replicas, affinity_key=affinity_key) for _ in range(6)]
+            counts = router.tracker.get_counts([replica.id for replica in self.replicas])
+            assert list(counts.values()) == [2, 2, 2]
+
+            with pytest.raises(ReplicaRateLimitExceeded):
+                router.route(self.replicas, affinity_key=affinity_key)
+            requests[0].release()
+            assert router.route(self.replicas, affinity_key=affinity_key).replica.id == requests[0].replica.id
+
+    def test_tracker_limit(self):
+        """
+        Test that a replica isn't marked with more in-flight requests than the limit.
+        """
+        tracker = ReplicaInFlightTracker()
+        replica_id = self.replicas[0].id
+        assert tracker.acquire(replica_id, limit=1) is not None
+        assert tracker.acquire(replica_id, limit=1) is None
+        assert tracker.acquire(replica_id) is not None
+        assert tracker.get_counts([replica_id]) == {replica_id: 2}
+
+    def test_replica_rate_limits(self):
+        """
+        Test that replicas are admitted up to their rate limit, and always without one.
+        """
+        rate_limits = ReplicaRateLimitManager()
+        self.replicas[0].rate_limit = 1
+        self.replicas[1].rate_limit = None
+        assert rate_limits.admit(self.replicas[0]).allowed
+        assert not rate_limits.admit(self.replicas[0]).allowed
+        assert rate_limits.admit(self.replicas[1]) == RateLimitResult(True, None, 0)
+
+    def test_unknown_strategy(self):
+        """
+        Test that an unknown routing strategy is rejected.
+        """
+        with pytest.raises(ValueError):
+            get_router("unknown")
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+from unittest.mock import patch
+
+from utils.single_flight import FLIGHT_ABORTED, get_flight, join_flight, make_flight_key
+
+PAYLOAD = {
+    "model": "model",
+    "messages": [{"role": "user", "content": "test message"}],
+    "temperature": 0,
+    "stream": True,
+}
+
+
+class TestSingleFlight:
+    """
+    Tests for the coalescing of identical in-flight requests.
+    """
+
+    def test_flight_key(self, mock_app):
+        """
+        Test that only deterministic requests get a flight, when enabled.
+        """
+        with patch.dict(mock_app.config, {"SINGLE_FLIGHT_ENABLED": True}):
+            assert make_flight_key(PAYLOAD) == make_flight_key({**PAYLOAD, "user": "someone"})
+            assert make_flight_key(PAYLOAD) != make_flight_key({**PAYLOAD, "stream": False})
+            assert make_flight_key({**PAYLOAD, "temperature": 0.7}) is None
+            assert make_flight_key({**PAYLOAD, "temperature": 0.7, "seed": 1}) is not None
+        assert make_flight_key(PAYLOAD) is None
+
+    def test_fan_out(self):
+        """
+        Test that followers get every chunk whenever they joined, and that the flight is over once finished.
+        """
+        flight, leader = join_flight("key")
+        assert leader
+        assert join_flight("key") == (flight, False)
+        assert get_flight("key") is flight
+
+        received = []
+        flight.publish(b"a")
+        followers = [threading.Thread(target=lambda: received.append(b"".join(flight))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        flight.publish(b"b")
+        flight.finish()
+        flight.finish(error=FLIGHT_ABORTED)
+        for follower in followers:
+            follower.join(timeout=5)
+
+        assert received == [b"ab"] * 3
+        assert flight.error is None
+        assert get_flight("key") is None
+
+    def test_async_fan_out_with_error(self):
+        """
+        Test that followers on the event loop get the chunks published so far and the error ending the flight.
+        """
+        flight, _ = join_flight("key")
+
+        async def follow():
+            return [chunk async for chunk in flight.aiter()]
+
+        async def main():
+            followers = asyncio.gather(follow(), follow())
+            await asyncio.sleep(0)
+            flight.publish(b"a")
+            await asyncio.sleep(0)
+            flight.finish(error=(502, "Bad Gateway"))
+            return await asyncio.wait_for(followers, timeout=5)
+
+        assert asyncio.run(main()) == [[b"a"], [b"a"]]
+        assert flight.error == (502, "Bad Gateway")
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from utils.sketches import DDSketch
+
+
+class TestDDSketch:
+    """
+    Tests for the quantile sketches.
+    """
+
+    def test_quantiles_within_relative_accuracy(self):
+        """
+        Test that the quantiles are within the relative accuracy of the exact ones.
+        """
+        values = sorted(random.lognormvariate(0, 1.5) for _ in range(10000))
+        sketch = DDSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+
+        assert sketch.count == len(values)
+        for q in (0, 0.5, 0.95, 0.99, 1):
+            exact = values[int(q * (len(values) - 1))]
+            assert sketch.quantile(q) == pytest.approx(exact, rel=0.01)
+
+    def test_merge(self):
+        """
+        Test that merging sketches gives the sketch of all their values, and that the sketches must have the same
+        relative accuracy.
+        """
+        values = [random.uniform(0.01, 100) for _ in range(1000)] + [0.0] * 10
+        merged, first, second = DDSketch(), DDSketch(), DDSketch()
+        for index, value in enumerate(values):
+            merged.add(value)
+            (first if index % 2 else second).add(value)
+        first.merge(second)
+
+        assert first.bins == merged.bins
+        assert first.zero_count == merged.zero_count == 10
+        assert first.quantile(0) == 0.0
+
+        with pytest.raises(ValueError):
+            first.merge(DDSketch(relative_accuracy=0.02))
+
+    def test_serialization(self):
+        """
+        Test that a sketch survives a round trip through JSON compatible data.
+        """
+        sketch = DDSketch(relative_accuracy=0.02)
+        for value in (0.0, 0.5, 1.5, 30):
+            sketch.add(value)
+
+        restored = DDSketch.from_dict(sketch.to_dict())
+        assert restored.relative_accuracy == 0.02
+        assert restored.bins == sketch.bins
+        assert restored.zero_count == sketch.zero_count
+        assert DDSketch().quantile(0.5) is None
@@ -0,0 +1,108 @@
+import json
+
+from utils.sse import SSEFramer, SSERelay
+
+CHUNKS = [
+    {"id": "cmpl-1", "choices": [{"index": 0, "delta": {"content": "Hello"}}], "usage": None},
+    {"id": "cmpl-1", "choices": [{"index": 0, "delta": {"content": " world"}}], "usage": None},
+    {"id": "cmpl-1", "choices": [], "usage": {"prompt_tokens": 7, "total_tokens": 9, "completion_tokens": 2}},
+]
+
+
+def make_stream(chunks=CHUNKS):
+    frames = [f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks]
+    return b"".join(frames) + b": keep-alive\n\ndata: [DONE]\n\n"
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestSSEFramer:
+    """
+    Tests for the incremental SSE framer.
+    """
+
+    def test_coalesced_and_split_frames(self):
+        """
+        Test that frames are returned whole whatever the boundaries of the reads.
+        """
+        stream = make_stream()
+        expected = SSEFramer().feed(stream)
+        assert len(expected) == len(CHUNKS) + 2
+
+        for size in (1, 7, 100):
+            framer = SSEFramer()
+            frames = [frame for data in split(stream, size) for frame in framer.feed(data)]
+            assert frames == expected
+            assert framer.close() == []
+
+    def test_unterminated_frame(self):
+        """
+        Test that the last frame is returned on close when the stream doesn't end with a blank line.
+        """
+        framer = SSEFramer()
+        assert framer.feed(b"data: 1\r\n\r\ndata: 2") == [b"data: 1"]
+        assert framer.close() == [b"data: 2"]
+
+
+class TestSSERelay:
+    """
+    Tests for the relay of the streamed chat completion chunks.
+    """
+
+    def test_relay(self):
+        """
+        Test that chunks are forwarded as NDJSON, and that only usage data is kept from the usage frame.
+        """
+        relay = SSERelay(raw=False, keep_payloads=True)
+        output = b"".join(relay.feed(data) for data in split(make_stream(), 5)) + relay.close()
+
+        assert [json.loads(line) for line in output.splitlines()] == CHUNKS[:2]
+        assert relay.usage == CHUNKS[2]["usage"]
+        assert relay.chunks == 2
+        assert relay.choices() == CHUNKS[0]["choices"] + CHUNKS[1]["choices"]
+
+    def test_relay_without_payloads(self):
+        """
+        Test that the forwarded payloads aren't kept by default, only counted.
+        """
+        relay = SSERelay(raw=False)
+        relay.feed(make_stream())
+        relay.close()
+
+        assert relay.chunks == 2
+        assert relay.payloads == []
+        assert relay.usage == CHUNKS[2]["usage"]
+
+    def test_relay_raw(self):
+        """
+        Test that frames are forwarded byte-for-byte in raw mode, the usage-only frame included.
+        """
+        stream = make_stream()
+        relay = SSERelay(raw=True)
+        output = relay.feed(stream) + relay.close()
+
+        assert output == stream
+        assert relay.usage == CHUNKS[2]["usage"]
+
+    def test_relay_raw_usage_chunk(self):
+        """
+        Test that raw clients asking for `stream_options.include_usage` get the usage chunk, whatever the boundaries
+        of the reads, while it isn't forwarded as NDJSON.
+        """
+        stream = make_stream()
+        relay = SSERelay(raw=True)
+        output = b"".join(relay.feed(data) for data in split(stream, 3)) + relay.close()
+
+        chunks = [
+            json.loads(line[len(b"data: "):])
+            for line in output.splitlines()
+            if line.startswith(b"data: {")
+        ]
+        assert chunks[-1] == CHUNKS[2]
+        assert relay.usage == CHUNKS[2]["usage"]
+
+        relay = SSERelay(raw=False)
+        output = relay.feed(stream) + relay.close()
+        assert all(json.loads(line)["choices"] for line in output.splitlines())
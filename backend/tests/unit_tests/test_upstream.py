@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+from utils.upstream import KeepAliveExpiryHTTPConnectionPool, UpstreamAdapter
+
+
+class TestUpstreamConnectionPool:
+    """
+    Tests for the keep-alive connections to the upstream LLM endpoints.
+    """
+
+    def test_adapter_pools(self):
+        """
+        Test that the pools of the upstream adapter expire their idle connections.
+        """
+        adapter = UpstreamAdapter(keepalive_expiry=5, pool_connections=1, pool_maxsize=2)
+        pool = adapter.poolmanager.connection_from_url("http://replica:8000/v1/chat/completions")
+        assert isinstance(pool, KeepAliveExpiryHTTPConnectionPool)
+        assert pool.keepalive_expiry == 5
+
+    def test_idle_connection_expiry(self):
+        """
+        Test that a pooled connection is reused while recently used, and reopened once idle for longer than the
+        keep-alive expiry.
+        """
+        pool = KeepAliveExpiryHTTPConnectionPool("replica", 8000, keepalive_expiry=60, maxsize=1)
+        with patch("urllib3.connectionpool.is_connection_dropped", return_value=False):
+            conn = pool._get_conn()
+            with patch.object(conn, "close") as close:
+                pool._put_conn(conn)
+                assert pool._get_conn() is conn
+                close.assert_not_called()
+
+                pool._put_conn(conn)
+                conn.idle_since -= 61
+                assert pool._get_conn() is conn
+                close.assert_called_once()
@@ -0,0 +1,202 @@
+"""Admission queue of the chat completion requests of a model, shared across workers through Redis."""
+
+import time
+import uuid
+import typing
+import logging
+
+from flask import current_app as app
+
+from tables.api_key import APIKeyPriority
+from utils.redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Weighted fair queuing: a ticket is scored by its virtual finish time, i.e. the finish time of the previous ticket of
+# its flow (the API key), or the current virtual time if the flow is idle, plus the inverse of its weight. Tickets
+# are dequeued in score order, so that every flow gets a share of the capacity proportional to its weight.
+ENQUEUE_SCRIPT = """
+local vtime = tonumber(redis.call('GET', KEYS[3]) or '0')
+local last_finish = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+local finish = math.max(vtime, last_finish) + 1 / tonumber(ARGV[2])
+local ttl = tonumber(ARGV[5])
+
+redis.call('HSET', KEYS[2], ARGV[1], finish)
+redis.call('ZADD', KEYS[1], finish, ARGV[3])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[3])
+for _, key in ipairs(KEYS) do
+    redis.call('EXPIRE', key, ttl)
+end
+return tostring(finish)
+"""
+
+# Let the ticket in if it is among the first `free` tickets of the queue, `free` being the number of slots left. The
+# admitted ticket takes a slot until released, and its finish time becomes the virtual time. Tickets and slots older
+# than their timeout are dropped first, in case their worker died. Returns 1 if admitted, -1 if the ticket is gone.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[3])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now - tonumber(ARGV[4]))
+for _, ticket in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], ticket)
+    redis.call('ZREM', KEYS[4], ticket)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[5]))
+
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+if not rank then
+    return -1
+end
+if rank >= tonumber(ARGV[2]) - redis.call('ZCARD', KEYS[2]) then
+    return 0
+end
+
+local finish = redis.call('ZSCORE', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[5]))
+if tonumber(finish) > tonumber(redis.call('GET', KEYS[3]) or '0') then
+    redis.call('SET', KEYS[3], finish, 'EX', tonumber(ARGV[5]))
+end
+return 1
+"""
+
+# Release a slot or cancel a queued ticket, then wake the queued requests up: the notify list gets a notification per
+# queued ticket, each of them trying to acquire a slot again. Notifications left over by requests that got in or
+# timed out are replaced by the next ones.
+NOTIFY_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[4])
+local waiting = redis.call('ZCARD', KEYS[3])
+for _ = 1, waiting do
+    redis.call('RPUSH', KEYS[4], 1)
+end
+if waiting > 0 then
+    redis.call('EXPIRE', KEYS[4], tonumber(ARGV[2]))
+end
+return waiting
+"""
+
+
+def resolve_priority(api_key_priority: str, requested_priority: typing.Optional[str] = None) -> str:
+    """
+    Returns the priority class of a request: the one of its API key, unless the request asks for a lower one.
+    """
+    if requested_priority is None:
+        return api_key_priority
+    return max(api_key_priority, requested_priority, key=APIKeyPriority.CHOICES.index)
+
+
+def get_priority_weight(priority: str) -> float:
+    weights = {
+        APIKeyPriority.INTERACTIVE: app.config['ADMISSION_INTERACTIVE_WEIGHT'],
+        APIKeyPriority.BATCH: app.config['ADMISSION_BATCH_WEIGHT'],
+    }
+    return weights[priority]
+
+
+class AdmissionSlot:
+    """
+    A slot of the model capacity taken by an admitted request, released once the response has been fully sent.
+    """
+
+    def __init__(self, queue: 'AdmissionQueue', ticket: str):
+        self.queue = queue
+        self.ticket = ticket
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.queue.notify(self.ticket)
+        except Exception:
+            logger.exception(f"Failed to release admission slot {self.ticket}")
+
+
+class AdmissionQueue:
+    """
+    A class to bound the in-flight requests of a model to `ADMISSION_MAX_IN_FLIGHT_PER_REPLICA` per replica, queuing
+    the others.
+
+    The queue lets in up to `ADMISSION_MAX_IN_FLIGHT_PER_REPLICA` times the number of ready replicas, and the router
+    only sends the admitted requests to the replicas under that bound (see `utils.routing.ReplicaRouter.reserve`), so
+    that a replica favoured by the routing strategy can't take the slots of the others.
+
+    Queued requests are let in by weighted fair queuing across API keys, weighted by their priority class: a batch
+    job queuing many requests only gets its share of the capacity, and interactive requests overtake it. They block
+    on a notify list of the model (`BLPOP`) until a slot is released or a ticket ahead of them is cancelled, instead
+    of polling.
+    """
+
+    def __init__(self, model_id: int, client=None):
+        self.client = client or get_redis_client()
+        self.max_in_flight_per_replica = app.config['ADMISSION_MAX_IN_FLIGHT_PER_REPLICA']
+        self.timeout = app.config['ADMISSION_QUEUE_TIMEOUT']
+        self.slot_timeout = app.config['REPLICA_INFLIGHT_TIMEOUT']
+        self.keys = [
+            f"admission_queue:{model_id}",
+            f"admission_flows:{model_id}",
+            f"admission_vtime:{model_id}",
+            f"admission_tickets:{model_id}",
+        ]
+        self.slots_key = f"admission_slots:{model_id}"
+        self.notify_key = f"admission_notify:{model_id}"
+        self.enqueue_script = self.client.register_script(ENQUEUE_SCRIPT)
+        self.acquire_script = self.client.register_script(ACQUIRE_SCRIPT)
+        self.notify_script = self.client.register_script(NOTIFY_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight_per_replica > 0
+
+    def enqueue(self, flow_id: int, weight: float) -> str:
+        ticket = uuid.uuid4().hex
+        self.enqueue_script(
+            keys=self.keys, args=[flow_id, weight, ticket, time.time(), int(self.slot_timeout)]
+        )
+        return ticket
+
+    def acquire(self, ticket: str, capacity: int) -> int:
+        queue_key, _, vtime_key, tickets_key = self.keys
+        return self.acquire_script(
+            keys=[queue_key, self.slots_key, vtime_key, tickets_key],
+            args=[ticket, capacity, time.time(), self.timeout, self.slot_timeout],
+        )
+
+    def notify(self, ticket: str):
+        """
+        Release the slot or cancel the queued `ticket`, and wake the queued requests up.
+        """
+        queue_key, _, _, tickets_key = self.keys
+        self.notify_script(
+            keys=[self.slots_key, queue_key, tickets_key, self.notify_key],
+            args=[ticket, int(self.slot_timeout)],
+        )
+
+    def cancel(self, ticket: str):
+        self.notify(ticket)
+
+    def wait(self, flow_id: int, priority: str, replica_count: int) -> typing.Optional[AdmissionSlot]:
+        """
+        Queue the request until a slot is free, returns the slot or None once `ADMISSION_QUEUE_TIMEOUT` is reached.
+        """
+        capacity = replica_count * self.max_in_flight_per_replica
+        ticket = self.enqueue(flow_id, get_priority_weight(priority))
+        deadline = time.monotonic() + self.timeout
+        try:
+            while True:
+                result = self.acquire(ticket, capacity)
+                if result == 1:
+                    ticket, slot_ticket = None, ticket
+                    return AdmissionSlot(self, slot_ticket)
+                remaining = deadline - time.monotonic()
+                if result == -1 or remaining <= 0:
+                    return None
+                # A timeout of 0 would block forever
+                self.client.blpop([self.notify_key], timeout=max(remaining, 0.001))
+        finally:
+            if ticket is not None:
+                self.cancel(ticket)
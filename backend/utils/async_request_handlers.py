@@ -0,0 +1,503 @@
+"""Asynchronous counterparts of `utils.request_handlers`, used by the ASGI proxy (see `asgi.py`)."""
+
+import json
+import time
+import typing
+import asyncio
+import logging
+
+import httpx
+from flask import Flask
+from werkzeug.exceptions import HTTPException, InternalServerError, default_exceptions
+from werkzeug.utils import get_content_type
+
+from utils.latency import StreamTimer
+from utils.metric_payloads import should_store_payload
+from utils.prometheus import observe_client_disconnect, observe_upstream_error
+from utils.rate_limits import TokenDebit
+from utils.request_handlers import (
+    is_replica_healthy,
+    record_metrics,
+    record_replica_outcome,
+    refund_tokens,
+    replay_cached_response,
+    store_cached_response,
+)
+from utils.routing import InFlightRequest
+from utils.single_flight import FLIGHT_ABORTED, Flight
+from utils.sse import SSERelay
+from utils.upstream import RETRYABLE_STATUS_CODES, get_retry_policy, get_upstream_origin
+
+logger = logging.getLogger(__name__)
+
+ASGISend = typing.Callable[[typing.Dict[str, typing.Any]], typing.Awaitable[None]]
+ASGIReceive = typing.Callable[[], typing.Awaitable[typing.Dict[str, typing.Any]]]
+
+# Failures to connect to the replica, it can't have started processing the request
+RETRYABLE_HTTPX_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+_clients = {}
+
+
+def get_async_client(flask_app: Flask, endpoint: str) -> httpx.AsyncClient:
+    """
+    Returns the HTTP client of the upstream serving `endpoint`. Clients are kept per upstream origin, so that each
+    replica gets its own persistent pool of keep-alive connections.
+    """
+    origin = get_upstream_origin(endpoint)
+    client = _clients.get(origin)
+    if client is None:
+        config = flask_app.config
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config['UPSTREAM_POOL_MAXSIZE'],
+                max_keepalive_connections=config['UPSTREAM_POOL_MAXSIZE'],
+                keepalive_expiry=config['UPSTREAM_KEEPALIVE_EXPIRY'],
+            ),
+            timeout=httpx.Timeout(
+                config['UPSTREAM_READ_TIMEOUT'],
+                connect=config['UPSTREAM_CONNECT_TIMEOUT'],
+                pool=config['UPSTREAM_CONNECT_TIMEOUT'],
+            ),
+        )
+        _clients[origin] = client
+    return client
+
+
+async def close_async_clients():
+    while _clients:
+        _, client = _clients.popitem()
+        await client.aclose()
+
+
+def encode_headers(headers: typing.Mapping[str, str]) -> typing.List[typing.Tuple[bytes, bytes]]:
+    return [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()]
+
+
+async def send_response(send: ASGISend, response):
+    """
+    Send a complete werkzeug response (e.g. a Flask error response) to the client.
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': encode_headers(response.headers),
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def send_stream_start(send: ASGISend, headers: typing.Optional[typing.Dict[str, str]] = None):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': encode_headers({'Content-Type': 'text/event-stream; charset=utf-8', **(headers or {})}),
+    })
+
+
+async def send_error(send: ASGISend, status_code: int, description: str):
+    """
+    Send the same error response as `flask.abort` would.
+    """
+    exception_cls = default_exceptions.get(status_code, InternalServerError)
+    exception: HTTPException = exception_cls(description=description)
+    await send_response(send, exception.get_response())
+
+
+async def send_upstream_error(
+    send: ASGISend, status_code: int, description: str, flight: typing.Optional[Flight] = None
+):
+    """
+    Send the error of the LLM endpoint API, failing the requests following the flight of the request with it.
+    """
+    if flight is not None:
+        flight.finish(error=(status_code, description))
+    await send_error(send, status_code, description)
+
+
+def upstream_error_status(response: typing.Optional[httpx.Response]) -> int:
+    return response.status_code if (response is not None and 400 <= response.status_code < 500) else 500
+
+
+async def record_async_metrics(flask_app: Flask, **metric_kwargs: typing.Any):
+    """
+    Update the metrics from a worker thread, outside of the event loop.
+    """
+    await asyncio.to_thread(record_metrics, flask_app, **metric_kwargs)
+
+
+async def send_async_upstream_request(
+    flask_app: Flask,
+    in_flight: InFlightRequest,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    stream: bool = False,
+    timer: typing.Optional[StreamTimer] = None,
+) -> typing.Tuple[httpx.Response, int]:
+    """
+    Send the request to the replica it was routed to, retrying the requests that fail before any byte of the response
+    was received, returns the response and the number of retries (see `utils.request_handlers.send_upstream_request`).
+
+    Streamed responses are returned once their headers are received, they must be closed by the caller.
+    """
+    retry_policy = get_retry_policy(flask_app.config)
+    retries = 0
+    while True:
+        replica = in_flight.replica
+        client = get_async_client(flask_app, replica.endpoint)
+        request_time = time.time()
+        if timer is not None:
+            timer.request_sent()
+        try:
+            response = await client.send(
+                client.build_request('POST', replica.endpoint, json=chat_completion_payload), stream=stream
+            )
+            if timer is not None:
+                timer.headers_received()
+        except httpx.HTTPError as e:
+            await asyncio.to_thread(record_replica_outcome, flask_app, replica.id, False)
+            observe_upstream_error(chat_completion_payload['model'], replica.id, type(e).__name__)
+            if not isinstance(e, RETRYABLE_HTTPX_ERRORS) or retries >= retry_policy.retries:
+                raise
+            logger.warning(f"Failed to connect to replica {replica.id}, retrying: {e}")
+        else:
+            await asyncio.to_thread(
+                record_replica_outcome, flask_app, replica.id, is_replica_healthy(response), time.time() - request_time
+            )
+            if response.status_code >= 400:
+                observe_upstream_error(chat_completion_payload['model'], replica.id, response.status_code)
+            if response.status_code not in RETRYABLE_STATUS_CODES or retries >= retry_policy.retries:
+                return response, retries
+            logger.warning(f"Replica {replica.id} responded with {response.status_code}, retrying.")
+            await response.aclose()
+
+        retries += 1
+        await asyncio.to_thread(in_flight.failover)
+        await asyncio.sleep(retry_policy.get_backoff(retries))
+
+
+async def handle_async_non_streaming_request(
+    flask_app: Flask,
+    send: ASGISend,
+    api_key_id: int,
+    in_flight: InFlightRequest,
+    start_time: float,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+    token_debit: typing.Optional[TokenDebit] = None,
+    cache_key: typing.Optional[str] = None,
+    flight: typing.Optional[Flight] = None,
+):
+    """
+    Forward a non-streaming request to the LLM endpoint API, send its response back and update the metrics. With a
+    `cache_key`, the response is stored in the response cache. With a `flight`, it is published to the identical
+    requests following it.
+    """
+    response = None
+    retries = 0
+    try:
+        response, retries = await send_async_upstream_request(flask_app, in_flight, chat_completion_payload)
+        response.raise_for_status()
+        json_response = response.json()
+    except json.JSONDecodeError:
+        await asyncio.to_thread(refund_tokens, flask_app, token_debit)
+        await send_upstream_error(
+            send,
+            500,
+            f'Failed to decode response from LLM endpoint API ({in_flight.replica.endpoint}): {response.text}',
+            flight,
+        )
+        return
+    except httpx.HTTPError as e:
+        await asyncio.to_thread(refund_tokens, flask_app, token_debit)
+        await send_upstream_error(
+            send,
+            upstream_error_status(response),
+            f'Failed to receive response from LLM endpoint API ({in_flight.replica.endpoint}): '
+            f'{e} {response.text if response is not None else ""}',
+            flight,
+        )
+        return
+
+    if flight is not None:
+        flight.publish(response.content)
+        flight.finish()
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': encode_headers({'Content-Type': 'application/json', **(headers or {})}),
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(json_response).encode('utf-8')})
+
+    if cache_key:
+        await asyncio.to_thread(store_cached_response, flask_app, cache_key, response.content)
+
+    await record_async_metrics(
+        flask_app,
+        usage_data=json_response.get('usage', {}),
+        api_key_id=str(api_key_id),
+        input_data=chat_completion_payload,
+        response_choices=json_response['choices'] if should_store_payload(flask_app.config) else None,
+        start_time=start_time,
+        retries=retries,
+        replica_id=in_flight.replica.id,
+        token_debit=token_debit,
+    )
+
+
+async def wait_for_disconnect(receive: ASGIReceive):
+    """
+    Returns once the client has disconnected, the body of the request having been read.
+    """
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def run_until_disconnect(
+    receive: ASGIReceive, coroutine: typing.Awaitable[typing.Any]
+) -> typing.Tuple[bool, typing.Any]:
+    """
+    Run `coroutine` until it is done, or cancel it if the client disconnects first. Returns whether the client
+    disconnected, with the result of the coroutine otherwise.
+    """
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watcher.cancel()
+        raise
+
+    watcher.cancel()
+    if task.done():
+        return False, task.result()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return True, None
+
+
+async def handle_async_streaming_request(
+    flask_app: Flask,
+    send: ASGISend,
+    receive: ASGIReceive,
+    api_key_id: int,
+    in_flight: InFlightRequest,
+    start_time: float,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    raw: bool,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+    token_debit: typing.Optional[TokenDebit] = None,
+    cache_key: typing.Optional[str] = None,
+    flight: typing.Optional[Flight] = None,
+):
+    """
+    Stream the response of the LLM endpoint API back to the client as it is received (see `SSERelay`), then update
+    the metrics with the usage data of the response. With a `cache_key`, the stream is buffered and stored in the
+    response cache once complete. With a `flight`, its chunks are published to the identical requests following it.
+
+    As in `handle_streaming_request`, a stream failing once the response has started is ended early, and the tokens
+    debited for it are refunded without recording its metrics.
+
+    If the client disconnects before the end of the stream, the request to the replica is cancelled and the request
+    released right away, so that the replica stops generating and its slots are freed. The request is counted as
+    aborted instead of recording its metrics, and the tokens debited at admission are kept, its usage being unknown.
+    """
+    store_payload = should_store_payload(flask_app.config)
+    relay = SSERelay(raw=raw, keep_payloads=store_payload)
+    max_entry_bytes = flask_app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+    buffer = bytearray() if cache_key else None
+    timer = StreamTimer(start_time)
+    started = False
+    completed = False
+    response = None
+    retries = 0
+
+    async def relay_stream() -> bool:
+        """
+        Relay the stream to the client, returns whether it completed.
+        """
+        nonlocal buffer, completed, response, retries, started
+
+        try:
+            response, retries = await send_async_upstream_request(
+                flask_app, in_flight, chat_completion_payload, stream=True, timer=timer
+            )
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+
+            await send_stream_start(send, headers)
+            started = True
+            async for chunk in response.aiter_bytes():
+                if flight is not None:
+                    flight.publish(chunk)
+                if buffer is not None:
+                    buffer += chunk
+                    if len(buffer) > max_entry_bytes:
+                        buffer = None
+                data = relay.feed(chunk)
+                timer.observe(relay.chunks)
+                if data:
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            completed = True
+            if data := relay.close():
+                timer.observe(relay.chunks)
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        except Exception as e:
+            await asyncio.to_thread(refund_tokens, flask_app, token_debit)
+            if not started:
+                if not isinstance(e, httpx.HTTPError):
+                    raise
+                await send_upstream_error(
+                    send,
+                    upstream_error_status(getattr(e, 'response', None)),
+                    f'Failed to receive response from LLM endpoint API ({in_flight.replica.endpoint}): {e}',
+                    flight,
+                )
+                return False
+
+            # The response has started, the client only sees the stream end early
+            logger.exception(f"Stream from LLM endpoint API ({in_flight.replica.endpoint}) failed.")
+            if isinstance(e, httpx.HTTPError):
+                observe_upstream_error(chat_completion_payload['model'], in_flight.replica.id, type(e).__name__)
+            await send({'type': 'http.response.body', 'body': b''})
+            return False
+        finally:
+            if response is not None:
+                await response.aclose()
+            if flight is not None:
+                # The followers see the stream end early if it didn't complete
+                flight.finish(error=None if completed else FLIGHT_ABORTED)
+
+        await send({'type': 'http.response.body', 'body': b''})
+        return True
+
+    disconnected, relayed = await run_until_disconnect(receive, relay_stream())
+    if disconnected:
+        logger.info(f"Client disconnected from the stream of replica {in_flight.replica.id}, aborting it.")
+        observe_client_disconnect(chat_completion_payload['model'])
+        await asyncio.to_thread(in_flight.release)
+        return
+    if not relayed:
+        return
+
+    if buffer is not None:
+        await asyncio.to_thread(store_cached_response, flask_app, cache_key, bytes(buffer))
+
+    await record_async_metrics(
+        flask_app,
+        usage_data=relay.usage,
+        api_key_id=str(api_key_id),
+        input_data=chat_completion_payload,
+        response_choices=await asyncio.to_thread(relay.choices) if store_payload else None,
+        start_time=start_time,
+        retries=retries,
+        replica_id=in_flight.replica.id,
+        token_debit=token_debit,
+        latency=timer.get_metrics(relay.usage),
+    )
+
+
+async def handle_async_cached_request(
+    flask_app: Flask,
+    send: ASGISend,
+    api_key_id: int,
+    start_time: float,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    raw: bool,
+    cached: bytes,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+):
+    """
+    Send a chat completion from the response cache and update the metrics, recording the cache hit.
+    """
+    body, mimetype, usage_data, response_choices = await asyncio.to_thread(
+        replay_cached_response, chat_completion_payload, raw, cached, should_store_payload(flask_app.config)
+    )
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': encode_headers({'Content-Type': get_content_type(mimetype, 'utf-8'), **(headers or {})}),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+    await record_async_metrics(
+        flask_app,
+        usage_data=usage_data,
+        api_key_id=str(api_key_id),
+        input_data=chat_completion_payload,
+        response_choices=response_choices,
+        start_time=start_time,
+        cache_hit=True,
+    )
+
+
+async def handle_async_coalesced_request(
+    flask_app: Flask,
+    send: ASGISend,
+    api_key_id: int,
+    start_time: float,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    raw: bool,
+    flight: Flight,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+):
+    """
+    Send a chat completion from the flight of an identical request in progress instead of sending it to a replica,
+    relaying the streamed chunks as they are received, then update the metrics.
+    """
+    store_payload = should_store_payload(flask_app.config)
+    chunks = flight.aiter()
+    if not chat_completion_payload['stream']:
+        body = b''.join([chunk async for chunk in chunks])
+        if flight.error:
+            await send_error(send, *flight.error)
+            return
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': encode_headers({'Content-Type': 'application/json', **(headers or {})}),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        json_response = json.loads(body)
+        await record_async_metrics(
+            flask_app,
+            usage_data=json_response.get('usage', {}),
+            api_key_id=str(api_key_id),
+            input_data=chat_completion_payload,
+            response_choices=json_response['choices'] if store_payload else None,
+            start_time=start_time,
+        )
+        return
+
+    relay = SSERelay(raw=raw, keep_payloads=store_payload)
+    started = False
+    async for chunk in chunks:
+        if not started:
+            await send_stream_start(send, headers)
+            started = True
+        if data := relay.feed(chunk):
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    if not started:
+        # The error of a flight that failed before its first chunk can still be returned
+        if flight.error:
+            await send_error(send, *flight.error)
+            return
+        await send_stream_start(send, headers)
+    if not flight.error and (data := relay.close()):
+        await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+    if not flight.error:
+        await record_async_metrics(
+            flask_app,
+            usage_data=relay.usage,
+            api_key_id=str(api_key_id),
+            input_data=chat_completion_payload,
+            response_choices=await asyncio.to_thread(relay.choices) if store_payload else None,
+            start_time=start_time,
+        )
@@ -0,0 +1,192 @@
+"""Validation and execution of the chat completion requests of a batch (see the `run_batch` worker task)."""
+
+import json
+import time
+import uuid
+import typing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from tables.api_key import APIKeyPriority
+from utils.upstream import RetryPolicy
+
+# Endpoints a batch can target, and their path in the API of the backend
+BATCH_ENDPOINTS = {
+    '/v1/chat/completions': '/chat/completions',
+}
+
+# Completion windows of the batches, in seconds
+COMPLETION_WINDOWS = {
+    '24h': 24 * 60 * 60,
+}
+
+# Responses of the backend worth sending the request again for: rate limited, timed out in the admission queue or no
+# replica available for now
+RETRYABLE_STATUS_CODES = (429, 502, 503)
+
+# Invalid lines reported for an input file, beyond which the others are only counted
+MAX_INPUT_ERRORS = 100
+
+# Output lines of a batch appended to its output and error files at once, at most
+OUTPUT_CHUNK_SIZE = 1000
+
+
+def make_batch_error(
+    code: str, message: str, line: typing.Optional[int] = None, param: typing.Optional[str] = None
+) -> typing.Dict[str, typing.Any]:
+    return {"code": code, "message": message, "param": param, "line": line}
+
+
+def parse_batch_input(
+    content: str, endpoint: str, max_requests: int
+) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.List[typing.Dict[str, typing.Any]]]:
+    """
+    Returns the requests of a JSONL batch input file, and the errors of its invalid lines. Every line is a request
+    object with a unique `custom_id`, the `POST` method, the `url` of the endpoint of the batch and a `body`.
+    """
+    batch_requests = []
+    errors = []
+    custom_ids = set()
+    invalid_lines = 0
+    for line, text in enumerate(content.splitlines(), start=1):
+        if not text.strip():
+            continue
+
+        try:
+            batch_request = json.loads(text)
+        except ValueError:
+            batch_request = None
+        if not isinstance(batch_request, dict):
+            error = make_batch_error("invalid_json_line", "This line is not parseable as a JSON object.", line)
+        elif not isinstance(batch_request.get("custom_id"), str) or not batch_request["custom_id"]:
+            error = make_batch_error("missing_required_parameter", "Missing `custom_id`.", line, "custom_id")
+        elif batch_request["custom_id"] in custom_ids:
+            error = make_batch_error(
+                "duplicate_custom_id", "The `custom_id` is used by another line.", line, "custom_id"
+            )
+        elif batch_request.get("method") != "POST":
+            error = make_batch_error("invalid_method", "The `method` must be `POST`.", line, "method")
+        elif batch_request.get("url") != endpoint:
+            error = make_batch_error("mismatched_endpoint", f"The `url` must be `{endpoint}`.", line, "url")
+        elif not isinstance(batch_request.get("body"), dict) or not batch_request["body"].get("model"):
+            error = make_batch_error("invalid_request", "The `body` must be an object with a `model`.", line, "body")
+        else:
+            custom_ids.add(batch_request["custom_id"])
+            batch_requests.append(batch_request)
+            continue
+
+        invalid_lines += 1
+        if len(errors) < MAX_INPUT_ERRORS:
+            errors.append(error)
+
+    if invalid_lines > len(errors):
+        errors.append(make_batch_error("invalid_lines", f"{invalid_lines} lines of the input file are invalid."))
+    if not batch_requests and not errors:
+        errors.append(make_batch_error("empty_file", "The input file has no requests."))
+    if len(batch_requests) > max_requests:
+        errors.append(
+            make_batch_error("too_many_requests", f"A batch can have at most {max_requests} requests.")
+        )
+    return batch_requests, errors
+
+
+def make_batch_output(
+    custom_id: str,
+    response: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    error: typing.Optional[typing.Dict[str, typing.Any]] = None,
+) -> typing.Dict[str, typing.Any]:
+    return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": response, "error": error}
+
+
+class BatchRequestSender:
+    """
+    Sends the requests of a batch to the API of the backend with the API key of the batch, so that they go through
+    the admission of online requests (rate limits, token quotas, routing and metrics) at the batch priority.
+
+    Requests rejected for now (see `RETRYABLE_STATUS_CODES`) or failing to connect are retried after the
+    `Retry-After` of the response, or a jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        retry_policy: RetryPolicy,
+        timeout: float,
+        session: requests.Session = None,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.retry_policy = retry_policy
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def send(self, batch_request: typing.Dict[str, typing.Any]) -> typing.Tuple[typing.Dict[str, typing.Any], bool]:
+        """
+        Returns the output line of the request, and whether it succeeded.
+        """
+        url = f"{self.base_url}{BATCH_ENDPOINTS[batch_request['url']]}"
+        body = {**batch_request["body"], "stream": False, "priority": APIKeyPriority.BATCH}
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+
+        response = error = None
+        delay = 0
+        for retry in range(self.retry_policy.retries + 1):
+            time.sleep(delay)
+            try:
+                response = self.session.post(url, json=body, headers=headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                response, error = None, e
+                delay = self.retry_policy.get_backoff(retry + 1)
+                continue
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                break
+            delay = max(self.retry_policy.get_backoff(retry + 1), float(response.headers.get("Retry-After") or 0))
+
+        if response is None:
+            output = make_batch_output(
+                batch_request["custom_id"], error={"code": "request_failed", "message": str(error)}
+            )
+            return output, False
+
+        try:
+            response_body = response.json()
+        except ValueError:
+            response_body = {"error": response.text}
+        output = make_batch_output(
+            batch_request["custom_id"],
+            response={
+                "status_code": response.status_code,
+                "request_id": uuid.uuid4().hex,
+                "body": response_body,
+            },
+        )
+        return output, response.status_code == 200
+
+
+def run_concurrently(
+    func: typing.Callable[[typing.Any], typing.Any],
+    items: typing.Iterable[typing.Any],
+    concurrency: int,
+    should_stop: typing.Callable[[], bool] = None,
+) -> typing.Iterator[typing.Tuple[int, typing.Any]]:
+    """
+    Yields the index and the result of `func` for each of the items as they complete, running at most `concurrency`
+    of them at once. No item is started once `should_stop` returns True, the ones in progress are still yielded.
+    """
+    items = enumerate(items)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            while len(pending) < concurrency and not (should_stop and should_stop()):
+                item = next(items, None)
+                if item is None:
+                    break
+                pending[executor.submit(func, item[1])] = item[0]
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
@@ -0,0 +1,217 @@
+"""In-process caches for the lookups on the chat completions hot path."""
+
+import os
+import time
+import typing
+import logging
+import threading
+import collections
+
+from flask import current_app as app
+
+from utils.db import db
+from utils.redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries expire `ttl` seconds after being set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key: typing.Any, default: typing.Any = None) -> typing.Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: typing.Any, value: typing.Any):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CachedAPIKey(typing.NamedTuple):
+    id: int
+    user_id: str
+    api_key: str
+    allowed_rpm: int
+    allowed_tpm: typing.Optional[int]
+    daily_token_budget: typing.Optional[int]
+    priority: str
+    enabled: bool
+
+
+class CachedModel(typing.NamedTuple):
+    id: int
+    name: str
+
+
+class CachedReplica(typing.NamedTuple):
+    id: int
+    model_id: int
+    endpoint: str
+    rate_limit: int
+    vm_status: str
+
+
+def snapshot(cls: typing.Type[typing.NamedTuple], instance: typing.Any) -> typing.NamedTuple:
+    """
+    Copy the cached fields of a database row, so that it can outlive the session it was loaded with.
+    """
+    return cls(**{field: getattr(instance, field) for field in cls._fields})
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_listener_pid = None
+
+
+def get_cache(name: str) -> TTLCache:
+    """
+    Returns the named process-wide cache, creating it from the app config on first use.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = TTLCache(
+                maxsize=app.config['LOOKUP_CACHE_MAXSIZE'], ttl=app.config['LOOKUP_CACHE_TTL']
+            )
+    _ensure_invalidation_listener()
+    return _caches[name]
+
+
+def cached(name: str, key: typing.Any, loader: typing.Callable[[], typing.Any]) -> typing.Any:
+    """
+    Returns the cached value for `key`, loading and caching it on a miss. Misses are cached too.
+    """
+    if app.config['LOOKUP_CACHE_TTL'] <= 0:
+        return loader()
+
+    cache = get_cache(name)
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = loader()
+        cache.set(key, value)
+    return value
+
+
+def clear_caches(*names: str):
+    """
+    Clear the given caches of this process, or all of them when no name is given.
+    """
+    with _caches_lock:
+        caches = [_caches[name] for name in names if name in _caches] if names else list(_caches.values())
+    for cache in caches:
+        cache.clear()
+
+
+def publish_cache_invalidation(client, *names: str):
+    """
+    Ask every process subscribed to the invalidation channel to clear the given caches.
+    """
+    try:
+        client.publish(INVALIDATION_CHANNEL, ",".join(names))
+    except Exception:
+        logger.exception(f"Failed to publish cache invalidation for: {names}")
+
+
+def invalidate_caches(*names: str):
+    """
+    Clear the given caches in this process and in every other worker.
+    """
+    clear_caches(*names)
+    publish_cache_invalidation(get_redis_client(), *names)
+
+
+def _listen_for_invalidations(client):
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                data = message["data"]
+                names = data.decode("utf-8") if isinstance(data, bytes) else data
+                clear_caches(*names.split(","))
+        except Exception:
+            logger.exception("Cache invalidation listener failed, clearing caches and reconnecting.")
+            clear_caches()
+            time.sleep(1)
+
+
+def _ensure_invalidation_listener():
+    """
+    Start the invalidation listener thread once per process, including after a fork.
+    """
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _caches_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    thread = threading.Thread(
+        target=_listen_for_invalidations, args=(get_redis_client(),), name="cache-invalidation", daemon=True
+    )
+    thread.start()
+
+
+def get_api_key_by_value(api_key: str) -> typing.Optional[CachedAPIKey]:
+    """
+    Returns the API key matching the given key value.
+    """
+    from tables.api_key import APIKey
+
+    def load():
+        key = db.session.query(APIKey).filter_by(api_key=api_key).first()
+        return snapshot(CachedAPIKey, key) if key else None
+
+    return cached("api_key", api_key, load)
+
+
+def get_model_by_name(name: str) -> typing.Optional[CachedModel]:
+    """
+    Returns the LLM model with the given name.
+    """
+    from tables.llm_model import LLMModel
+
+    def load():
+        model = db.session.query(LLMModel).filter_by(name=name).one_or_none()
+        return snapshot(CachedModel, model) if model else None
+
+    return cached("model", name, load)
+
+
+def get_model_replicas(model_id: int) -> typing.List[CachedReplica]:
+    """
+    Returns all the replicas of the given model, whatever their status.
+    """
+    from tables.replicas import Replica
+
+    def load():
+        replicas = db.session.query(Replica).filter_by(model_id=model_id).all()
+        return [snapshot(CachedReplica, replica) for replica in replicas]
+
+    return cached("replicas", model_id, load)
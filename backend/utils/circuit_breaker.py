@@ -0,0 +1,184 @@
+"""Circuit breaking of the replicas, consulted when routing the requests."""
+
+import time
+import typing
+import logging
+
+from flask import current_app as app
+
+from utils.redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+# Let a request through an open circuit once it has been open for `open_seconds`, moving it to half-open. The same
+# applies to a half-open circuit whose trial request never reported back. Returns 1 if the request is allowed.
+CIRCUIT_ALLOW_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state then
+    return 1
+end
+
+local now = tonumber(ARGV[1])
+local open_seconds = tonumber(ARGV[2])
+local changed_at = tonumber(redis.call('HGET', KEYS[1], 'changed_at') or '0')
+if now - changed_at < open_seconds then
+    return 0
+end
+
+redis.call('HSET', KEYS[1], 'state', 'half_open', 'changed_at', now)
+return 1
+"""
+
+# Record the outcome of a request (or of a health probe) and move the circuit to its next state, returns the state.
+# Outcomes are counted in a fixed window; the circuit opens once the error rate over at least `min_requests` requests
+# reaches `error_rate`, or after `probe_failures` consecutive failed probes.
+CIRCUIT_RECORD_SCRIPT = """
+local success = ARGV[1] == '1'
+local probe = ARGV[2] == '1'
+local now = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local min_requests = tonumber(ARGV[5])
+local error_rate = tonumber(ARGV[6])
+local probe_failures = tonumber(ARGV[7])
+local open_seconds = tonumber(ARGV[8])
+
+local function open()
+    redis.call('HSET', KEYS[1], 'state', 'open', 'changed_at', now)
+    redis.call('DEL', KEYS[2])
+    return 'open'
+end
+
+local state = redis.call('HGET', KEYS[1], 'state')
+if state then
+    local changed_at = tonumber(redis.call('HGET', KEYS[1], 'changed_at') or '0')
+    if success then
+        if state == 'half_open' or (probe and now - changed_at >= open_seconds) then
+            redis.call('DEL', KEYS[1], KEYS[2])
+            return 'closed'
+        end
+        return state
+    end
+    if state == 'half_open' or probe then
+        return open()
+    end
+    return state
+end
+
+if probe then
+    if success then
+        redis.call('HDEL', KEYS[2], 'probe_failures')
+        return 'closed'
+    end
+    local failures = redis.call('HINCRBY', KEYS[2], 'probe_failures', 1)
+    redis.call('EXPIRE', KEYS[2], window)
+    if failures >= probe_failures then
+        return open()
+    end
+    return 'closed'
+end
+
+redis.call('HINCRBY', KEYS[2], success and 'successes' or 'errors', 1)
+if redis.call('TTL', KEYS[2]) < 0 then
+    redis.call('EXPIRE', KEYS[2], window)
+end
+if success then
+    return 'closed'
+end
+
+local successes = tonumber(redis.call('HGET', KEYS[2], 'successes') or '0')
+local errors = tonumber(redis.call('HGET', KEYS[2], 'errors') or '0')
+if successes + errors >= min_requests and errors / (successes + errors) >= error_rate then
+    return open()
+end
+return 'closed'
+"""
+
+
+class ReplicaCircuitBreaker:
+    """
+    A class to stop routing requests to failing replicas, shared across workers through Redis.
+
+    A circuit is closed while its replica is healthy. It opens when the error rate of the proxied requests (errors
+    being connection failures, timeouts, 5xx responses and, optionally, slow responses) gets too high, or when the
+    replica fails its health probes. An open circuit rejects requests for `CIRCUIT_BREAKER_OPEN_SECONDS`, then lets a
+    single trial request through (half-open): the circuit closes if it succeeds and opens again otherwise. A
+    successful health probe also closes a circuit that has been open long enough.
+    """
+
+    def __init__(self, client=None, config: typing.Mapping[str, typing.Any] = None):
+        config = config if config is not None else app.config
+        self.client = client or get_redis_client()
+        self.window = config['CIRCUIT_BREAKER_WINDOW']
+        self.min_requests = config['CIRCUIT_BREAKER_MIN_REQUESTS']
+        self.error_rate = config['CIRCUIT_BREAKER_ERROR_RATE']
+        self.open_seconds = config['CIRCUIT_BREAKER_OPEN_SECONDS']
+        self.slow_call_seconds = config['CIRCUIT_BREAKER_SLOW_CALL_SECONDS']
+        self.probe_failures = config['CIRCUIT_BREAKER_PROBE_FAILURES']
+        self.allow_script = self.client.register_script(CIRCUIT_ALLOW_SCRIPT)
+        self.record_script = self.client.register_script(CIRCUIT_RECORD_SCRIPT)
+
+    @staticmethod
+    def make_key(replica_id: int) -> str:
+        return f"replica_circuit:{replica_id}"
+
+    @staticmethod
+    def make_stats_key(replica_id: int) -> str:
+        return f"replica_circuit_stats:{replica_id}"
+
+    def get_states(self, replica_ids: typing.List[int]) -> typing.Dict[int, str]:
+        pipe = self.client.pipeline()
+        for replica_id in replica_ids:
+            pipe.hget(self.make_key(replica_id), 'state')
+        states = pipe.execute()
+        return {
+            replica_id: state.decode('utf-8') if state else CircuitState.CLOSED
+            for replica_id, state in zip(replica_ids, states)
+        }
+
+    def available(self, replicas: typing.List[typing.Any]) -> typing.List[typing.Any]:
+        """
+        Returns the replicas whose circuit lets a request through.
+        """
+        states = self.get_states([replica.id for replica in replicas])
+        now = time.time()
+        return [
+            replica
+            for replica in replicas
+            if states[replica.id] == CircuitState.CLOSED
+            or self.allow_script(keys=[self.make_key(replica.id)], args=[now, self.open_seconds])
+        ]
+
+    def record(self, replica_id: int, success: bool, duration: float = None, probe: bool = False) -> str:
+        """
+        Record the outcome of a request proxied to the replica, or of a health probe, returns the circuit state.
+        """
+        if success and duration is not None and 0 < self.slow_call_seconds <= duration:
+            success = False
+        try:
+            state = self.record_script(
+                keys=[self.make_key(replica_id), self.make_stats_key(replica_id)],
+                args=[
+                    int(success),
+                    int(probe),
+                    time.time(),
+                    self.window,
+                    self.min_requests,
+                    self.error_rate,
+                    self.probe_failures,
+                    self.open_seconds,
+                ],
+            )
+        except Exception:
+            logger.exception(f"Failed to record the outcome of a request to replica {replica_id}.")
+            return CircuitState.CLOSED
+        state = state.decode('utf-8') if isinstance(state, bytes) else state
+        if state != CircuitState.CLOSED:
+            logger.warning(f"Circuit of replica {replica_id} is {state}.")
+        return state
@@ -0,0 +1,77 @@
+"""Latency breakdown of the streamed chat completions, recorded along with their metrics."""
+
+import time
+import typing
+
+# Metric columns of the latency breakdown
+LATENCY_METRICS = (
+    'upstream_connect_time',
+    'time_to_first_token',
+    'time_per_output_token',
+    'proxy_overhead',
+    'chunk_count',
+)
+
+
+class StreamTimer:
+    """
+    A class timing a streamed chat completion, from the arrival of the request (`start_time`) to the end of the
+    stream:
+
+    - `upstream_connect_time`: from sending the request to the replica to receiving the headers of its response, for
+      the attempt that got a response (see `send_upstream_request`).
+    - `time_to_first_token`: from the arrival of the request to the first chunk of the completion, i.e. the admission,
+      the queuing and the prefill of the prompt by the replica.
+    - `time_per_output_token`: between the first and the last chunk of the completion, per completion token after the
+      first one, i.e. the decode speed of the replica.
+    - `proxy_overhead`: the time of the request not spent waiting on the replica, from the arrival of the request to
+      its sending (admission, routing and the backoff of retries) and after the last chunk of the completion.
+    - `chunk_count`: the number of chunks of the completion relayed to the client.
+    """
+
+    def __init__(self, start_time: float):
+        self.start_time = start_time
+        self.request_time = None
+        self.headers_time = None
+        self.first_chunk_time = None
+        self.last_chunk_time = None
+        self.chunks = 0
+
+    def request_sent(self):
+        self.request_time = time.time()
+        self.headers_time = None
+
+    def headers_received(self):
+        self.headers_time = time.time()
+
+    def observe(self, chunks: int):
+        """
+        Record the number of chunks relayed so far, timing the first and the last one.
+        """
+        if chunks <= self.chunks:
+            return
+        now = time.time()
+        if self.first_chunk_time is None:
+            self.first_chunk_time = now
+        self.last_chunk_time = now
+        self.chunks = chunks
+
+    def get_metrics(self, usage_data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        """
+        Returns the latency metrics of the stream, once over. Metrics that can't be measured are None, e.g. the time
+        per output token of a completion of a single token, or without usage data.
+        """
+        end_time = time.time()
+        metrics = {**dict.fromkeys(LATENCY_METRICS), 'chunk_count': self.chunks}
+        if self.request_time is not None and self.headers_time is not None:
+            metrics['upstream_connect_time'] = self.headers_time - self.request_time
+        if self.first_chunk_time is None:
+            return metrics
+
+        metrics['time_to_first_token'] = self.first_chunk_time - self.start_time
+        completion_tokens = usage_data.get('completion_tokens') or 0
+        if completion_tokens > 1:
+            metrics['time_per_output_token'] = (self.last_chunk_time - self.first_chunk_time) / (completion_tokens - 1)
+        if self.request_time is not None:
+            metrics['proxy_overhead'] = (end_time - self.start_time) - (self.last_chunk_time - self.request_time)
+        return metrics
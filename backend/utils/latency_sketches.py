@@ -0,0 +1,212 @@
+"""
+Latency percentiles of the chat completions per model, replica and API key, served by the `/latency` endpoint.
+
+Every worker process adds the latencies of its completions to quantile sketches in memory (see `LatencySketches`),
+and flushes them to Redis every `LATENCY_SKETCH_FLUSH_INTERVAL` seconds. In Redis, a sketch is a hash of its bins per
+time bucket of `LATENCY_SKETCH_BUCKET_SECONDS`, so that the sketches of every worker are merged by `HINCRBY` as they
+are flushed, and the sketches of a window by adding the bins of its buckets when queried.
+"""
+
+import os
+import math
+import time
+import typing
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from flask import Flask, current_app as app
+
+from utils.redis import get_redis_client
+from utils.sketches import DDSketch
+
+logger = logging.getLogger(__name__)
+
+# Field of the hash of a sketch counting its zero values, the others being its bins
+ZERO_FIELD = 'zero'
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+
+class LatencyMetric:
+    DURATION = 'duration'
+    TIME_TO_FIRST_TOKEN = 'time_to_first_token'
+    OUTPUT_TOKENS_PER_SECOND = 'output_tokens_per_second'
+
+    CHOICES = [DURATION, TIME_TO_FIRST_TOKEN, OUTPUT_TOKENS_PER_SECOND]
+
+
+class SketchDimension:
+    MODEL = 'model'
+    REPLICA = 'replica'
+    API_KEY = 'api_key'
+
+    CHOICES = [MODEL, REPLICA, API_KEY]
+
+
+def make_sketch_key(bucket: int, dimension: str, value: str, metric: str) -> str:
+    return f"latency_sketch:{bucket}:{dimension}:{value}:{metric}"
+
+
+def make_index_key(bucket: int) -> str:
+    """
+    Returns the key of the set of the `dimension:value` pairs with sketches in a bucket.
+    """
+    return f"latency_sketch_index:{bucket}"
+
+
+class LatencySketches:
+    """
+    A class aggregating the latencies of the chat completions of a worker process in sketches per time bucket,
+    dimension and metric, until they are flushed to Redis.
+
+    Latencies are flushed when recorded once `flush_interval` seconds have passed since the previous flush, and when
+    the process exits. The sketches in Redis expire `ttl` seconds after the end of their bucket.
+    """
+
+    def __init__(
+        self,
+        flask_app: Flask,
+        relative_accuracy: float,
+        bucket_seconds: int,
+        ttl: int,
+        flush_interval: float,
+    ):
+        self.app = flask_app
+        self.relative_accuracy = relative_accuracy
+        self.bucket_seconds = bucket_seconds
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.sketches: typing.Dict[typing.Tuple[int, str, str, str], DDSketch] = {}
+        self.flushed_at = time.monotonic()
+
+    def get_bucket(self, at: float) -> int:
+        return int(at) - int(at) % self.bucket_seconds
+
+    def record(
+        self,
+        latencies: typing.Dict[str, typing.Optional[float]],
+        dimensions: typing.Dict[str, typing.Optional[typing.Any]],
+        at: typing.Optional[float] = None,
+    ):
+        """
+        Add the `latencies` of a completion (see `LatencyMetric`) to the sketches of each of its `dimensions` (see
+        `SketchDimension`). Latencies and dimensions that are None are left out.
+        """
+        bucket = self.get_bucket(at if at is not None else time.time())
+        with self.lock:
+            for dimension, value in dimensions.items():
+                if value is None:
+                    continue
+                for metric, latency in latencies.items():
+                    if latency is None:
+                        continue
+                    key = (bucket, dimension, str(value), metric)
+                    if key not in self.sketches:
+                        self.sketches[key] = DDSketch(self.relative_accuracy)
+                    self.sketches[key].add(latency)
+            flush = time.monotonic() - self.flushed_at >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Merge the sketches into their sketches in Redis. Sketches that fail to be flushed are dropped.
+        """
+        with self.lock:
+            sketches, self.sketches = self.sketches, {}
+            self.flushed_at = time.monotonic()
+        if not sketches:
+            return
+
+        try:
+            with self.app.app_context():
+                pipe = get_redis_client().pipeline(transaction=False)
+                for (bucket, dimension, value, metric), sketch in sketches.items():
+                    key = make_sketch_key(bucket, dimension, value, metric)
+                    expire_at = bucket + self.bucket_seconds + self.ttl
+                    for index, count in sketch.bins.items():
+                        pipe.hincrby(key, str(index), count)
+                    if sketch.zero_count:
+                        pipe.hincrby(key, ZERO_FIELD, sketch.zero_count)
+                    pipe.expireat(key, expire_at)
+                    pipe.sadd(make_index_key(bucket), f"{dimension}:{value}")
+                    pipe.expireat(make_index_key(bucket), expire_at)
+                pipe.execute()
+        except Exception:
+            logger.exception(f"[LatencySketches] Failed to flush {len(sketches)} sketches.")
+
+
+def query_latency_sketches(
+    client: typing.Any,
+    dimension: str,
+    start: float,
+    end: float,
+    bucket_seconds: int,
+    relative_accuracy: float,
+    value: typing.Optional[str] = None,
+) -> typing.Dict[str, typing.Dict[str, DDSketch]]:
+    """
+    Returns the sketches of every metric per value of `dimension` (or only of `value`), merged over the buckets from
+    `start` to `end`.
+    """
+    # The buckets starting before `end`, the current one included when `end` is within its first second
+    buckets = list(range(int(start) - int(start) % bucket_seconds, math.ceil(end), bucket_seconds))
+    pipe = client.pipeline(transaction=False)
+    for bucket in buckets:
+        pipe.smembers(make_index_key(bucket))
+    prefix = f"{dimension}:"
+    keys = []
+    for bucket, members in zip(buckets, pipe.execute()):
+        for member in members:
+            member = member.decode('utf-8')
+            if member.startswith(prefix) and (value is None or member[len(prefix):] == value):
+                keys.extend((bucket, member[len(prefix):], metric) for metric in LatencyMetric.CHOICES)
+
+    pipe = client.pipeline(transaction=False)
+    for bucket, member_value, metric in keys:
+        pipe.hgetall(make_sketch_key(bucket, dimension, member_value, metric))
+    sketches = defaultdict(dict)
+    for (bucket, member_value, metric), fields in zip(keys, pipe.execute()):
+        if not fields:
+            continue
+        sketch = sketches[member_value].setdefault(metric, DDSketch(relative_accuracy))
+        for field, count in fields.items():
+            field = field.decode('utf-8')
+            if field == ZERO_FIELD:
+                sketch.zero_count += int(count)
+            else:
+                sketch.bins[int(field)] = sketch.bins.get(int(field), 0) + int(count)
+    return sketches
+
+
+def summarize_sketch(sketch: typing.Optional[DDSketch]) -> typing.Dict[str, typing.Any]:
+    if sketch is None:
+        return {'count': 0, **dict.fromkeys(QUANTILES)}
+    return {'count': sketch.count, **{name: sketch.quantile(q) for name, q in QUANTILES.items()}}
+
+
+_sketches = None
+_sketches_pid = None
+_sketches_lock = threading.Lock()
+
+
+def get_latency_sketches() -> LatencySketches:
+    """
+    Returns the latency sketches of this process, created on first use (including after a fork).
+    """
+    global _sketches, _sketches_pid
+    if _sketches_pid != os.getpid():
+        with _sketches_lock:
+            if _sketches_pid != os.getpid():
+                _sketches = LatencySketches(
+                    flask_app=app._get_current_object(),
+                    relative_accuracy=app.config['METRICS_SKETCH_RELATIVE_ACCURACY'],
+                    bucket_seconds=app.config['LATENCY_SKETCH_BUCKET_SECONDS'],
+                    ttl=app.config['LATENCY_SKETCH_TTL'],
+                    flush_interval=app.config['LATENCY_SKETCH_FLUSH_INTERVAL'],
+                )
+                atexit.register(_sketches.flush)
+                _sketches_pid = os.getpid()
+    return _sketches
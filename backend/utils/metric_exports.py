@@ -0,0 +1,151 @@
+"""
+Streaming exports of the metric table as NDJSON, CSV or Parquet, served by the `/metrics/export` endpoint.
+
+The rows are read through a server-side cursor in batches of `METRICS_EXPORT_BATCH_SIZE` and encoded one batch at a
+time, so that exporting millions of rows only holds a batch in memory. Parquet files get a row group per batch, and
+need `pyarrow`, imported on first use.
+"""
+
+import io
+import csv
+import json
+import typing
+
+from sqlalchemy import BigInteger, Boolean, Column, Float, Integer, LargeBinary, select
+from sqlalchemy.engine import Engine
+
+from tables.metrics import Metric
+from utils.rest import serialize_row
+
+# Query parameters of the exports that aren't filters (see `utils.table_queries`)
+EXPORT_ARGS = ('format', 'fields')
+# Columns exported by default, the payloads of the completions being left out
+DEFAULT_EXPORT_COLUMNS = tuple(
+    column.name for column in Metric.__table__.columns if column.name not in ('input', 'choices', 'payload')
+)
+
+
+class ExportFormat:
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+    PARQUET = 'parquet'
+
+    CHOICES = [NDJSON, CSV, PARQUET]
+    MIMETYPES = {
+        NDJSON: 'application/x-ndjson',
+        CSV: 'text/csv',
+        PARQUET: 'application/vnd.apache.parquet',
+    }
+
+
+def iter_metric_batches(
+    engine: Engine, columns: typing.List[Column], filters: typing.List[typing.Any], batch_size: int
+) -> typing.Iterator[typing.List[typing.Any]]:
+    """
+    Yields the rows of the metric table matching `filters` by ascending ID, in batches of `batch_size` rows read
+    through a server-side cursor.
+    """
+    query = select(*columns).where(*filters).order_by(Metric.id)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        for partition in result.partitions():
+            yield partition
+
+
+def encode_ndjson(
+    keys: typing.List[str], batches: typing.Iterable[typing.List[typing.Any]]
+) -> typing.Iterator[bytes]:
+    for batch in batches:
+        yield ''.join(
+            json.dumps(serialize_row(keys, row), separators=(',', ':')) + '\n' for row in batch
+        ).encode('utf-8')
+
+
+def encode_csv(keys: typing.List[str], batches: typing.Iterable[typing.List[typing.Any]]) -> typing.Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(keys)
+    for batch in batches:
+        writer.writerows(serialize_row(keys, row).values() for row in batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class ChunkSink:
+    """
+    A writable file collecting the bytes written by the Parquet writer until they are taken.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def get_arrow_type(column: Column) -> typing.Any:
+    import pyarrow as pa
+
+    if isinstance(column.type, (Integer, BigInteger)):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    if isinstance(column.type, LargeBinary):
+        return pa.binary()
+    return pa.string()
+
+
+def encode_parquet(
+    columns: typing.List[Column], batches: typing.Iterable[typing.List[typing.Any]]
+) -> typing.Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column.name, get_arrow_type(column)) for column in columns])
+    sink = ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='zstd') as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist([dict(zip(schema.names, row)) for row in batch], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def export_metrics(
+    engine: Engine,
+    export_format: str,
+    columns: typing.List[Column],
+    filters: typing.List[typing.Any],
+    batch_size: int,
+) -> typing.Iterator[bytes]:
+    """
+    Yields the rows of the metric table matching `filters` encoded in `export_format`, a batch at a time.
+    """
+    batches = iter_metric_batches(engine, columns, filters, batch_size)
+    keys = [column.name for column in columns]
+    if export_format == ExportFormat.PARQUET:
+        return encode_parquet(columns, batches)
+    if export_format == ExportFormat.CSV:
+        return encode_csv(keys, batches)
+    return encode_ndjson(keys, batches)
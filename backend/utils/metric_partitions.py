@@ -0,0 +1,175 @@
+"""
+Monthly range partitioning and retention of the metric table.
+
+On MySQL, the metric table can be partitioned by month of `created` (see `partition_metric_table`, run once with
+`flask partition-metrics`), so that the retention task drops the partitions past `METRICS_RETENTION_DAYS` instead of
+deleting their rows. MySQL doesn't support foreign keys on partitioned tables, and requires the partitioning column in
+every unique key: the foreign key of `api_key_id` is dropped and the primary key becomes `(id, created)`.
+
+Tables that aren't partitioned have their old rows deleted in batches instead (see `delete_old_metrics`).
+"""
+
+import calendar
+import datetime
+import logging
+import typing
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger(__name__)
+
+METRIC_TABLE = 'metric'
+# Partition of the rows created after the last monthly partition, split as months go by
+FUTURE_PARTITION = 'pfuture'
+
+
+def month_start(at: float) -> datetime.date:
+    return datetime.datetime.fromtimestamp(at, datetime.timezone.utc).date().replace(day=1)
+
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def get_timestamp(month: datetime.date) -> int:
+    return calendar.timegm(month.timetuple())
+
+
+def make_monthly_partitions(first_month: datetime.date, last_month: datetime.date) -> typing.List[str]:
+    """
+    Returns the definitions of the monthly partitions from `first_month` to `last_month` included, each one holding
+    the rows created before the start of the following month.
+    """
+    partitions = []
+    month = first_month
+    while month <= last_month:
+        partitions.append(
+            f"PARTITION p{month:%Y%m} VALUES LESS THAN ({get_timestamp(add_months(month, 1))})"
+        )
+        month = add_months(month, 1)
+    return partitions
+
+
+def get_metric_partitions(connection: Connection) -> typing.List[typing.Tuple[str, typing.Optional[int]]]:
+    """
+    Returns the partitions of the metric table with the upper bound of their `created`, in order. The bound of the
+    future partition is None, and a table that isn't partitioned has no partitions.
+    """
+    if connection.dialect.name != 'mysql':
+        return []
+
+    rows = connection.execute(
+        text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        ),
+        {"table": METRIC_TABLE},
+    )
+    return [(name, None if bound == 'MAXVALUE' else int(bound)) for name, bound in rows]
+
+
+def partition_metric_table(connection: Connection, now: float, months_ahead: int):
+    """
+    Partition the metric table by month of `created`, from the month of its oldest row to `months_ahead` months
+    after the current one. This rebuilds the table, and is meant to be run once during a maintenance window.
+    """
+    if connection.dialect.name != 'mysql':
+        raise RuntimeError("Partitioning the metric table is only supported on MySQL.")
+    if get_metric_partitions(connection):
+        logger.info("The metric table is already partitioned.")
+        return
+
+    for foreign_key in inspect(connection).get_foreign_keys(METRIC_TABLE):
+        connection.execute(text(f"ALTER TABLE {METRIC_TABLE} DROP FOREIGN KEY {foreign_key['name']}"))
+
+    oldest = connection.execute(text(f"SELECT MIN(created) FROM {METRIC_TABLE}")).scalar()
+    current_month = month_start(now)
+    partitions = make_monthly_partitions(
+        month_start(oldest) if oldest is not None else current_month, add_months(current_month, months_ahead)
+    )
+    partitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    connection.execute(
+        text(
+            f"ALTER TABLE {METRIC_TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (id, created), "
+            f"PARTITION BY RANGE (created) ({', '.join(partitions)})"
+        )
+    )
+
+
+def add_metric_partitions(
+    connection: Connection,
+    partitions: typing.List[typing.Tuple[str, typing.Optional[int]]],
+    now: float,
+    months_ahead: int,
+) -> int:
+    """
+    Split the future partition into the monthly partitions missing until `months_ahead` months after the current
+    one, returns the number of partitions added. The future partition is empty as long as this runs often enough, so
+    splitting it doesn't move any row.
+    """
+    bounds = [bound for _, bound in partitions if bound is not None]
+    if not bounds:
+        return 0
+
+    # The last monthly partition holds the rows created before the start of the month following it
+    first_month = month_start(max(bounds))
+    new_partitions = make_monthly_partitions(first_month, add_months(month_start(now), months_ahead))
+    if not new_partitions:
+        return 0
+
+    new_partitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    connection.execute(
+        text(
+            f"ALTER TABLE {METRIC_TABLE} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(new_partitions)})"
+        )
+    )
+    return len(new_partitions) - 1
+
+
+def drop_metric_partitions(
+    connection: Connection,
+    partitions: typing.List[typing.Tuple[str, typing.Optional[int]]],
+    before: float,
+) -> typing.List[str]:
+    """
+    Drop the partitions only holding rows created before `before`, returns their names. The last monthly partition
+    is always kept, as MySQL can't drop every partition of a table.
+    """
+    expired = [name for name, bound in partitions[:-2] if bound is not None and bound <= before]
+    if expired:
+        connection.execute(text(f"ALTER TABLE {METRIC_TABLE} DROP PARTITION {', '.join(expired)}"))
+    return expired
+
+
+def delete_old_metrics(connection: Connection, before: float, batch_size: int) -> int:
+    """
+    Delete the rows of the metric table created before `before` in batches of `batch_size` rows, committing each
+    batch, returns the number of rows deleted.
+
+    As the ids grow with `created`, the old rows are the ones below the id of the oldest row to keep: finding it only
+    reads the rows to delete, and each batch is then a range of the primary key.
+    """
+    boundary = connection.execute(
+        text(f"SELECT id FROM {METRIC_TABLE} WHERE created >= :before ORDER BY id LIMIT 1"),
+        {"before": int(before)},
+    ).scalar()
+    condition = "created < :before" if boundary is None else "id < :boundary AND created < :before"
+
+    deleted = 0
+    while True:
+        ids = connection.execute(
+            text(f"SELECT id FROM {METRIC_TABLE} WHERE {condition} ORDER BY id LIMIT :limit"),
+            {"before": int(before), "boundary": boundary, "limit": batch_size},
+        ).scalars().all()
+        if not ids:
+            return deleted
+
+        connection.execute(
+            text(f"DELETE FROM {METRIC_TABLE} WHERE id >= :first AND id <= :last AND created < :before"),
+            {"first": ids[0], "last": ids[-1], "before": int(before)},
+        )
+        connection.commit()
+        deleted += len(ids)
@@ -0,0 +1,147 @@
+"""Storage of the request and response payloads of the chat completions in the metric table."""
+
+import json
+import random
+import typing
+import hashlib
+
+import zstandard
+
+# Columns of the metric table holding the payloads
+PAYLOAD_COLUMNS = ('input', 'choices', 'payload', 'input_hash')
+
+
+class PayloadMode:
+    """
+    How the payloads of the chat completions are stored in their metrics (`METRICS_PAYLOAD_MODE`):
+
+    - `full`: the request and the final choices of the completion as compact JSON, in the `input` and `choices`
+      columns.
+    - `compressed`: both in a single zstd-compressed JSON document, in the `payload` column.
+    - `hash`: only the SHA-256 of the request, in the `input_hash` column.
+    - `off`: nothing.
+
+    The hash of the request is stored by every mode but `off`, so that repeated requests can be found.
+    """
+
+    FULL = 'full'
+    COMPRESSED = 'compressed'
+    HASH = 'hash'
+    OFF = 'off'
+
+    CHOICES = [FULL, COMPRESSED, HASH, OFF]
+
+
+def dump_json(data: typing.Any) -> str:
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+def hash_input(input_data: typing.Dict[str, typing.Any]) -> str:
+    """
+    Returns the SHA-256 of a request, independent of the order of its keys.
+    """
+    return hashlib.sha256(json.dumps(input_data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def merge_tool_calls(tool_calls: typing.List[typing.Dict[str, typing.Any]], deltas: typing.List[typing.Any]):
+    """
+    Merge the deltas of the tool calls of a streamed choice, the arguments of a call being streamed in pieces.
+    """
+    for delta in deltas or ():
+        index = delta.get('index', len(tool_calls))
+        while len(tool_calls) <= index:
+            tool_calls.append({'function': {'arguments': ''}})
+        tool_call = tool_calls[index]
+        for key, value in delta.items():
+            if key == 'function':
+                function = tool_call['function']
+                function['arguments'] += (value or {}).get('arguments') or ''
+                if (value or {}).get('name'):
+                    function['name'] = value['name']
+            elif key != 'index' and value is not None:
+                tool_call[key] = value
+
+
+def assemble_choices(choices: typing.List[typing.Dict[str, typing.Any]]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Returns the final choices of a completion. The choices of a streamed completion, one per chunk, are merged into
+    a message per choice: the pieces of its content are joined and the deltas of its tool calls merged. The choices
+    of a completion that wasn't streamed are returned as is.
+    """
+    if not any('delta' in choice for choice in choices):
+        return choices
+
+    assembled = {}
+    for choice in choices:
+        index = choice.get('index', 0)
+        final = assembled.setdefault(index, {'index': index, 'message': {}, 'finish_reason': None})
+        message = final['message']
+        for key, value in (choice.get('delta') or {}).items():
+            if key == 'tool_calls':
+                merge_tool_calls(message.setdefault('tool_calls', []), value)
+            elif isinstance(value, str) and key != 'role':
+                message[key] = message.get(key, '') + value
+            elif value is not None:
+                message[key] = value
+        if choice.get('finish_reason') is not None:
+            final['finish_reason'] = choice['finish_reason']
+    return [assembled[index] for index in sorted(assembled)]
+
+
+def compress_payload(payload: typing.Dict[str, typing.Any], level: int = 3) -> bytes:
+    return zstandard.ZstdCompressor(level=level).compress(dump_json(payload).encode('utf-8'))
+
+
+def decompress_payload(data: bytes) -> typing.Dict[str, typing.Any]:
+    """
+    Returns the payload of a metric stored by the `compressed` mode, i.e. its `input` and `choices`.
+    """
+    return json.loads(zstandard.ZstdDecompressor().decompress(data))
+
+
+def validate_payload_mode(mode: str):
+    """
+    Raises ValueError if `mode` isn't a supported mode, so that a typo in `METRICS_PAYLOAD_MODE` fails at startup.
+    """
+    if mode not in PayloadMode.CHOICES:
+        raise ValueError(f"METRICS_PAYLOAD_MODE must be one of {', '.join(PayloadMode.CHOICES)}, not {mode!r}.")
+
+
+def should_store_payload(config: typing.Mapping[str, typing.Any]) -> bool:
+    """
+    Whether the response of a chat completion is stored in its metric, decided before the response is read so that
+    the choices of the completions that won't be stored are never decoded. With a `METRICS_PAYLOAD_SAMPLE_RATE` below
+    1, only that fraction of the completions store their payload.
+    """
+    return (
+        config['METRICS_PAYLOAD_MODE'] in (PayloadMode.FULL, PayloadMode.COMPRESSED)
+        and random.random() < config['METRICS_PAYLOAD_SAMPLE_RATE']
+    )
+
+
+def make_payload_columns(
+    input_data: typing.Dict[str, typing.Any],
+    response_choices: typing.Optional[typing.List[typing.Dict[str, typing.Any]]],
+    mode: str = PayloadMode.FULL,
+    compression_level: int = 3,
+) -> typing.Dict[str, typing.Any]:
+    """
+    Returns the payload columns of the metric of a chat completion for the given `mode` (see `PayloadMode`). Without
+    `response_choices`, i.e. for the completions left out by `should_store_payload`, only the hash of the request is
+    stored.
+    """
+    columns = dict.fromkeys(PAYLOAD_COLUMNS)
+    if mode == PayloadMode.OFF:
+        return columns
+
+    columns['input_hash'] = hash_input(input_data)
+    if mode == PayloadMode.HASH or response_choices is None:
+        return columns
+
+    choices = assemble_choices(response_choices)
+    if mode == PayloadMode.COMPRESSED:
+        columns['payload'] = compress_payload({'input': input_data, 'choices': choices}, compression_level)
+    else:
+        columns['input'] = dump_json(input_data)
+        columns['choices'] = dump_json(choices)
+    return columns
@@ -0,0 +1,137 @@
+"""Batched, asynchronous writes of the metrics table."""
+
+import os
+import time
+import queue
+import typing
+import atexit
+import logging
+import threading
+
+from flask import Flask, current_app as app
+
+from tables.metrics import Metric
+from utils.db import session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsWriter:
+    """
+    A class to write metric rows from a background thread.
+
+    Rows are buffered in a bounded in-memory queue and flushed with a single multi-row INSERT every `batch_size` rows
+    or `flush_interval` seconds, whichever comes first. When the queue is full, producers wait up to `put_timeout`
+    seconds before the row is dropped and counted, so that a slow database never stalls the requests.
+    """
+
+    def __init__(
+        self,
+        flask_app: Flask,
+        batch_size: int,
+        flush_interval: float,
+        max_queue_size: int,
+        put_timeout: float,
+    ):
+        self.app = flask_app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.lock = threading.Lock()
+        self.counters = {"submitted": 0, "written": 0, "dropped": 0, "failed": 0}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, metric_data: typing.Dict[str, typing.Any]) -> bool:
+        """
+        Queue a metric row to be written, returns False if the row had to be dropped.
+        """
+        try:
+            self.queue.put(metric_data, timeout=self.put_timeout)
+        except queue.Full:
+            self._count("dropped")
+            logger.warning("[MetricsWriter] Queue is full, dropping metric.")
+            return False
+        self._count("submitted")
+        return True
+
+    def flush(self):
+        """
+        Synchronously write every queued row.
+        """
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.lock:
+            return {**self.counters, "queued": self.queue.qsize()}
+
+    def _count(self, counter: str, value: int = 1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def _drain(self, limit: int) -> typing.List[typing.Dict[str, typing.Any]]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch: typing.List[typing.Dict[str, typing.Any]]):
+        try:
+            with self.app.app_context(), session_scope() as session:
+                Metric.bulk_create(session, batch)
+        except Exception:
+            self._count("failed", len(batch))
+            logger.exception(f"[MetricsWriter] Failed to write {len(batch)} metrics.")
+        else:
+            self._count("written", len(batch))
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_metrics_writer() -> MetricsWriter:
+    """
+    Returns the metrics writer of this process, starting it on first use (including after a fork).
+    """
+    global _writer, _writer_pid
+    if _writer_pid != os.getpid():
+        with _writer_lock:
+            if _writer_pid != os.getpid():
+                _writer = MetricsWriter(
+                    flask_app=app._get_current_object(),
+                    batch_size=app.config['METRICS_BATCH_SIZE'],
+                    flush_interval=app.config['METRICS_FLUSH_INTERVAL_MS'] / 1000,
+                    max_queue_size=app.config['METRICS_QUEUE_MAXSIZE'],
+                    put_timeout=app.config['METRICS_QUEUE_PUT_TIMEOUT_MS'] / 1000,
+                )
+                _writer.start()
+                _writer_pid = os.getpid()
+    return _writer
@@ -0,0 +1,188 @@
+"""
+Prometheus metrics of the proxy, exposed by the `/metrics` endpoint.
+
+Under gunicorn, every worker process has metrics of its own. When `PROMETHEUS_MULTIPROC_DIR` is set (see
+`scripts/entrypoint-prod.sh`), the metrics are written to memory-mapped files in that directory and `/metrics`
+aggregates the samples of every worker, whichever worker serves the scrape. The directory must be emptied before
+gunicorn starts, and the files of dead workers are marked as such by the `child_exit` hook of `gunicorn.conf.py`.
+"""
+
+import os
+import time
+import typing
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Buckets of the durations of whole requests, up to the 15 minutes timeout of the workers
+REQUEST_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900)
+# Buckets of the durations of the calls to the database and Redis
+CALL_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# Statements of the database calls, any other one is counted as `OTHER`
+DB_OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+REQUEST_DURATION = Histogram(
+    'llm_proxy_request_duration_seconds',
+    'Duration of the chat completions, from the arrival of the request to the end of the response.',
+    ['model', 'stream', 'cache_hit'],
+    buckets=REQUEST_DURATION_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    'llm_proxy_time_to_first_token_seconds',
+    'Time from the arrival of a streamed chat completion request to the first chunk of its completion.',
+    ['model'],
+    buckets=REQUEST_DURATION_BUCKETS,
+)
+OUTPUT_TOKENS_PER_SECOND = Histogram(
+    'llm_proxy_output_tokens_per_second',
+    'Completion tokens of the chat completions per second of their duration.',
+    ['model'],
+    buckets=(1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000),
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    'llm_proxy_in_flight_requests',
+    'Chat completion requests routed to a replica of the model and not completed yet.',
+    ['model'],
+    multiprocess_mode='livesum',
+)
+REPLICA_IN_FLIGHT_REQUESTS = Gauge(
+    'llm_proxy_replica_in_flight_requests',
+    'Chat completion requests sent to the replica and not completed yet.',
+    ['model', 'replica'],
+    multiprocess_mode='livesum',
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    'llm_proxy_rate_limit_rejections',
+    'Chat completion requests rejected by a rate limit, a token quota or the admission queue.',
+    ['limit'],
+)
+UPSTREAM_ERRORS = Counter(
+    'llm_proxy_upstream_errors',
+    'Failed requests to the replicas, by HTTP status of their response or type of error, retries included.',
+    ['model', 'replica', 'error'],
+)
+CLIENT_DISCONNECTS = Counter(
+    'llm_proxy_client_disconnects',
+    'Streamed chat completions aborted by the client disconnecting before their end.',
+    ['model'],
+)
+DB_QUERY_DURATION = Histogram(
+    'llm_proxy_db_query_duration_seconds',
+    'Duration of the database queries.',
+    ['operation'],
+    buckets=CALL_DURATION_BUCKETS,
+)
+REDIS_COMMAND_DURATION = Histogram(
+    'llm_proxy_redis_command_duration_seconds',
+    'Duration of the Redis commands, pipelines counted as a single `PIPELINE` command.',
+    ['command'],
+    buckets=CALL_DURATION_BUCKETS,
+)
+
+
+class RateLimit:
+    API_KEY = 'api_key'
+    TOKEN_QUOTA = 'token_quota'
+    REPLICA = 'replica'
+    ADMISSION_QUEUE = 'admission_queue'
+
+    CHOICES = [API_KEY, TOKEN_QUOTA, REPLICA, ADMISSION_QUEUE]
+
+
+def observe_completion(
+    model: str,
+    stream: bool,
+    cache_hit: bool,
+    duration: float,
+    completion_tokens: typing.Optional[int] = None,
+    time_to_first_token: typing.Optional[float] = None,
+):
+    """
+    Record a chat completion sent back to the client. Responses served from the response cache don't count towards
+    the throughput of the model, as they don't reach a replica.
+    """
+    REQUEST_DURATION.labels(model=model, stream=str(bool(stream)).lower(), cache_hit=str(cache_hit).lower()).observe(
+        duration
+    )
+    if time_to_first_token is not None:
+        TIME_TO_FIRST_TOKEN.labels(model=model).observe(time_to_first_token)
+    if not cache_hit and completion_tokens and completion_tokens > 0 and duration > 0:
+        OUTPUT_TOKENS_PER_SECOND.labels(model=model).observe(completion_tokens / duration)
+
+
+def observe_upstream_error(model: str, replica_id: int, error: typing.Union[int, str]):
+    """
+    Record a failed request to a replica, `error` being the HTTP status of its response or the type of the exception.
+    """
+    UPSTREAM_ERRORS.labels(model=model, replica=str(replica_id), error=str(error)).inc()
+
+
+def observe_client_disconnect(model: str):
+    CLIENT_DISCONNECTS.labels(model=model).inc()
+
+
+def observe_rate_limit_rejection(limit: str):
+    RATE_LIMIT_REJECTIONS.labels(limit=limit).inc()
+
+
+def track_in_flight(model: str, replica_id: typing.Optional[int], delta: int):
+    """
+    Update the in-flight gauges of the model, or of one of its replicas if `replica_id` is given.
+    """
+    if replica_id is None:
+        IN_FLIGHT_REQUESTS.labels(model=model).inc(delta)
+    else:
+        REPLICA_IN_FLIGHT_REQUESTS.labels(model=model, replica=str(replica_id)).inc(delta)
+
+
+def observe_redis_command(command: str, duration: float):
+    REDIS_COMMAND_DURATION.labels(command=command.upper()).observe(duration)
+
+
+def get_db_operation(statement: str) -> str:
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return operation if operation in DB_OPERATIONS else 'OTHER'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context rather than the connection, so that nothing is left behind by failing queries
+    if context is not None:
+        context._query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = getattr(context, '_query_start_time', None)
+    if start_time is not None:
+        DB_QUERY_DURATION.labels(operation=get_db_operation(statement)).observe(time.perf_counter() - start_time)
+
+
+def instrument_sqlalchemy():
+    """
+    Time the queries of every SQLAlchemy engine of the process.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def generate_metrics() -> typing.Tuple[bytes, str]:
+    """
+    Returns the metrics in the Prometheus text format and its content type, aggregated across the worker processes
+    in multiprocess mode.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,11 +1,13 @@
+import math
 import time
+import typing
 import logging
 import functools
 
-from flask import request, jsonify
+from flask import Response, g, request, jsonify
 
-from tables.api_key import APIKey
-from utils.db import db
+from utils.cache import CachedAPIKey, get_api_key_by_value
+from utils.prometheus import RateLimit, observe_rate_limit_rejection
 from utils.redis import get_redis_client
 from utils.rest import get_api_key
 
@@ -16,37 +18,295 @@ class RateLimitExceeded(Exception):
     """
     Exception class for rate limit exceeded errors.
     """
-    def __init__(self, allowed_rpm):
+    def __init__(self, allowed_rpm, retry_after=None):
         self.allowed_rpm = allowed_rpm
+        self.retry_after = retry_after
         super().__init__()
 
 
+class ReplicaRateLimitExceeded(Exception):
+    """
+    Exception class for when every replica of a model is at its rate limit.
+    """
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__()
+
+
+# Sliding window counter evaluated atomically in Redis. The request rate is estimated as the count of the current
+# fixed window plus the count of the previous one weighted by how much of it still overlaps the sliding window.
+# Returns {allowed, remaining, retry_after} where retry_after is in seconds.
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local elapsed = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local estimated = previous * (window - elapsed) / window + current
+
+if estimated + cost > limit then
+    local retry_after = window - elapsed
+    if current + cost <= limit and previous > 0 then
+        retry_after = retry_after - (limit - current - cost) * window / previous
+    end
+    return {0, math.max(0, math.floor(limit - estimated)), math.max(1, math.ceil(retry_after))}
+end
+
+redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], window * 2)
+return {1, math.floor(limit - estimated - cost), math.ceil(window - elapsed)}
+"""
+
+
+# Fixed budget over the lifetime of a key (e.g. a day), evaluated atomically in Redis. Returns {allowed, remaining}.
+TOKEN_BUDGET_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used + cost > limit then
+    return {0, math.max(0, limit - used)}
+end
+
+redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], ttl)
+return {1, limit - used - cost}
+"""
+
+# Adjust a counter unless it already expired, so that a late adjustment doesn't recreate it without a TTL.
+ADJUST_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class RateLimitResult(typing.NamedTuple):
+    allowed: bool
+    # None without a limit
+    remaining: typing.Optional[int]
+    retry_after: int
+
+
+class SlidingWindowRateLimiter:
+    """
+    A class to enforce a limit per sliding window on any identifier, shared across workers through Redis.
+    """
+    def __init__(self, prefix: str, window: int = 60, client=None):
+        self.prefix = prefix
+        self.window = window
+        self.client = client or get_redis_client()
+        self.script = self.client.register_script(SLIDING_WINDOW_SCRIPT)
+        self.adjust_script = self.client.register_script(ADJUST_SCRIPT)
+
+    def make_key(self, identifier: typing.Any, window: int) -> str:
+        return f"{self.prefix}:{identifier}:{window}"
+
+    def hit(self, identifier: typing.Any, limit: int, cost: int = 1) -> RateLimitResult:
+        now = time.time()
+        current_window = int(now // self.window)
+        keys = [self.make_key(identifier, current_window), self.make_key(identifier, current_window - 1)]
+        allowed, remaining, retry_after = self.script(
+            keys=keys, args=[limit, self.window, now - current_window * self.window, cost]
+        )
+        return RateLimitResult(bool(allowed), int(remaining), int(retry_after))
+
+    def adjust(self, identifier: typing.Any, delta: int, at: float):
+        """
+        Correct the cost counted by a hit made at time `at`.
+        """
+        self.adjust_script(keys=[self.make_key(identifier, int(at // self.window))], args=[delta])
+
+
+class ReplicaRateLimitManager:
+    """
+    A class to admit requests on a replica according to its requests per minute `rate_limit`.
+    Replicas without a rate limit are always admitted.
+    """
+    def __init__(self, client=None):
+        self.limiter = SlidingWindowRateLimiter("replica_rate_limit", window=60, client=client)
+
+    def admit(self, replica) -> RateLimitResult:
+        if not replica.rate_limit or replica.rate_limit <= 0:
+            return RateLimitResult(True, None, 0)
+        return self.limiter.hit(replica.id, replica.rate_limit)
+
+
 class APIKeyRateLimitManager:
     """
     A class to manage requests rate limits for an API key.
     """
-    def __init__(self, api_key: APIKey):
+    def __init__(self, api_key: CachedAPIKey, client=None):
         self.api_key_obj = api_key
-        self.client = get_redis_client()
+        self.limiter = SlidingWindowRateLimiter("rate_limit", window=60, client=client)
+
+    def hit(self) -> RateLimitResult:
+        """
+        Count a request against the API key rate limit, unless it is exceeded.
+        """
+        return self.limiter.hit(self.api_key_obj.id, self.api_key_obj.allowed_rpm)
+
+
+class TokenQuotaExceeded(Exception):
+    """
+    Exception class for when a request would exceed the token quota of its API key. Without `retry_after`, the request
+    alone exceeds the quota and can't be retried.
+    """
+    def __init__(self, limit, period, retry_after, tokens=None):
+        self.limit = limit
+        self.period = period
+        self.retry_after = retry_after
+        self.tokens = tokens
+        super().__init__()
+
+
+class TokenDebit(typing.NamedTuple):
+    """
+    The tokens pre-debited from the quotas of an API key at admission.
+    """
+    api_key_id: int
+    tokens: int
+    debited_at: float
+    per_minute: bool
+    per_day: bool
+
 
-    def make_key(self):
-        current_time = int(time.time())
-        return f"rate_limit:{self.api_key_obj.api_key}:{current_time // 60}"
+def estimate_request_tokens(payload: typing.Dict[str, typing.Any], default_max_tokens: int) -> int:
+    """
+    Estimate the tokens of a chat completion request: about 4 characters per prompt token, plus the completion tokens
+    it may generate.
+    """
+    characters = 0
+    for message in payload["messages"]:
+        content = message.get("content")
+        if isinstance(content, str):
+            characters += len(content)
+        elif isinstance(content, list):
+            characters += sum(len(item.get("text") or "") for item in content if isinstance(item, dict))
+    completion_tokens = (payload.get("max_tokens") or default_max_tokens) * payload.get("n", 1)
+    return math.ceil(characters / 4) + completion_tokens
+
+
+def estimate_default_completion_tokens(payload: typing.Dict[str, typing.Any], default_max_tokens: int) -> int:
+    """
+    Returns the completion tokens of the estimate of a request (see `estimate_request_tokens`) that come from the
+    default `max_tokens`, 0 if the request sets it.
+    """
+    if payload.get("max_tokens"):
+        return 0
+    return default_max_tokens * payload.get("n", 1)
+
+
+class TokenQuotaManager:
+    """
+    A class to manage the tokens per minute and daily token budget of API keys.
+
+    The estimated tokens of a request are debited at admission, and reconciled with the actual usage reported by the
+    LLM endpoint once the response is complete. Keys without token quotas are not tracked.
+    """
+    def __init__(self, client=None):
+        self.client = client or get_redis_client()
+        self.per_minute = SlidingWindowRateLimiter("token_rate_limit", window=60, client=self.client)
+        self.budget_script = self.client.register_script(TOKEN_BUDGET_SCRIPT)
+        self.adjust_script = self.client.register_script(ADJUST_SCRIPT)
+
+    @staticmethod
+    def make_budget_key(api_key_id: int, at: float) -> str:
+        return f"token_budget:{api_key_id}:{time.strftime('%Y%m%d', time.gmtime(at))}"
+
+    def get_remaining(self, api_key: CachedAPIKey, per_minute: bool, per_day: bool) -> float:
+        """
+        Returns the tokens left in the quotas of the API key, without debiting any.
+        """
+        remaining = math.inf
+        if per_minute:
+            remaining = self.per_minute.hit(api_key.id, api_key.allowed_tpm, cost=0).remaining
+        if per_day:
+            _, budget_remaining = self.budget_script(
+                keys=[self.make_budget_key(api_key.id, time.time())],
+                args=[api_key.daily_token_budget, 0, 60 * 60 * 48],
+            )
+            remaining = min(remaining, budget_remaining)
+        return remaining
+
+    def debit(
+        self, api_key: CachedAPIKey, tokens: int, default_completion_tokens: int = 0
+    ) -> typing.Optional[TokenDebit]:
+        """
+        Debit `tokens` from the quotas of the API key, raises TokenQuotaExceeded if either would be exceeded, without
+        a `retry_after` if the request exceeds the quota on its own.
+
+        The `default_completion_tokens` of the estimate, for requests without `max_tokens` (see
+        `estimate_default_completion_tokens`), are capped at the tokens left in the quotas instead, the debit being
+        settled with the actual usage anyway.
+        """
+        per_minute = bool(api_key.allowed_tpm and api_key.allowed_tpm > 0)
+        per_day = bool(api_key.daily_token_budget and api_key.daily_token_budget > 0)
+        if not per_minute and not per_day:
+            return None
+        requested_tokens = tokens - default_completion_tokens
+        if per_minute and requested_tokens > api_key.allowed_tpm:
+            raise TokenQuotaExceeded(api_key.allowed_tpm, "minute", None, requested_tokens)
+        if per_day and requested_tokens > api_key.daily_token_budget:
+            raise TokenQuotaExceeded(api_key.daily_token_budget, "day", None, requested_tokens)
+        if default_completion_tokens:
+            remaining = self.get_remaining(api_key, per_minute, per_day)
+            tokens = requested_tokens + max(0, min(default_completion_tokens, remaining - requested_tokens))
+
+        now = time.time()
+        if per_minute:
+            result = self.per_minute.hit(api_key.id, api_key.allowed_tpm, cost=tokens)
+            if not result.allowed:
+                raise TokenQuotaExceeded(api_key.allowed_tpm, "minute", result.retry_after)
+        if per_day:
+            allowed, _ = self.budget_script(
+                keys=[self.make_budget_key(api_key.id, now)],
+                args=[api_key.daily_token_budget, tokens, 60 * 60 * 48],
+            )
+            if not allowed:
+                if per_minute:
+                    self.per_minute.adjust(api_key.id, -tokens, now)
+                raise TokenQuotaExceeded(api_key.daily_token_budget, "day", math.ceil(86400 - now % 86400))
+        return TokenDebit(api_key.id, tokens, now, per_minute, per_day)
+
+    def settle(self, debit: TokenDebit, used_tokens: int):
+        """
+        Replace the estimated tokens of a debit with the tokens actually used, 0 refunds the debit.
+        """
+        delta = used_tokens - debit.tokens
+        if not delta:
+            return
+        try:
+            if debit.per_minute:
+                self.per_minute.adjust(debit.api_key_id, delta, debit.debited_at)
+            if debit.per_day:
+                self.adjust_script(keys=[self.make_budget_key(debit.api_key_id, debit.debited_at)], args=[delta])
+        except Exception:
+            logger.exception(f"Failed to settle the token quotas of API key {debit.api_key_id}.")
+
+
+def get_rate_limit_headers() -> typing.Dict[str, str]:
+    """
+    Returns the `X-RateLimit-*` headers of the API key rate limit checked for the current request, if any.
+    """
+    rate_limit = g.get("rate_limit")
+    if rate_limit is None:
+        return {}
+    allowed_rpm, result = rate_limit
+    return {
+        "X-RateLimit-Limit": str(allowed_rpm),
+        "X-RateLimit-Remaining": str(max(0, result.remaining)),
+        "X-RateLimit-Reset": str(result.retry_after),
+    }
 
-    def increment_usage(self):
-        key = self.make_key()
-        lock = self.client.lock(f"lock:{key}", timeout=10)
-        if lock.acquire(blocking=True):
-            try:
-                self.client.incr(key)
-                self.client.expire(key, 60 * 60 * 24)
-            finally:
-                lock.release()
 
-    def should_allow(self):
-        key = self.make_key()
-        count = self.client.get(key)
-        return int(count or 0) < self.api_key_obj.allowed_rpm
+def add_rate_limit_headers(response: Response) -> Response:
+    response.headers.update(get_rate_limit_headers())
+    return response
 
 
 def ensure_api_key_rate_limits(func):
@@ -59,14 +319,14 @@ def ensure_api_key_rate_limits(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         # try to retrieve api key from request headers
-        api_key = db.session.query(APIKey).filter_by(api_key=get_api_key(request)).first()
+        api_key = get_api_key_by_value(get_api_key(request))
         if api_key:
-            manager = APIKeyRateLimitManager(api_key=api_key)
-            if manager.should_allow():
-                manager.increment_usage()
-                return func(*args, **kwargs)
-            else:
-                raise RateLimitExceeded(api_key.allowed_rpm)
+            # The check and the increment are a single atomic script in Redis
+            result = APIKeyRateLimitManager(api_key=api_key).hit()
+            g.rate_limit = (api_key.allowed_rpm, result)
+            if not result.allowed:
+                raise RateLimitExceeded(api_key.allowed_rpm, result.retry_after)
+            return func(*args, **kwargs)
         else:
             logger.warning("[ensure_api_key_rate_limits] API Key is missing.")
             return func(*args, **kwargs)
@@ -77,10 +337,59 @@ def rate_limit_error_handler(error):
     """
     Error handler for RateLimitExceeded exception.
     """
+    observe_rate_limit_rejection(RateLimit.API_KEY)
     response = jsonify({
         "error": "rate_limit_exceeded",
         "message": f"Rate limit exceeded: allowed {error.allowed_rpm} requests per minute.",
         "allowed_rpm": error.allowed_rpm
     })
     response.status_code = 429
+    if error.retry_after is not None:
+        response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def token_quota_error_handler(error):
+    """
+    Error handler for TokenQuotaExceeded exception.
+    """
+    observe_rate_limit_rejection(RateLimit.TOKEN_QUOTA)
+    if error.retry_after is None:
+        response = jsonify({
+            "error": "request_exceeds_token_quota",
+            "message": (
+                f"Request exceeds the token quota of the API key: estimated {error.tokens} tokens, allowed "
+                f"{error.limit} tokens per {error.period}."
+            ),
+            "limit": error.limit,
+            "period": error.period,
+            "tokens": error.tokens,
+        })
+        response.status_code = 400
+        return response
+
+    response = jsonify({
+        "error": "token_quota_exceeded",
+        "message": f"Token quota exceeded: allowed {error.limit} tokens per {error.period}.",
+        "limit": error.limit,
+        "period": error.period,
+        "retry_after": error.retry_after
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def replica_rate_limit_error_handler(error):
+    """
+    Error handler for ReplicaRateLimitExceeded exception.
+    """
+    observe_rate_limit_rejection(RateLimit.REPLICA)
+    response = jsonify({
+        "error": "replica_rate_limit_exceeded",
+        "message": "All replicas for the model are at their rate limit.",
+        "retry_after": error.retry_after
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
     return response
@@ -1,16 +1,67 @@
+import time
+import threading
+
 import redis
+from redis.client import Pipeline
 
 from flask import current_app as app
 
+from utils.prometheus import observe_redis_command
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_redis_connection_pool(host: str, port: int, db: int) -> redis.ConnectionPool:
+    """
+    Returns the connection pool of this process for the given Redis database, so that clients reuse connections
+    instead of connecting on every request. redis-py resets the pool's connections after a fork.
+    """
+    with _pools_lock:
+        pool = _pools.get((host, port, db))
+        if pool is None:
+            pool = redis.ConnectionPool(host=host, port=port, db=db)
+            _pools[(host, port, db)] = pool
+    return pool
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    A Redis pipeline timing its executions (see `InstrumentedRedis`).
+    """
+
+    def execute(self, raise_on_error: bool = True):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            observe_redis_command('PIPELINE', time.perf_counter() - start_time)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    A Redis client timing its commands in the Prometheus metrics.
+    """
+
+    def execute_command(self, *args, **options):
+        start_time = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            observe_redis_command(str(args[0]).split(' ', 1)[0], time.perf_counter() - start_time)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
 
 def get_redis_client():
     """
     Returns a Redis client.
     """
-    return redis.Redis(
-        host=app.config['REDIS_HOST'],
-        port=app.config['REDIS_PORT'],
-        db=app.config['REDIS_DB']
+    return InstrumentedRedis(
+        connection_pool=get_redis_connection_pool(
+            app.config['REDIS_HOST'], app.config['REDIS_PORT'], app.config['REDIS_DB']
+        )
     )
 
 
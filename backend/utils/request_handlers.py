@@ -1,64 +1,161 @@
 import json
-import re
 import time
 import typing
+import logging
 
 import requests
-from flask import abort, Response, jsonify, stream_with_context
+from flask import Flask, abort, Response, jsonify, current_app as app
 from sqlalchemy.orm import Session
 
 from tables.metrics import Metric, MetricSchema
+from utils.circuit_breaker import ReplicaCircuitBreaker
+from utils.db import session_scope
+from utils.latency import LATENCY_METRICS, StreamTimer
+from utils.latency_sketches import LatencyMetric, SketchDimension, get_latency_sketches
+from utils.metric_payloads import make_payload_columns, should_store_payload
+from utils.metrics_writer import get_metrics_writer
+from utils.prometheus import observe_completion, observe_upstream_error
+from utils.rate_limits import TokenDebit, TokenQuotaManager
+from utils.response_cache import ResponseCache
+from utils.routing import InFlightRequest
+from utils.single_flight import FLIGHT_ABORTED, Flight
+from utils.sse import SSERelay
+from utils.upstream import RETRYABLE_STATUS_CODES, get_retry_policy, get_upstream_session, get_upstream_timeout
 
-RE_NORMALIZE = re.compile(r'\s*data\s*:\s*({.*)')
+logger = logging.getLogger(__name__)
+
+
+def send_upstream_request(
+    in_flight: InFlightRequest,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    stream: bool = False,
+    timer: typing.Optional[StreamTimer] = None,
+) -> typing.Tuple[requests.Response, int]:
+    """
+    Send the request to the replica it was routed to, returns the response and the number of retries it took.
+
+    Requests failing before any byte of the response was received (connection errors, 502 and 503 responses of
+    replicas being restarted) are sent again following the retry policy, failing over to another replica of the model
+    if there is one. The last failure is returned (or raised) once the retries are exhausted.
+
+    With a `timer`, the sending of every attempt and the headers of its response are timed.
+    """
+    circuit_breaker = ReplicaCircuitBreaker()
+    retry_policy = get_retry_policy()
+    timeout = get_upstream_timeout()
+    retries = 0
+    while True:
+        replica = in_flight.replica
+        request_time = time.time()
+        if timer is not None:
+            timer.request_sent()
+        try:
+            response = get_upstream_session(replica.endpoint).post(
+                replica.endpoint, json=chat_completion_payload, stream=stream, timeout=timeout
+            )
+            if timer is not None:
+                timer.headers_received()
+        except requests.exceptions.RequestException as e:
+            circuit_breaker.record(replica.id, False)
+            observe_upstream_error(chat_completion_payload['model'], replica.id, type(e).__name__)
+            if not isinstance(e, requests.exceptions.ConnectionError) or retries >= retry_policy.retries:
+                raise
+            logger.warning(f"Failed to connect to replica {replica.id}, retrying: {e}")
+        else:
+            circuit_breaker.record(replica.id, is_replica_healthy(response), time.time() - request_time)
+            if response.status_code >= 400:
+                observe_upstream_error(chat_completion_payload['model'], replica.id, response.status_code)
+            if response.status_code not in RETRYABLE_STATUS_CODES or retries >= retry_policy.retries:
+                return response, retries
+            logger.warning(f"Replica {replica.id} responded with {response.status_code}, retrying.")
+            response.close()
+
+        retries += 1
+        in_flight.failover()
+        time.sleep(retry_policy.get_backoff(retries))
+
+
+def describe_upstream_error(endpoint: str, e: Exception, response: typing.Optional[requests.Response]) -> str:
+    return (
+        f'Failed to receive response from LLM endpoint API ({endpoint}): '
+        f'{e} {response.text if response is not None else ""}'
+    )
+
+
+def abort_upstream_request(status_code: int, description: str, flight: typing.Optional[Flight] = None):
+    """
+    Abort the request with the error of the LLM endpoint API, failing the requests following its flight with it.
+    """
+    if flight is not None:
+        flight.finish(error=(status_code, description))
+    abort(status_code, description=description)
 
 
 def handle_non_streaming_request(
-    session: Session,
     api_key_id: int,
-    endpoint: str,
+    in_flight: InFlightRequest,
     start_time: int,
     chat_completion_payload: typing.Dict[str, typing.Any],
+    token_debit: typing.Optional[TokenDebit] = None,
+    cache_key: typing.Optional[str] = None,
+    flight: typing.Optional[Flight] = None,
 ) -> Response:
     """
     This function is responsible for handling non-streaming requests from the LLM endpoint API. This function is
     called when the `stream` parameter in the request is set to `False`. The function will update the metrics and
     return the response from the LLM endpoint API.
+
+    With a `cache_key`, the response is stored in the response cache. With a `flight`, it is published to the
+    identical requests following it.
     """
     response = None
+    retries = 0
     try:
-        response = requests.post(endpoint, json=chat_completion_payload)
+        response, retries = send_upstream_request(in_flight, chat_completion_payload)
         response.raise_for_status()
         json_response = response.json()
     except json.JSONDecodeError:
-        abort(
+        abort_upstream_request(
             500,
-            description=f'Failed to decode response from LLM endpoint API ({endpoint}): {response.text}',
+            f'Failed to decode response from LLM endpoint API ({in_flight.replica.endpoint}): {response.text}',
+            flight,
         )
     except requests.exceptions.RequestException as e:
-        abort(
+        abort_upstream_request(
             response.status_code if (response is not None and 400 <= response.status_code < 500) else 500,
-            description=f'Failed to receive response from LLM endpoint API ({endpoint}): '
-                        f'{e} {response.json() if response is not None else ""}',
+            describe_upstream_error(in_flight.replica.endpoint, e, response),
+            flight,
         )
 
-    update_metrics(
-        session=session,
+    if flight is not None:
+        flight.publish(response.content)
+        flight.finish()
+    if cache_key:
+        ResponseCache().set(cache_key, response.content)
+
+    record_metrics(
+        app._get_current_object(),
         usage_data=json_response.get('usage', {}),
         api_key_id=str(api_key_id),
         input_data=chat_completion_payload,
-        response_choices=json_response['choices'],
-        start_time=start_time
+        response_choices=json_response['choices'] if should_store_payload(app.config) else None,
+        start_time=start_time,
+        retries=retries,
+        replica_id=in_flight.replica.id,
+        token_debit=token_debit,
     )
     return jsonify(json_response)
 
 
 def handle_streaming_request(
-    session: Session,
     api_key_id: int,
-    endpoint: str,
+    in_flight: InFlightRequest,
     start_time: int,
     chat_completion_payload: typing.Dict[str, typing.Any],
     raw: bool,
+    token_debit: typing.Optional[TokenDebit] = None,
+    cache_key: typing.Optional[str] = None,
+    flight: typing.Optional[Flight] = None,
 ) -> Response:
     """
     This function is responsible for making sure a streaming response is returned to the client. How this is made
@@ -68,54 +165,226 @@ def handle_streaming_request(
     Finally, metrics are updated to account for the data that was streamed back to the client and an important point to
     note here is that the last response sent back by the LLM endpoint API is used to update the metrics as that
     contains usage data.
+
+    The request is sent before the response is returned, so that it can be retried on another replica and its errors
+    reported with a proper status code; nothing can be retried once the stream has started.
+
+    The generator runs outside of the request context and doesn't hold a database session while streaming: the
+    metrics are written in a unit of work of their own once the stream is over.
+
+    The response is framed incrementally with `SSERelay`, as network reads don't line up with the events: frames are
+    forwarded without being decoded, except for the one carrying the usage data.
+
+    With a `cache_key`, the stream is buffered and stored in the response cache once complete. With a `flight`, its
+    chunks are published to the identical requests following it.
     """
 
-    def stream_generator():
-        choices = []
-        last_response = {}
-        response = None
+    flask_app = app._get_current_object()
+    response_cache = ResponseCache() if cache_key else None
+    store_payload = should_store_payload(app.config)
+    timer = StreamTimer(start_time)
+    response = None
+    try:
+        response, retries = send_upstream_request(in_flight, chat_completion_payload, stream=True, timer=timer)
+        response.raise_for_status()  # Raise an error for bad status codes
+    except requests.exceptions.RequestException as e:
+        abort_upstream_request(
+            response.status_code if (response is not None and 400 <= response.status_code < 500) else 500,
+            describe_upstream_error(in_flight.replica.endpoint, e, response),
+            flight,
+        )
 
+    def stream_generator():
+        relay = SSERelay(raw=raw, keep_payloads=store_payload)
+        buffer = bytearray() if response_cache else None
+        completed = False
         try:
-            # Make a GET request to the external API with streaming enabled
-            response = requests.post(endpoint, json=chat_completion_payload, stream=True)
-            response.raise_for_status()  # Raise an error for bad status codes
             for chunk in response.iter_content(chunk_size=None):
-                chunk = chunk.decode('utf-8')
-                if chunk and (match := RE_NORMALIZE.match(chunk)):
-                    try:
-                        parsed_chunk = json.loads(match.group(1))
-                    except json.JSONDecodeError:
-                        abort(
-                            500,
-                            description=f'Failed to decode response from LLM endpoint API ({response.url}): {chunk}',
-                        )
-                    if parsed_chunk and parsed_chunk['choices']:
-                        if raw:
-                            yield chunk
-                        else:
-                            yield match.group(1) + '\n'
-                        last_response = parsed_chunk
-                        choices.extend(last_response['choices'])
+                if flight is not None:
+                    flight.publish(chunk)
+                if buffer is not None:
+                    buffer += chunk
+                    if len(buffer) > response_cache.max_entry_bytes:
+                        buffer = None
+                data = relay.feed(chunk)
+                timer.observe(relay.chunks)
+                if data:
+                    yield data
+            completed = True
+            if data := relay.close():
+                timer.observe(relay.chunks)
+                yield data
         except requests.exceptions.RequestException as e:
-            abort(
-                response.status_code if (response is not None and 400 <= response.status_code < 500) else 500,
-                description=f'Failed to receive response from LLM endpoint API ({endpoint}): '
-                            f'{e} {response.json() if response is not None else ""}',
-            )
+            # The response has started, the client only sees the stream end early
+            logger.exception(f"Stream from LLM endpoint API ({in_flight.replica.endpoint}) failed.")
+            observe_upstream_error(chat_completion_payload['model'], in_flight.replica.id, type(e).__name__)
+            refund_tokens(flask_app, token_debit)
+            return
+        finally:
+            response.close()
+            if flight is not None:
+                # The followers see the stream end early if it didn't complete
+                flight.finish(error=None if completed else FLIGHT_ABORTED)
+
+        if buffer is not None:
+            response_cache.set(cache_key, bytes(buffer))
 
         # Once streaming is done, update the metrics
-        update_metrics(
-            session=session,
-            usage_data=last_response.get('usage', {}),
+        record_metrics(
+            flask_app,
+            usage_data=relay.usage,
             api_key_id=str(api_key_id),
             input_data=chat_completion_payload,
-            response_choices=choices,
-            start_time=start_time
+            response_choices=relay.choices() if store_payload else None,
+            start_time=start_time,
+            retries=retries,
+            replica_id=in_flight.replica.id,
+            token_debit=token_debit,
+            latency=timer.get_metrics(relay.usage),
         )
 
-    return Response(
-        stream_with_context(stream_generator()), mimetype='text/event-stream'
+    return Response(stream_generator(), mimetype='text/event-stream')
+
+
+def replay_cached_response(
+    chat_completion_payload: typing.Dict[str, typing.Any], raw: bool, cached: bytes, store_payload: bool
+) -> typing.Tuple[bytes, str, typing.Dict[str, typing.Any], typing.Optional[list]]:
+    """
+    Returns the body and mimetype of a response served from the response cache, with its usage and choices (None
+    unless `store_payload`, see `should_store_payload`). Cached streams are replayed through `SSERelay`, as they would
+    be relayed from the LLM endpoint.
+    """
+    if chat_completion_payload['stream']:
+        relay = SSERelay(raw=raw, keep_payloads=store_payload)
+        body = relay.feed(cached) + relay.close()
+        return body, 'text/event-stream', relay.usage, relay.choices() if store_payload else None
+
+    json_response = json.loads(cached)
+    choices = json_response['choices'] if store_payload else None
+    return cached, 'application/json', json_response.get('usage', {}), choices
+
+
+def handle_cached_request(
+    api_key_id: int,
+    start_time: int,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    raw: bool,
+    cached: bytes,
+) -> Response:
+    """
+    Serve a chat completion from the response cache and update the metrics, recording the cache hit.
+    """
+    body, mimetype, usage_data, response_choices = replay_cached_response(
+        chat_completion_payload, raw, cached, should_store_payload(app.config)
+    )
+    record_metrics(
+        app._get_current_object(),
+        usage_data=usage_data,
+        api_key_id=str(api_key_id),
+        input_data=chat_completion_payload,
+        response_choices=response_choices,
+        start_time=start_time,
+        cache_hit=True,
     )
+    return Response(body, mimetype=mimetype)
+
+
+def handle_coalesced_request(
+    api_key_id: int,
+    start_time: int,
+    chat_completion_payload: typing.Dict[str, typing.Any],
+    raw: bool,
+    flight: Flight,
+) -> Response:
+    """
+    Serve a chat completion from the flight of an identical request in progress instead of sending it to a replica,
+    relaying the streamed chunks as they are received, then update the metrics.
+    """
+    flask_app = app._get_current_object()
+    store_payload = should_store_payload(app.config)
+    chunks = iter(flight)
+    if not chat_completion_payload['stream']:
+        body = b''.join(chunks)
+        if flight.error:
+            abort(flight.error[0], description=flight.error[1])
+        json_response = json.loads(body)
+        record_metrics(
+            flask_app,
+            usage_data=json_response.get('usage', {}),
+            api_key_id=str(api_key_id),
+            input_data=chat_completion_payload,
+            response_choices=json_response['choices'] if store_payload else None,
+            start_time=start_time,
+        )
+        return jsonify(json_response)
+
+    # Wait for the first chunk, the error of a flight that failed before can still be returned
+    first_chunk = next(chunks, None)
+    if first_chunk is None and flight.error:
+        abort(flight.error[0], description=flight.error[1])
+
+    def stream_generator():
+        relay = SSERelay(raw=raw, keep_payloads=store_payload)
+        if first_chunk is not None and (data := relay.feed(first_chunk)):
+            yield data
+        for chunk in chunks:
+            if data := relay.feed(chunk):
+                yield data
+        if flight.error:
+            return
+        if data := relay.close():
+            yield data
+
+        record_metrics(
+            flask_app,
+            usage_data=relay.usage,
+            api_key_id=str(api_key_id),
+            input_data=chat_completion_payload,
+            response_choices=relay.choices() if store_payload else None,
+            start_time=start_time,
+        )
+
+    return Response(stream_generator(), mimetype='text/event-stream')
+
+
+def store_cached_response(flask_app: Flask, cache_key: str, body: bytes):
+    """
+    Store a response in the response cache, from outside of the app context.
+    """
+    with flask_app.app_context():
+        ResponseCache().set(cache_key, body)
+
+
+def is_replica_healthy(response: typing.Any) -> bool:
+    """
+    Whether a response of a replica counts as a success for its circuit breaker, client errors do.
+    """
+    return response.status_code < 500
+
+
+def record_replica_outcome(flask_app: Flask, replica_id: int, success: bool, duration: float = None):
+    """
+    Record the outcome of a request to a replica in its circuit breaker, from outside of the app context.
+    """
+    with flask_app.app_context():
+        ReplicaCircuitBreaker().record(replica_id, success, duration)
+
+
+def refund_tokens(flask_app: Flask, token_debit: typing.Optional[TokenDebit]):
+    """
+    Refund the tokens debited from the API key quotas for a request that failed.
+    """
+    if token_debit is not None:
+        with flask_app.app_context():
+            TokenQuotaManager().settle(token_debit, 0)
+
+
+def record_metrics(flask_app: Flask, **metric_kwargs: typing.Any):
+    """
+    Update the metrics in a short-lived unit of work of its own, independent of the session of the request (if any).
+    """
+    with flask_app.app_context(), session_scope() as session:
+        update_metrics(session=session, **metric_kwargs)
 
 
 def update_metrics(
@@ -123,25 +392,82 @@ def update_metrics(
     usage_data: typing.Dict[str, typing.Any],
     api_key_id: str,
     input_data: typing.Dict[str, typing.Any],
-    response_choices: list,
-    start_time: float
+    response_choices: typing.Optional[list],
+    start_time: float,
+    retries: int = 0,
+    cache_hit: bool = False,
+    token_debit: typing.Optional[TokenDebit] = None,
+    latency: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    replica_id: typing.Optional[int] = None,
 ):
     """
-    Update the metrics table with the data from the completion request.
+    Update the metrics table with the data from the completion request. Unless `METRICS_ASYNC_WRITES` is disabled, the
+    metric is queued and written in a batch by the metrics writer instead of committing inline.
+
+    Streamed completions also record their `latency` breakdown (see `StreamTimer`), left empty for the others.
+
+    The latencies are also added to the latency sketches of the model, the API key and the `replica_id` that served
+    the completion, if any (see `utils.latency_sketches`).
+
+    The request and the final choices of the completion are stored depending on `METRICS_PAYLOAD_MODE` (see
+    `utils.metric_payloads`), `response_choices` being None for the completions whose choices aren't stored.
+
+    The tokens debited from the API key quotas at admission are reconciled with the usage reported by the LLM
+    endpoint. Without usage data (e.g. streams without `include_usage`), the estimate is kept.
     """
+    if token_debit is not None and 'total_tokens' in usage_data:
+        TokenQuotaManager().settle(token_debit, usage_data['total_tokens'])
+
+    duration = time.time() - start_time
+    observe_completion(
+        model=input_data['model'],
+        stream=input_data.get('stream', False),
+        cache_hit=cache_hit,
+        duration=duration,
+        completion_tokens=usage_data.get('completion_tokens'),
+        time_to_first_token=(latency or {}).get('time_to_first_token'),
+    )
+    completion_tokens = usage_data.get('completion_tokens') or 0
+    get_latency_sketches().record(
+        {
+            LatencyMetric.DURATION: duration,
+            LatencyMetric.TIME_TO_FIRST_TOKEN: (latency or {}).get('time_to_first_token'),
+            # Responses served from the response cache don't count towards the throughput of the model
+            LatencyMetric.OUTPUT_TOKENS_PER_SECOND: (
+                completion_tokens / duration if not cache_hit and completion_tokens > 0 and duration > 0 else None
+            ),
+        },
+        {
+            SketchDimension.MODEL: input_data['model'],
+            SketchDimension.REPLICA: replica_id,
+            SketchDimension.API_KEY: api_key_id,
+        },
+    )
+
     metric_payload = {
         'api_key_id': api_key_id,
-        'input': json.dumps(input_data, indent=2),
         'created': int(start_time),
         'model': input_data['model'],
-        'choices': str(response_choices),
         'prompt_tokens': usage_data.get('prompt_tokens', -999),
         'total_tokens': usage_data.get('total_tokens', -999),
         'completion_tokens': usage_data.get('completion_tokens', -999),
-        'duration': time.time() - start_time,
+        'duration': duration,
+        'retries': retries,
+        'cache_hit': cache_hit,
+        **dict.fromkeys(LATENCY_METRICS),
+        **(latency or {}),
+        **make_payload_columns(
+            input_data,
+            response_choices,
+            mode=app.config['METRICS_PAYLOAD_MODE'],
+            compression_level=app.config['METRICS_PAYLOAD_COMPRESSION_LEVEL'],
+        ),
     }
     metric_schema = MetricSchema(
         only=tuple(metric_payload.keys()),
     )
     metric_data = metric_schema.dump(metric_payload)
-    Metric.create(session, **metric_data)
+    if app.config['METRICS_ASYNC_WRITES']:
+        get_metrics_writer().submit(metric_data)
+    else:
+        Metric.create(session, **metric_data)
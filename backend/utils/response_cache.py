@@ -0,0 +1,100 @@
+"""Exact-match cache of the responses to deterministic chat completion requests."""
+
+import json
+import time
+import typing
+import hashlib
+import logging
+
+from flask import current_app as app
+
+from utils.redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Request parameters that don't change the generated response
+IGNORED_PARAMS = ('user',)
+
+# Store a response and index it by insertion time, then evict the expired entries from the index and the oldest
+# entries beyond `max_entries`.
+CACHE_SET_SCRIPT = """
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local max_entries = tonumber(ARGV[4])
+
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ttl)
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl)
+
+local excess = redis.call('ZCARD', KEYS[2]) - max_entries
+if excess > 0 then
+    local evicted = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(evicted))
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+end
+"""
+
+
+def is_deterministic(chat_completion_payload: typing.Dict[str, typing.Any]) -> bool:
+    """
+    Whether the request asks for a reproducible response, i.e. greedy sampling or a fixed seed.
+    """
+    return chat_completion_payload.get('temperature') == 0 or chat_completion_payload.get('seed') is not None
+
+
+def make_request_hash(chat_completion_payload: typing.Dict[str, typing.Any]) -> str:
+    """
+    Returns a hash of the canonical JSON of the request: model, messages and every sampling parameter.
+    """
+    canonical = json.dumps(
+        {key: value for key, value in chat_completion_payload.items() if key not in IGNORED_PARAMS},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    A cache of the responses to deterministic chat completion requests, shared across workers through Redis.
+
+    Entries are keyed by the hash of the request (see `make_request_hash`) and hold the response body of the LLM
+    endpoint as received: the JSON completion, or the SSE stream for streaming requests. Entries expire after
+    `RESPONSE_CACHE_TTL` seconds (0 disables the cache) and the oldest ones are evicted beyond
+    `RESPONSE_CACHE_MAX_ENTRIES`. Responses bigger than `RESPONSE_CACHE_MAX_ENTRY_BYTES` aren't cached.
+    """
+
+    INDEX_KEY = "response_cache_index"
+
+    def __init__(self, client=None, config: typing.Mapping[str, typing.Any] = None):
+        config = config if config is not None else app.config
+        self.ttl = config['RESPONSE_CACHE_TTL']
+        self.max_entries = config['RESPONSE_CACHE_MAX_ENTRIES']
+        self.max_entry_bytes = config['RESPONSE_CACHE_MAX_ENTRY_BYTES']
+        self.client = client or get_redis_client()
+        self.set_script = self.client.register_script(CACHE_SET_SCRIPT)
+
+    def make_key(self, chat_completion_payload: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+        """
+        Returns the cache key of the request, or None if its response isn't cacheable.
+        """
+        if self.ttl <= 0 or not is_deterministic(chat_completion_payload):
+            return None
+        return f"response_cache:{make_request_hash(chat_completion_payload)}"
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        try:
+            return self.client.get(key)
+        except Exception:
+            logger.exception("Failed to read the response cache.")
+            return None
+
+    def set(self, key: str, body: bytes):
+        if len(body) > self.max_entry_bytes:
+            return
+        try:
+            self.set_script(
+                keys=[key, self.INDEX_KEY], args=[body, time.time(), self.ttl, self.max_entries]
+            )
+        except Exception:
+            logger.exception("Failed to write the response cache.")
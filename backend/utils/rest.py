@@ -1,3 +1,4 @@
+import base64
 import logging
 from functools import wraps
 import os
@@ -6,8 +7,7 @@ import requests
 from flask import request, jsonify
 from marshmallow import ValidationError
 
-from utils.db import db
-from tables.api_key import APIKey
+from utils.cache import get_api_key_by_value
 
 
 logger = logging.getLogger(__name__)
@@ -61,7 +61,7 @@ def ensure_api_key(include_api_key=False):
             if not api_key:
                 return error_response
 
-            key = db.session.query(APIKey).filter_by(api_key=api_key).first()
+            key = get_api_key_by_value(api_key)
             if not key:
                 return error_response
 
@@ -111,3 +111,13 @@ def get_public_ip() -> str:
     else:
         public_ip = response_json.get("origin")
     return public_ip or "0.0.0.0/0"
+
+
+def serialize_row(keys, row) -> dict:
+    """
+    Returns a row of a table as a JSON serializable dict, binary values being base64 encoded.
+    """
+    return {
+        key: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value
+        for key, value in zip(keys, row)
+    }
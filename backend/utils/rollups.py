@@ -0,0 +1,244 @@
+"""
+Rollups of the metric table per minute, hour and day, served by the `/usage` endpoint.
+
+The worker rolls the new metrics up periodically (see the `rollup_metrics` task), watermarking by `Metric.id`: the
+metrics of a run are the ones up to the highest ID seen by the previous run, so that the metrics written by
+transactions still in progress at that time, with lower IDs than the ones already committed, aren't skipped. Rollups
+are kept per model and API key, and their latencies as mergeable sketches, so that any range and grouping can be
+queried from them.
+"""
+
+import typing
+from collections import defaultdict
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from tables.metric_rollup import MetricRollup, MetricRollupWatermark, RollupGranularity
+from tables.metrics import Metric
+from utils.sketches import DDSketch
+
+# Columns of the metrics rolled up
+ROLLUP_METRIC_COLUMNS = (
+    Metric.id,
+    Metric.created,
+    Metric.model,
+    Metric.api_key_id,
+    Metric.prompt_tokens,
+    Metric.completion_tokens,
+    Metric.total_tokens,
+    Metric.duration,
+    Metric.cache_hit,
+    Metric.time_to_first_token,
+)
+# Sums of the rollups, merged by addition
+ROLLUP_SUMS = (
+    'request_count',
+    'cache_hits',
+    'prompt_tokens',
+    'completion_tokens',
+    'total_tokens',
+    'duration_sum',
+    'time_to_first_token_sum',
+    'time_to_first_token_count',
+)
+# Sketches of the rollups with the metric column they are made of
+ROLLUP_SKETCHES = {'duration_sketch': 'duration', 'time_to_first_token_sketch': 'time_to_first_token'}
+# Dimensions the rollups can be grouped by when queried
+ROLLUP_GROUPS = ('model', 'api_key_id')
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+# Buckets a query can span at most
+MAX_QUERY_BUCKETS = 10000
+
+
+class Rollup:
+    """
+    The sums and sketches of a rollup being aggregated.
+    """
+
+    def __init__(self, relative_accuracy: float):
+        self.sums = dict.fromkeys(ROLLUP_SUMS, 0)
+        self.sketches = {name: DDSketch(relative_accuracy) for name in ROLLUP_SKETCHES}
+
+    def add_metric(self, metric: typing.Any):
+        self.sums['request_count'] += 1
+        self.sums['cache_hits'] += int(bool(metric.cache_hit))
+        # Metrics without usage data have negative token counts
+        for name in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+            value = getattr(metric, name)
+            if value is not None and value >= 0:
+                self.sums[name] += value
+        if metric.duration is not None:
+            self.sums['duration_sum'] += metric.duration
+            self.sketches['duration_sketch'].add(metric.duration)
+        if metric.time_to_first_token is not None:
+            self.sums['time_to_first_token_sum'] += metric.time_to_first_token
+            self.sums['time_to_first_token_count'] += 1
+            self.sketches['time_to_first_token_sketch'].add(metric.time_to_first_token)
+
+    def add_row(self, row: MetricRollup):
+        for name in ROLLUP_SUMS:
+            self.sums[name] += getattr(row, name) or 0
+        for name in ROLLUP_SKETCHES:
+            if data := getattr(row, name):
+                self.sketches[name].merge(DDSketch.from_dict(data))
+
+    def update_row(self, row: MetricRollup):
+        """
+        Add the rollup to a row of the rollup table.
+        """
+        for name in ROLLUP_SUMS:
+            setattr(row, name, (getattr(row, name) or 0) + self.sums[name])
+        for name, sketch in self.sketches.items():
+            if data := getattr(row, name):
+                sketch = DDSketch.from_dict(data)
+                sketch.merge(self.sketches[name])
+            # The JSON column is only updated when assigned a new value
+            setattr(row, name, sketch.to_dict())
+
+
+def get_bucket(created: int, granularity: str) -> int:
+    """
+    Returns the start of the bucket of `granularity` of a timestamp.
+    """
+    seconds = RollupGranularity.SECONDS[granularity]
+    return created - created % seconds
+
+
+def aggregate_metrics(
+    metrics: typing.Iterable[typing.Any], relative_accuracy: float
+) -> typing.Dict[typing.Tuple[str, int, typing.Optional[str], typing.Optional[int]], Rollup]:
+    """
+    Returns the rollups of metrics by granularity, bucket, model and API key.
+    """
+    rollups = {}
+    for metric in metrics:
+        if metric.created is None:
+            continue
+        for granularity in RollupGranularity.CHOICES:
+            key = (granularity, get_bucket(metric.created, granularity), metric.model, metric.api_key_id)
+            if key not in rollups:
+                rollups[key] = Rollup(relative_accuracy)
+            rollups[key].add_metric(metric)
+    return rollups
+
+
+def save_rollups(
+    session: Session,
+    rollups: typing.Dict[typing.Tuple[str, int, typing.Optional[str], typing.Optional[int]], Rollup],
+):
+    """
+    Add rollups to the rollup table, merging them into the rows of their bucket, model and API key.
+    """
+    by_granularity = defaultdict(dict)
+    for key, rollup in rollups.items():
+        by_granularity[key[0]][key] = rollup
+
+    for granularity, granularity_rollups in by_granularity.items():
+        buckets = [key[1] for key in granularity_rollups]
+        rows = {
+            (row.granularity, row.bucket, row.model, row.api_key_id): row
+            for row in session.query(MetricRollup).filter(
+                MetricRollup.granularity == granularity,
+                MetricRollup.bucket >= min(buckets),
+                MetricRollup.bucket <= max(buckets),
+            )
+        }
+        for key, rollup in granularity_rollups.items():
+            row = rows.get(key)
+            if row is None:
+                row = MetricRollup(granularity=key[0], bucket=key[1], model=key[2], api_key_id=key[3])
+                session.add(row)
+            rollup.update_row(row)
+
+
+def rollup_metrics(session: Session, batch_size: int, relative_accuracy: float) -> int:
+    """
+    Roll up the metrics written since the previous run, in batches of `batch_size` metrics each committed along with
+    the watermark, returns the number of metrics rolled up. The watermark is locked while a batch is rolled up, so
+    that concurrent runs don't roll up the same metrics.
+    """
+    rolled_up = 0
+    while True:
+        watermark = session.query(MetricRollupWatermark).with_for_update().first()
+        if watermark is None:
+            watermark = MetricRollupWatermark(id=1, last_metric_id=0, pending_metric_id=0)
+            session.add(watermark)
+
+        metrics = (
+            session.query(*ROLLUP_METRIC_COLUMNS)
+            .filter(Metric.id > watermark.last_metric_id, Metric.id <= watermark.pending_metric_id)
+            .order_by(Metric.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not metrics:
+            watermark.last_metric_id = watermark.pending_metric_id
+            watermark.pending_metric_id = max(
+                session.query(func.max(Metric.id)).scalar() or 0, watermark.pending_metric_id
+            )
+            session.commit()
+            return rolled_up
+
+        save_rollups(session, aggregate_metrics(metrics, relative_accuracy))
+        watermark.last_metric_id = metrics[-1].id
+        session.commit()
+        rolled_up += len(metrics)
+
+
+def summarize_rollup(rollup: Rollup) -> typing.Dict[str, typing.Any]:
+    sums = rollup.sums
+    summary = {
+        name: sums[name]
+        for name in ('request_count', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+    }
+    summary['duration'] = {
+        'avg': sums['duration_sum'] / sums['request_count'] if sums['request_count'] else None,
+        **{name: rollup.sketches['duration_sketch'].quantile(q) for name, q in QUANTILES.items()},
+    }
+    summary['time_to_first_token'] = {
+        'avg': (
+            sums['time_to_first_token_sum'] / sums['time_to_first_token_count']
+            if sums['time_to_first_token_count'] else None
+        ),
+        **{name: rollup.sketches['time_to_first_token_sketch'].quantile(q) for name, q in QUANTILES.items()},
+    }
+    return summary
+
+
+def query_rollups(
+    session: Session,
+    granularity: str,
+    start: int,
+    end: int,
+    relative_accuracy: float,
+    model: typing.Optional[str] = None,
+    api_key_id: typing.Optional[int] = None,
+    group_by: typing.Sequence[str] = (),
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Returns the usage per bucket of `granularity` from `start` (included) to `end` (excluded), optionally filtered
+    by model and API key, and grouped by the dimensions of `group_by` (see `ROLLUP_GROUPS`). Buckets without metrics
+    are left out.
+    """
+    rows = session.query(MetricRollup).filter(
+        MetricRollup.granularity == granularity,
+        MetricRollup.bucket >= get_bucket(start, granularity),
+        MetricRollup.bucket < end,
+    )
+    if model is not None:
+        rows = rows.filter(MetricRollup.model == model)
+    if api_key_id is not None:
+        rows = rows.filter(MetricRollup.api_key_id == api_key_id)
+
+    rollups = {}
+    for row in rows.order_by(MetricRollup.bucket):
+        key = (row.bucket, *(getattr(row, name) for name in group_by))
+        if key not in rollups:
+            rollups[key] = Rollup(relative_accuracy)
+        rollups[key].add_row(row)
+
+    return [
+        {'bucket': key[0], **dict(zip(group_by, key[1:])), **summarize_rollup(rollup)}
+        for key, rollup in rollups.items()
+    ]
@@ -0,0 +1,393 @@
+import math
+import bisect
+import random
+import time
+import typing
+import uuid
+import hashlib
+import logging
+import functools
+
+from flask import current_app as app
+
+from utils.prometheus import track_in_flight
+from utils.rate_limits import ReplicaRateLimitExceeded, ReplicaRateLimitManager
+from utils.redis import get_redis_client
+
+if typing.TYPE_CHECKING:
+    from tables.replicas import Replica
+    from utils.admission import AdmissionSlot
+
+logger = logging.getLogger(__name__)
+
+# Add an in-flight request to a replica unless it already has `limit` of them (0 for no limit), the requests older than
+# the timeout being pruned first. Returns 1 if added, 0 otherwise.
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[2]) - tonumber(ARGV[4]))
+local limit = tonumber(ARGV[3])
+if limit > 0 and redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[4])))
+return 1
+"""
+
+
+class ReplicaInFlightTracker:
+    """
+    A class to track in-flight requests per replica.
+
+    Every in-flight request is stored as a member of a Redis sorted set scored by its start time, so that all gunicorn
+    workers share the same view of the replica load. Members older than `REPLICA_INFLIGHT_TIMEOUT` are pruned on read,
+    which keeps the counters correct even if a worker dies before releasing its requests.
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis_client()
+        self.timeout = app.config['REPLICA_INFLIGHT_TIMEOUT']
+        self.acquire_script = self.client.register_script(ACQUIRE_SCRIPT)
+
+    @staticmethod
+    def make_key(replica_id: int) -> str:
+        return f"replica_inflight:{replica_id}"
+
+    def acquire(self, replica_id: int, limit: int = 0) -> typing.Optional[str]:
+        """
+        Mark a request as in-flight on the replica, returns its token, or None if the replica already has `limit`
+        in-flight requests (0 for no limit).
+        """
+        token = uuid.uuid4().hex
+        acquired = self.acquire_script(
+            keys=[self.make_key(replica_id)], args=[token, time.time(), limit, self.timeout]
+        )
+        return token if acquired else None
+
+    def release(self, replica_id: int, token: str):
+        self.client.zrem(self.make_key(replica_id), token)
+
+    def get_counts(self, replica_ids: typing.List[int]) -> typing.Dict[int, int]:
+        """
+        Return the number of in-flight requests for each of the given replicas.
+        """
+        min_score = time.time() - self.timeout
+        pipe = self.client.pipeline()
+        for replica_id in replica_ids:
+            key = self.make_key(replica_id)
+            pipe.zremrangebyscore(key, '-inf', min_score)
+            pipe.zcard(key)
+        results = pipe.execute()
+        return dict(zip(replica_ids, results[1::2]))
+
+
+class InFlightRequest:
+    """
+    A handle on a request routed to a replica, released once the response has been fully sent.
+
+    Until then, the request can fail over to another of the replicas it was routed among (see `failover`). The slot
+    it holds in the admission queue of the model, if any, is released along with it, after its replica so that the
+    request let in next finds the replica slot free.
+
+    The request is counted in the in-flight gauges of the `model` and of its replica of this worker process.
+    """
+
+    def __init__(
+        self,
+        tracker: ReplicaInFlightTracker,
+        replica: 'Replica',
+        router: 'ReplicaRouter' = None,
+        replicas: typing.List['Replica'] = (),
+        rate_limits: ReplicaRateLimitManager = None,
+        affinity_key: str = None,
+        model: str = '',
+        token: str = None,
+    ):
+        self.tracker = tracker
+        self.replica = replica
+        self.router = router
+        self.replicas = replicas
+        self.rate_limits = rate_limits
+        self.affinity_key = affinity_key
+        self.model = model
+        self.tried = {replica.id}
+        self.token = token or tracker.acquire(replica.id)
+        self.released = False
+        self.finished = False
+        self.admission: typing.Optional['AdmissionSlot'] = None
+        track_in_flight(model, None, 1)
+        track_in_flight(model, replica.id, 1)
+
+    def failover(self) -> bool:
+        """
+        Move the request to a replica it wasn't sent to yet, returns False if there is none available.
+        """
+        candidates = [replica for replica in self.replicas if replica.id not in self.tried]
+        if self.router is None or not candidates:
+            return False
+        try:
+            replica, token = self.router.reserve(
+                candidates, rate_limits=self.rate_limits, affinity_key=self.affinity_key
+            )
+        except ReplicaRateLimitExceeded:
+            return False
+
+        self.release_replica()
+        self.replica = replica
+        self.tried.add(replica.id)
+        self.token = token
+        self.released = False
+        track_in_flight(self.model, replica.id, 1)
+        return True
+
+    def release(self):
+        self.release_replica()
+        if self.admission is not None:
+            self.admission.release()
+        if not self.finished:
+            self.finished = True
+            track_in_flight(self.model, None, -1)
+
+    def release_replica(self):
+        if self.released:
+            return
+        self.released = True
+        track_in_flight(self.model, self.replica.id, -1)
+        try:
+            self.tracker.release(self.replica.id, self.token)
+        except Exception:
+            logger.exception(f"Failed to release in-flight request for replica {self.replica.id}")
+
+
+class ReplicaRouter:
+    """
+    Base class for replica routing strategies.
+
+    When `ADMISSION_MAX_IN_FLIGHT_PER_REPLICA` is set, requests are only routed to the replicas with fewer in-flight
+    requests, each replica being reserved atomically (see `reserve`).
+    """
+
+    name = None
+
+    def __init__(self, tracker: ReplicaInFlightTracker = None):
+        self.tracker = tracker or ReplicaInFlightTracker()
+        self.max_in_flight_per_replica = app.config['ADMISSION_MAX_IN_FLIGHT_PER_REPLICA']
+
+    def select(self, replicas: typing.List['Replica'], affinity_key: str = None) -> 'Replica':
+        raise NotImplementedError
+
+    def get_affinity_key(self, chat_completion_payload: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+        """
+        Returns the key of the request for the strategies routing on its content, None for the others.
+        """
+        return None
+
+    def route(
+        self,
+        replicas: typing.List['Replica'],
+        rate_limits: ReplicaRateLimitManager = None,
+        affinity_key: str = None,
+        model: str = '',
+    ) -> InFlightRequest:
+        """
+        Select a replica for the request and mark the request as in-flight on it, `model` being the name of the
+        model of the replicas.
+
+        When `rate_limits` is given, replicas at their rate limit are skipped and ReplicaRateLimitExceeded is raised
+        once every replica of the model is saturated.
+        """
+        replica, token = self.reserve(replicas, rate_limits=rate_limits, affinity_key=affinity_key)
+        return InFlightRequest(
+            self.tracker,
+            replica,
+            router=self,
+            replicas=replicas,
+            rate_limits=rate_limits,
+            affinity_key=affinity_key,
+            model=model,
+            token=token,
+        )
+
+    def reserve(
+        self,
+        replicas: typing.List['Replica'],
+        rate_limits: ReplicaRateLimitManager = None,
+        affinity_key: str = None,
+    ) -> typing.Tuple['Replica', str]:
+        """
+        Select a replica for the request and mark the request as in-flight on it, returns the replica and the token of
+        the request. Replicas with `ADMISSION_MAX_IN_FLIGHT_PER_REPLICA` in-flight requests are skipped, and
+        ReplicaRateLimitExceeded is raised if every replica has as many, as for the replica rate limits.
+        """
+        candidates = list(replicas)
+        if self.max_in_flight_per_replica > 0:
+            counts = self.tracker.get_counts([replica.id for replica in candidates])
+            candidates = [replica for replica in candidates if counts[replica.id] < self.max_in_flight_per_replica]
+
+        while candidates:
+            replica = self.pick(candidates, rate_limits=rate_limits, affinity_key=affinity_key)
+            token = self.tracker.acquire(replica.id, self.max_in_flight_per_replica)
+            if token is not None:
+                return replica, token
+            # Another request took the last slot of the replica since the counts were read
+            candidates.remove(replica)
+
+        raise ReplicaRateLimitExceeded(1)
+
+    def pick(
+        self,
+        replicas: typing.List['Replica'],
+        rate_limits: ReplicaRateLimitManager = None,
+        affinity_key: str = None,
+    ) -> 'Replica':
+        """
+        Select a replica for the request, skipping the replicas at their rate limit when `rate_limits` is given.
+        """
+        candidates = sorted(replicas, key=lambda replica: replica.id)
+        retry_after = None
+        while candidates:
+            replica = candidates[0] if len(candidates) == 1 else self.select(candidates, affinity_key=affinity_key)
+            if rate_limits is None:
+                return replica
+
+            result = rate_limits.admit(replica)
+            if result.allowed:
+                return replica
+
+            retry_after = result.retry_after if retry_after is None else min(retry_after, result.retry_after)
+            candidates.remove(replica)
+
+        raise ReplicaRateLimitExceeded(retry_after)
+
+
+class RoundRobinRouter(ReplicaRouter):
+    """
+    Cycle through the replicas of a model using a counter shared across workers.
+    """
+
+    name = 'round_robin'
+
+    def select(self, replicas: typing.List['Replica'], affinity_key: str = None) -> 'Replica':
+        counter = self.tracker.client.incr(f"routing:round_robin:{replicas[0].model_id}")
+        return replicas[(counter - 1) % len(replicas)]
+
+
+class LeastOutstandingRequestsRouter(ReplicaRouter):
+    """
+    Pick the replica with the fewest in-flight requests, breaking ties randomly.
+    """
+
+    name = 'least_outstanding_requests'
+
+    def select(self, replicas: typing.List['Replica'], affinity_key: str = None) -> 'Replica':
+        counts = self.tracker.get_counts([replica.id for replica in replicas])
+        lowest = min(counts.values())
+        return random.choice([replica for replica in replicas if counts[replica.id] == lowest])
+
+
+class PowerOfTwoChoicesRouter(ReplicaRouter):
+    """
+    Sample two replicas at random and pick the one with fewer in-flight requests.
+    """
+
+    name = 'power_of_two_choices'
+
+    def select(self, replicas: typing.List['Replica'], affinity_key: str = None) -> 'Replica':
+        first, second = random.sample(replicas, 2)
+        counts = self.tracker.get_counts([first.id, second.id])
+        return first if counts[first.id] <= counts[second.id] else second
+
+
+def hash_to_int(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+@functools.lru_cache(maxsize=256)
+def make_hash_ring(replica_ids: typing.Tuple[int, ...], virtual_nodes: int) -> typing.Tuple[list, list]:
+    """
+    Returns the sorted points of the consistent hash ring of the replicas, with the replica id of each point.
+    """
+    points = sorted(
+        (hash_to_int(f"replica:{replica_id}:{node}"), replica_id)
+        for replica_id in replica_ids
+        for node in range(virtual_nodes)
+    )
+    return [point for point, _ in points], [replica_id for _, replica_id in points]
+
+
+class PrefixAffinityRouter(ReplicaRouter):
+    """
+    Send the requests sharing a prefix (system prompt and start of the conversation) to the same replica, so that
+    they hit the prefix cache of vLLM.
+
+    The prefix is hashed onto a consistent hash ring of the replicas, which only remaps the prefixes of a replica
+    when it comes or goes. The load is bounded: walking the ring from the prefix, the first replica with fewer
+    in-flight requests than `PREFIX_AFFINITY_LOAD_FACTOR` times the average is picked, so a hot prefix spills over
+    to the next replicas instead of overloading its own.
+    """
+
+    name = 'prefix_affinity'
+    virtual_nodes = 64
+
+    def __init__(self, tracker: ReplicaInFlightTracker = None):
+        super().__init__(tracker)
+        # About 4 characters per token, as for the token quotas
+        self.prefix_chars = app.config['PREFIX_AFFINITY_TOKENS'] * 4
+        self.load_factor = app.config['PREFIX_AFFINITY_LOAD_FACTOR']
+
+    def get_affinity_key(self, chat_completion_payload: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+        """
+        Returns a hash of the system messages and of the first `PREFIX_AFFINITY_TOKENS` of the other messages.
+        """
+        budget = self.prefix_chars
+        prefix = []
+        for message in chat_completion_payload['messages']:
+            content = message.get('content') or ''
+            if isinstance(content, list):
+                content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+            if message.get('role') != 'system':
+                if budget <= 0:
+                    break
+                content = content[:budget]
+                budget -= len(content)
+            prefix.append(f"{message.get('role')}:{content}")
+        return hashlib.sha256('\x1e'.join(prefix).encode('utf-8')).hexdigest()
+
+    def select(self, replicas: typing.List['Replica'], affinity_key: str = None) -> 'Replica':
+        counts = self.tracker.get_counts([replica.id for replica in replicas])
+        if affinity_key is None:
+            lowest = min(counts.values())
+            return random.choice([replica for replica in replicas if counts[replica.id] == lowest])
+
+        by_id = {replica.id: replica for replica in replicas}
+        points, replica_ids = make_hash_ring(tuple(sorted(by_id)), self.virtual_nodes)
+        capacity = math.ceil(self.load_factor * (sum(counts.values()) + 1) / len(replicas))
+        start = bisect.bisect(points, hash_to_int(affinity_key))
+        visited = set()
+        for index in range(start, start + len(points)):
+            replica_id = replica_ids[index % len(points)]
+            if replica_id in visited:
+                continue
+            if counts[replica_id] < capacity:
+                return by_id[replica_id]
+            visited.add(replica_id)
+            if len(visited) == len(by_id):
+                break
+
+        # Every replica is at capacity, fall back to the least loaded one
+        return by_id[min(counts, key=counts.get)]
+
+
+ROUTING_STRATEGIES = {
+    router.name: router
+    for router in (RoundRobinRouter, LeastOutstandingRequestsRouter, PowerOfTwoChoicesRouter, PrefixAffinityRouter)
+}
+
+
+def get_router(strategy: str = None) -> ReplicaRouter:
+    """
+    Returns the replica router for the given strategy, defaulting to `REPLICA_ROUTING_STRATEGY`.
+    """
+    strategy = strategy or app.config['REPLICA_ROUTING_STRATEGY']
+    if strategy not in ROUTING_STRATEGIES:
+        raise ValueError(f"Unknown replica routing strategy: {strategy!r}")
+    return ROUTING_STRATEGIES[strategy]()
@@ -0,0 +1,119 @@
+"""Coalescing of identical in-flight chat completion requests within a worker process (single-flight)."""
+
+import typing
+import asyncio
+import threading
+
+from flask import current_app as app
+
+from utils.response_cache import is_deterministic, make_request_hash
+
+# Error of a flight whose leader ended before its response was complete
+FLIGHT_ABORTED = (500, 'The shared request to the LLM endpoint API ended early.')
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class Flight:
+    """
+    An upstream call shared by identical requests. The request that started it (the leader) publishes the chunks
+    of the response as it receives them, and every other request (the followers) iterates over them, from the first
+    one whenever it joined. The chunks are kept until the flight is over, once the leader finishes it.
+
+    A flight can be followed from threads (or greenlets) by iterating over it, or from the event loop with `aiter`.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: typing.List[bytes] = []
+        self.done = False
+        self.error: typing.Optional[typing.Tuple[int, str]] = None
+        self.condition = threading.Condition()
+        self.waiters = set()
+
+    def publish(self, chunk: bytes):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.notify()
+
+    def finish(self, error: typing.Optional[typing.Tuple[int, str]] = None):
+        """
+        End the flight, with the (status code, description) of the error that ended it if any. Subsequent calls
+        are ignored.
+        """
+        with self.condition:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self.notify()
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+
+    def notify(self):
+        self.condition.notify_all()
+        for loop, event in list(self.waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.chunks) and not self.done:
+                    self.condition.wait()
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+            if done:
+                return
+
+    async def aiter(self) -> typing.AsyncIterator[bytes]:
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            self.waiters.add(waiter)
+        try:
+            index = 0
+            while True:
+                waiter[1].clear()
+                with self.condition:
+                    chunks = self.chunks[index:]
+                    done = self.done
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if done:
+                    return
+                await waiter[1].wait()
+        finally:
+            with self.condition:
+                self.waiters.discard(waiter)
+
+
+def make_flight_key(chat_completion_payload: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+    """
+    Returns the key of the flight of the request, or None if it can't be shared. Only deterministic requests are,
+    as sampled ones are expected to get responses of their own.
+    """
+    if not app.config['SINGLE_FLIGHT_ENABLED'] or not is_deterministic(chat_completion_payload):
+        return None
+    return make_request_hash(chat_completion_payload)
+
+
+def get_flight(key: str) -> typing.Optional[Flight]:
+    with _flights_lock:
+        return _flights.get(key)
+
+
+def join_flight(key: str) -> typing.Tuple[Flight, bool]:
+    """
+    Returns the flight of the key, started if there is none, and whether the request leads it.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight(key)
+    return flight, True
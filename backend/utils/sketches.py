@@ -0,0 +1,90 @@
+"""Mergeable quantile sketches of latencies and throughputs."""
+
+import math
+import typing
+
+# Values below which a sketch counts a value as zero, e.g. the duration of a response served from the cache
+MIN_INDEXABLE_VALUE = 1e-6
+
+
+class DDSketch:
+    """
+    A quantile sketch of positive values (DDSketch, Masson et al., VLDB 2019).
+
+    Values are counted in logarithmic bins, the bin of `x` being `ceil(log(x) / log(gamma))` with
+    `gamma = (1 + alpha) / (1 - alpha)`, so that every quantile is returned within a relative error of
+    `relative_accuracy` (`alpha`). Sketches with the same accuracy merge exactly by adding their bins, which is what
+    allows the sketches of different workers and time buckets to be combined. With values from a millisecond to an
+    hour and an accuracy of 1%, a sketch has at most a few hundred bins.
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = 0.01,
+        bins: typing.Optional[typing.Dict[int, int]] = None,
+        zero_count: int = 0,
+    ):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("The relative accuracy must be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins: typing.Dict[int, int] = dict(bins or {})
+        self.zero_count = zero_count
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.bins.values())
+
+    def get_index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def get_value(self, index: int) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1):
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+            return
+        index = self.get_index(value)
+        self.bins[index] = self.bins.get(index, 0) + count
+
+    def merge(self, other: 'DDSketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches of the same relative accuracy can be merged.")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        """
+        Returns the value at the quantile `q` (between 0 and 1), None if the sketch is empty.
+        """
+        count = self.count
+        if not count:
+            return None
+
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self.get_value(index)
+        return self.get_value(max(self.bins))
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "bins": {str(index): count for index, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: typing.Dict[str, typing.Any]) -> 'DDSketch':
+        return cls(
+            relative_accuracy=data["relative_accuracy"],
+            bins={int(index): count for index, count in data["bins"].items()},
+            zero_count=data["zero_count"],
+        )
@@ -0,0 +1,124 @@
+"""Incremental parsing of the server-sent events streamed back by the LLM endpoints."""
+
+import re
+import json
+import typing
+import logging
+
+logger = logging.getLogger(__name__)
+
+DONE = b'[DONE]'
+
+RE_FRAME_DELIMITER = re.compile(rb'\r\n\r\n|\n\n|\r\r')
+RE_LINE_DELIMITER = re.compile(rb'\r\n|\n|\r')
+RE_USAGE = re.compile(rb'"usage"\s*:\s*(?!null)')
+
+
+class SSEFramer:
+    """
+    A class splitting a byte stream into server-sent event frames.
+
+    Network reads don't line up with events: a read can hold several frames or end in the middle of one. The framer
+    buffers the incomplete tail and only returns complete frames, without their trailing blank line.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> typing.List[bytes]:
+        self.buffer += data
+        frames = []
+        start = 0
+        while match := RE_FRAME_DELIMITER.search(self.buffer, start):
+            frames.append(bytes(self.buffer[start:match.start()]))
+            start = match.end()
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def close(self) -> typing.List[bytes]:
+        """
+        Returns the last frame of a stream not terminated by a blank line.
+        """
+        frame = bytes(self.buffer).strip()
+        self.buffer.clear()
+        return [frame] if frame else []
+
+
+def frame_data(frame: bytes) -> typing.Optional[bytes]:
+    """
+    Returns the data of a frame, or None for frames without data (comments, keep-alives).
+    """
+    data = [
+        line[5:].removeprefix(b' ')
+        for line in RE_LINE_DELIMITER.split(frame)
+        if line.startswith(b'data:')
+    ]
+    return b'\n'.join(data) if data else None
+
+
+class SSERelay:
+    """
+    A class relaying the chat completion chunks streamed by an LLM endpoint to the client.
+
+    Chunk frames are forwarded as is, either as SSE frames (`raw`) or as newline-delimited JSON. Only the frame
+    carrying the usage data is decoded; usage-only frames and the `[DONE]` sentinel are not forwarded unless `raw`.
+    Only with `keep_payloads` are the forwarded payloads kept, so that the response choices can be decoded once the
+    stream is over; otherwise only the number of forwarded chunks is.
+    """
+
+    def __init__(self, raw: bool, keep_payloads: bool = False):
+        self.raw = raw
+        self.keep_payloads = keep_payloads
+        self.framer = SSEFramer()
+        self.payloads = []
+        self.chunks = 0
+        self.usage = {}
+
+    def feed(self, data: bytes) -> bytes:
+        """
+        Returns the bytes to send to the client for the data received from the LLM endpoint.
+        """
+        return self._relay(self.framer.feed(data))
+
+    def close(self) -> bytes:
+        return self._relay(self.framer.close())
+
+    def choices(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Returns the choices of the forwarded chunks, empty unless the payloads are kept.
+        """
+        choices = []
+        for payload in self.payloads:
+            try:
+                choices.extend(json.loads(payload)['choices'])
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Skipping undecodable chunk from LLM endpoint: {payload[:200]!r}")
+        return choices
+
+    def _relay(self, frames: typing.List[bytes]) -> bytes:
+        out = []
+        for frame in frames:
+            data = frame_data(frame)
+            if data is None or data == DONE:
+                if self.raw:
+                    out.append(frame + b'\n\n')
+                continue
+
+            if RE_USAGE.search(data):
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    logger.warning(f"Failed to decode usage chunk from LLM endpoint: {data[:200]!r}")
+                    chunk = {}
+                self.usage = chunk.get('usage') or self.usage
+                if not chunk.get('choices'):
+                    if self.raw:
+                        out.append(frame + b'\n\n')
+                    continue
+
+            self.chunks += 1
+            if self.keep_payloads:
+                self.payloads.append(data)
+            out.append(frame + b'\n\n' if self.raw else data + b'\n')
+        return b''.join(out)
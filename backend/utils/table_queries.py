@@ -0,0 +1,116 @@
+"""
+Keyset pagination, filtering and column projection of the rows of the tables, from query parameters.
+
+- `limit` (1 to `MAX_LIMIT`) and `after_id`: rows are returned by descending ID, from the one below `after_id`, so
+  that each page is a range of the primary key however deep it is.
+- `fields`: comma-separated columns to return, `id` always being returned.
+- `<column>=<value>`: rows whose column equals the value.
+- `<column>__gte`, `<column>__gt`, `<column>__lte` and `<column>__lt`: rows whose column is in a range, e.g.
+  `created__gte=1735689600&created__lt=1735776000` for the metrics of a day.
+"""
+
+import typing
+import operator
+
+from marshmallow import ValidationError
+from sqlalchemy import Column, Table
+from sqlalchemy.orm import Session
+
+from utils.rest import serialize_row
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# Query parameters that aren't filters
+RESERVED_ARGS = ('limit', 'after_id', 'fields')
+RANGE_OPERATORS = {'gte': operator.ge, 'gt': operator.gt, 'lte': operator.le, 'lt': operator.lt}
+# Types of the columns that can be filtered
+FILTER_TYPES = (bool, int, float, str)
+
+
+def parse_value(column: Column, value: str) -> typing.Any:
+    """
+    Returns the value of a filter converted to the type of its column, raises ValueError if it can't be.
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = None
+    if python_type not in FILTER_TYPES:
+        raise ValueError(f"Column {column.name} can't be filtered.")
+    if python_type is bool:
+        if value.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError("Must be true or false.")
+        return value.lower() in ('true', '1')
+    return python_type(value)
+
+
+def get_columns(table: Table, fields: typing.Optional[str]) -> typing.List[Column]:
+    """
+    Returns the columns of a comma-separated list of `fields`, every column if None.
+    """
+    if not fields:
+        return list(table.columns)
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in table.columns]
+    if unknown:
+        raise ValidationError({'fields': [f"Unknown columns: {', '.join(unknown)}."]})
+    return [table.columns.id, *(table.columns[name] for name in dict.fromkeys(names) if name != 'id')]
+
+
+def get_filters(
+    table: Table, args: typing.Mapping[str, str], reserved: typing.Sequence[str] = RESERVED_ARGS
+) -> typing.List[typing.Any]:
+    """
+    Returns the filters of the rows of a table from query parameters, ignoring the `reserved` ones.
+    """
+    filters = []
+    errors = {}
+    for arg, value in args.items():
+        if arg in reserved:
+            continue
+        name, _, operator_name = arg.partition('__')
+        if name not in table.columns or (operator_name and operator_name not in RANGE_OPERATORS):
+            errors[arg] = ["Unknown filter."]
+            continue
+        column = table.columns[name]
+        try:
+            value = parse_value(column, value)
+        except ValueError as e:
+            errors[arg] = [str(e)]
+            continue
+        filters.append(RANGE_OPERATORS[operator_name](column, value) if operator_name else column == value)
+    if errors:
+        raise ValidationError(errors)
+    return filters
+
+
+def get_limit(args: typing.Mapping[str, str]) -> int:
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ValidationError({'limit': ["Not a valid integer."]})
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValidationError({'limit': [f"Must be between 1 and {MAX_LIMIT}."]})
+    return limit
+
+
+def query_table(
+    session: Session, table: Table, args: typing.Mapping[str, str]
+) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.Optional[int]]:
+    """
+    Returns a page of the rows of a table from query parameters (see the module), with the `after_id` of the next
+    page, None if it is the last one. Raises ValidationError if the query parameters are invalid.
+    """
+    columns = get_columns(table, args.get('fields'))
+    limit = get_limit(args)
+    query = session.query(*columns).filter(*get_filters(table, args))
+    if args.get('after_id') is not None:
+        try:
+            query = query.filter(table.columns.id < int(args['after_id']))
+        except ValueError:
+            raise ValidationError({'after_id': ["Not a valid integer."]})
+
+    rows = query.order_by(table.columns.id.desc()).limit(limit + 1).all()
+    keys = [column.name for column in columns]
+    data = [serialize_row(keys, row) for row in rows[:limit]]
+    return data, data[-1]['id'] if len(rows) > limit else None
@@ -0,0 +1,163 @@
+"""Persistent HTTP connection pools to the upstream LLM endpoints (the replicas)."""
+
+import os
+import time
+import random
+import typing
+import functools
+import threading
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from flask import current_app as app
+
+# Responses of a replica that is restarting or overloaded, the request wasn't processed and can be sent again
+RETRYABLE_STATUS_CODES = (502, 503)
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_upstream_origin(endpoint: str) -> str:
+    url = urllib.parse.urlsplit(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def get_upstream_timeout() -> typing.Tuple[float, float]:
+    """
+    Returns the (connect, read) timeout of the requests sent to the LLM endpoints.
+    """
+    return app.config['UPSTREAM_CONNECT_TIMEOUT'], app.config['UPSTREAM_READ_TIMEOUT']
+
+
+class RetryPolicy(typing.NamedTuple):
+    """
+    How many times a request is sent again to the replicas when it fails before any byte was received, and how long
+    to wait in between. Each attempt is bounded by the connect timeout (see `get_upstream_timeout`).
+    """
+
+    retries: int
+    backoff: float
+    max_backoff: float
+
+    def get_backoff(self, retry: int) -> float:
+        """
+        Returns the delay before the given retry (starting at 1): exponential backoff with full jitter, so that the
+        requests failing at the same time don't all hit the next replica together.
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+
+def get_retry_policy(config: typing.Mapping[str, typing.Any] = None) -> RetryPolicy:
+    config = config if config is not None else app.config
+    return RetryPolicy(
+        retries=config['UPSTREAM_RETRIES'],
+        backoff=config['UPSTREAM_RETRY_BACKOFF_MS'] / 1000,
+        max_backoff=config['UPSTREAM_RETRY_MAX_BACKOFF_MS'] / 1000,
+    )
+
+
+class KeepAliveExpiryMixin:
+    """
+    A connection pool closing the connections left idle for longer than `keepalive_expiry` seconds when they are
+    taken from the pool, so that a request isn't sent on a connection the replica may be closing. Closed connections
+    reconnect on their next request.
+    """
+
+    def __init__(self, *args, keepalive_expiry: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive_expiry = keepalive_expiry
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if idle_since is not None and time.monotonic() - idle_since > self.keepalive_expiry:
+            conn.close()
+        conn.idle_since = None
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+
+class KeepAliveExpiryHTTPConnectionPool(KeepAliveExpiryMixin, HTTPConnectionPool):
+    pass
+
+
+class KeepAliveExpiryHTTPSConnectionPool(KeepAliveExpiryMixin, HTTPSConnectionPool):
+    pass
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """
+    An adapter whose pooled connections expire after `keepalive_expiry` seconds idle (`UPSTREAM_KEEPALIVE_EXPIRY`),
+    as the ones of the ASGI proxy do.
+    """
+
+    def __init__(self, keepalive_expiry: float, **kwargs):
+        self.keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(KeepAliveExpiryHTTPConnectionPool, keepalive_expiry=self.keepalive_expiry),
+            'https': functools.partial(KeepAliveExpiryHTTPSConnectionPool, keepalive_expiry=self.keepalive_expiry),
+        }
+
+
+def get_upstream_session(endpoint: str) -> requests.Session:
+    """
+    Returns the session of the upstream serving `endpoint`. Sessions are kept per process and per upstream origin,
+    so that requests to a replica reuse keep-alive connections instead of doing a new TCP (and TLS) handshake.
+    Connections idle for longer than `UPSTREAM_KEEPALIVE_EXPIRY` seconds are reopened.
+    """
+    global _sessions_pid
+    origin = get_upstream_origin(endpoint)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Connections can't be shared with a forked process
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(origin)
+        if session is None:
+            adapter = UpstreamAdapter(
+                keepalive_expiry=app.config['UPSTREAM_KEEPALIVE_EXPIRY'],
+                pool_connections=1,
+                pool_maxsize=app.config['UPSTREAM_POOL_MAXSIZE'],
+            )
+            session = requests.Session()
+            session.mount(f"{origin}/", adapter)
+            _sessions[origin] = session
+    return session
+
+
+def get_upstream_pool_stats() -> typing.Dict[str, typing.Dict[str, int]]:
+    """
+    Returns the connection pool stats of each upstream of this process.
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = dict(_sessions) if _sessions_pid == os.getpid() else {}
+
+    for origin, session in sessions.items():
+        adapter = session.get_adapter(f"{origin}/")
+        pool_stats = {"connections_created": 0, "requests": 0, "idle_connections": 0, "active_connections": 0}
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            # The pool queue is pre-filled with None placeholders for the connections not created yet
+            idle_connections = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            pool_stats["connections_created"] += pool.num_connections
+            pool_stats["requests"] += pool.num_requests
+            pool_stats["idle_connections"] += idle_connections
+            pool_stats["active_connections"] += pool.pool.maxsize - pool.pool.qsize()
+        stats[origin] = {**pool_stats, "pool_maxsize": app.config['UPSTREAM_POOL_MAXSIZE']}
+    return stats
@@ -17,5 +17,17 @@ celery_beat.conf.beat_schedule = {
             day_of_month=Config.DB_BACKUP_SCHEDULE_DAY_OF_MONTH,
             month_of_year=Config.DB_BACKUP_SCHEDULE_MONTH_OF_YEAR
         )
-    }
+    },
+    'probe_replicas': {
+        'task': 'probe_replicas',
+        'schedule': Config.REPLICA_HEALTH_CHECK_INTERVAL,
+    },
+    'enforce_metric_retention': {
+        'task': 'enforce_metric_retention',
+        'schedule': Config.METRICS_RETENTION_INTERVAL,
+    },
+    'rollup_metrics': {
+        'task': 'rollup_metrics',
+        'schedule': Config.METRICS_ROLLUP_INTERVAL,
+    },
 }
@@ -1,8 +1,12 @@
 import contextlib
+import json
 import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import requests
 from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import NoCredentialsError, ClientError, EndpointConnectionError
 from datetime import datetime
@@ -13,9 +17,29 @@ from hyperstack.connection import set_api_key
 from hyperstack.vm import VMService, VMServiceStatus
 from tables.llm_model import LLMModel  # noqa
 from tables.replicas import Replica, ReplicaVMStatus
+from tables.batch import Batch, BatchStatus
+from tables.file import File, FilePurpose
 from worker.celery_task import celery
-from worker.db_session import db_session
-from worker.utils import is_model_deployed, create_replica_vm
+from worker.db_session import db_session, engine
+from utils.cache import publish_cache_invalidation
+from utils.batches import (
+    OUTPUT_CHUNK_SIZE,
+    BatchRequestSender,
+    make_batch_error,
+    make_batch_output,
+    parse_batch_input,
+    run_concurrently,
+)
+from utils.circuit_breaker import ReplicaCircuitBreaker
+from utils.metric_partitions import (
+    add_metric_partitions,
+    delete_old_metrics,
+    drop_metric_partitions,
+    get_metric_partitions,
+)
+from utils.rollups import rollup_metrics as rollup_new_metrics
+from utils.upstream import RetryPolicy
+from worker.utils import is_model_deployed, create_replica_vm, get_redis_client, probe_replica_health
 
 
 set_api_key(Config.HYPERSTACK_API_KEY)
@@ -71,6 +95,7 @@ def monitor_vm_status(vm_id: int, data: dict, replica_id: int):
                 }
             )
         )
+    publish_cache_invalidation(get_redis_client(), "replicas")
 
 
 @celery.task(name="create_vm_on_hyperstack")
@@ -111,6 +136,7 @@ def create_vm_on_hyperstack(replica_id: int, data: dict):
                     }
                 )
             )
+        publish_cache_invalidation(get_redis_client(), "replicas")
 
 
 @celery.task(name="backup_db")
@@ -156,3 +182,245 @@ def backup_db():
         # Clean up local files
         with contextlib.suppress(OSError, FileNotFoundError):
             os.remove(backup_file)
+
+
+@celery.task(name="probe_replicas")
+def probe_replicas():
+    """
+    Probe the health endpoint of every deployed replica and feed the outcome to their circuit breakers, so that a
+    replica that crashed or hangs stops receiving traffic even when no request was sent to it.
+    """
+    with db_session() as session:
+        replicas = [
+            (replica.id, replica.endpoint)
+            for replica in session.query(Replica).filter_by(vm_status=ReplicaVMStatus.SUCCESS)
+            if replica.endpoint
+        ]
+    if not replicas:
+        return
+
+    circuit_breaker = ReplicaCircuitBreaker(client=get_redis_client(), config=vars(Config))
+
+    def probe(replica):
+        replica_id, endpoint = replica
+        start_time = time.time()
+        healthy = probe_replica_health(endpoint, timeout=Config.REPLICA_HEALTH_CHECK_TIMEOUT)
+        state = circuit_breaker.record(replica_id, healthy, time.time() - start_time, probe=True)
+        if not healthy:
+            lg.warning(f"Replica {replica_id} failed its health check, circuit is {state}.")
+
+    with ThreadPoolExecutor(max_workers=min(len(replicas), 16)) as executor:
+        list(executor.map(probe, replicas))
+
+
+@celery.task(name="enforce_metric_retention")
+def enforce_metric_retention():
+    """
+    Create the monthly partitions of the metric table ahead of time, and drop the ones past
+    `METRICS_RETENTION_DAYS`. Tables that aren't partitioned have their old rows deleted in batches instead.
+    """
+    now = time.time()
+    with engine.connect() as connection:
+        partitions = get_metric_partitions(connection)
+        if partitions:
+            added = add_metric_partitions(connection, partitions, now, Config.METRICS_PARTITIONS_AHEAD)
+            if added:
+                lg.info(f"Added {added} partitions to the metric table.")
+                partitions = get_metric_partitions(connection)
+
+        if Config.METRICS_RETENTION_DAYS <= 0:
+            return
+        before = now - Config.METRICS_RETENTION_DAYS * 24 * 60 * 60
+        if partitions:
+            dropped = drop_metric_partitions(connection, partitions, before)
+            if dropped:
+                lg.info(f"Dropped the partitions {', '.join(dropped)} of the metric table.")
+        else:
+            deleted = delete_old_metrics(connection, before, Config.METRICS_RETENTION_BATCH_SIZE)
+            if deleted:
+                lg.info(f"Deleted {deleted} rows of the metric table.")
+
+
+@celery.task(name="rollup_metrics")
+def rollup_metrics():
+    """
+    Add the metrics written since the previous run to the rollups per minute, hour and day.
+    """
+    with db_session() as session:
+        rolled_up = rollup_new_metrics(
+            session, Config.METRICS_ROLLUP_BATCH_SIZE, Config.METRICS_SKETCH_RELATIVE_ACCURACY
+        )
+    if rolled_up:
+        lg.info(f"Rolled up {rolled_up} metrics.")
+
+
+# Errors of the requests of a batch that weren't sent before it was cancelled or expired
+NOT_RUN_ERRORS = {
+    BatchStatus.CANCELLED: {
+        "code": "batch_cancelled",
+        "message": "This request was not executed, the batch was cancelled.",
+    },
+    BatchStatus.EXPIRED: {
+        "code": "batch_expired",
+        "message": "This request could not be executed before the completion window expired.",
+    },
+}
+
+
+def update_batch(batch_id: int, **values) -> str:
+    """
+    Update a batch, returns its status.
+    """
+    with db_session() as session:
+        batch = session.query(Batch).filter_by(id=batch_id).one()
+        for key, value in values.items():
+            setattr(batch, key, value)
+        return batch.status
+
+
+def append_batch_outputs(batch_id: int, outputs: list) -> str:
+    """
+    Append the output lines of requests of a batch that succeeded to its output file and the others to its error
+    file, creating them on their first lines, and count them in its request counts. Returns the status of the batch.
+    """
+    with db_session() as session:
+        batch = session.query(Batch).filter_by(id=batch_id).one()
+        for purpose_id, succeeded, suffix in (("output_file_id", True, "output"), ("error_file_id", False, "error")):
+            lines = [json.dumps(output) for output, ok in outputs if ok == succeeded]
+            if not lines:
+                continue
+            content = "\n".join(lines) + "\n"
+            if getattr(batch, purpose_id) is not None:
+                File.append(session, getattr(batch, purpose_id), content)
+                continue
+            file = File.create(
+                session,
+                api_key_id=batch.api_key_id,
+                filename=f"{Batch.format_id(batch_id)}_{suffix}.jsonl",
+                purpose=FilePurpose.BATCH_OUTPUT,
+                content=content,
+            )
+            setattr(batch, purpose_id, file.id)
+
+        completed = sum(1 for _, ok in outputs if ok)
+        batch.request_completed += completed
+        batch.request_failed += len(outputs) - completed
+        return batch.status
+
+
+def finish_batch(batch_id: int, status: str, not_run: list):
+    """
+    Set the final status of a batch. A batch being cancelled is cancelled, whatever the given status. The requests
+    of a cancelled or expired batch that weren't sent get an error line in its error file.
+    """
+    with db_session() as session:
+        (
+            session.query(Batch)
+            .filter_by(id=batch_id, status=BatchStatus.IN_PROGRESS)
+            .update({"status": BatchStatus.FINALIZING, "finalizing_at": int(time.time())})
+        )
+        if session.query(Batch.status).filter_by(id=batch_id).scalar() == BatchStatus.CANCELLING:
+            status = BatchStatus.CANCELLED
+
+    if status in NOT_RUN_ERRORS:
+        for index in range(0, len(not_run), OUTPUT_CHUNK_SIZE):
+            append_batch_outputs(
+                batch_id,
+                [
+                    (make_batch_output(batch_request["custom_id"], error=NOT_RUN_ERRORS[status]), False)
+                    for batch_request in not_run[index:index + OUTPUT_CHUNK_SIZE]
+                ],
+            )
+    update_batch(batch_id, status=status, **{f"{status}_at": int(time.time())})
+
+
+@celery.task(name="run_batch")
+def run_batch(batch_id: int):
+    """
+    Run the chat completion requests of a batch, at most `BATCH_CONCURRENCY` at once, through the chat completions
+    endpoint of the backend with the API key of the batch and the batch priority. The progress is saved every
+    `BATCH_PROGRESS_INTERVAL` seconds, or `OUTPUT_CHUNK_SIZE` responses, by appending their output lines to the files
+    of the batch, when the batch is also checked for cancellation and expiry.
+    """
+    with db_session() as session:
+        batch = session.query(Batch).filter_by(id=batch_id).one_or_none()
+        if batch is None or batch.status not in (BatchStatus.VALIDATING, BatchStatus.CANCELLING):
+            return
+        if batch.status == BatchStatus.CANCELLING:
+            batch.status = BatchStatus.CANCELLED
+            batch.cancelled_at = int(time.time())
+            return
+        api_key = batch.api_key.api_key
+        endpoint = batch.endpoint
+        expires_at = batch.expires_at
+        content = batch.input_file.content
+
+    batch_requests, errors = parse_batch_input(content, endpoint, Config.BATCH_MAX_REQUESTS)
+    if errors:
+        update_batch(batch_id, status=BatchStatus.FAILED, failed_at=int(time.time()), errors=errors)
+        return
+
+    with db_session() as session:
+        started = (
+            session.query(Batch)
+            .filter_by(id=batch_id, status=BatchStatus.VALIDATING)
+            .update(
+                {
+                    "status": BatchStatus.IN_PROGRESS,
+                    "in_progress_at": int(time.time()),
+                    "request_total": len(batch_requests),
+                }
+            )
+        )
+    if not started:
+        update_batch(batch_id, status=BatchStatus.CANCELLED, cancelled_at=int(time.time()))
+        return
+
+    sender = BatchRequestSender(
+        Config.BATCH_API_BASE_URL,
+        api_key,
+        retry_policy=RetryPolicy(retries=Config.BATCH_REQUEST_RETRIES, backoff=1, max_backoff=60),
+        timeout=Config.BATCH_REQUEST_TIMEOUT,
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=Config.BATCH_CONCURRENCY)
+    sender.session.mount("http://", adapter)
+    sender.session.mount("https://", adapter)
+
+    # The output lines are appended to the files of the batch as the progress is saved, only the ones since then
+    # are held
+    outputs = []
+    done = bytearray(len(batch_requests))
+    status = BatchStatus.COMPLETED
+    last_progress = time.monotonic()
+    try:
+        for index, output in run_concurrently(
+            sender.send,
+            batch_requests,
+            Config.BATCH_CONCURRENCY,
+            should_stop=lambda: status != BatchStatus.COMPLETED,
+        ):
+            outputs.append(output)
+            done[index] = True
+            if len(outputs) < OUTPUT_CHUNK_SIZE and time.monotonic() - last_progress < Config.BATCH_PROGRESS_INTERVAL:
+                continue
+
+            last_progress = time.monotonic()
+            current_status = append_batch_outputs(batch_id, outputs)
+            outputs = []
+            if current_status == BatchStatus.CANCELLING:
+                status = BatchStatus.CANCELLED
+            elif time.time() >= expires_at:
+                status = BatchStatus.EXPIRED
+
+        if outputs:
+            append_batch_outputs(batch_id, outputs)
+        not_run = [batch_request for index, batch_request in enumerate(batch_requests) if not done[index]]
+        finish_batch(batch_id, status, not_run)
+    except Exception as e:
+        lg.exception(f"Batch {batch_id} failed: {e}")
+        update_batch(
+            batch_id,
+            status=BatchStatus.FAILED,
+            failed_at=int(time.time()),
+            errors=[make_batch_error("batch_failed", "The batch failed unexpectedly.")],
+        )
@@ -1,8 +1,35 @@
 import time
+import urllib.parse
 
+import redis
+import requests
+
+from config import Config
 from hyperstack.cloud_config import InferenceEngineConfigGenerator
 from hyperstack.connection import call, Response
 from hyperstack.vm import VMService
+from utils.redis import get_redis_connection_pool
+
+
+def get_redis_client() -> redis.Redis:
+    """
+    Returns a Redis client for tasks running outside of the Flask app context.
+    """
+    return redis.Redis(
+        connection_pool=get_redis_connection_pool(Config.REDIS_HOST, Config.REDIS_PORT, Config.REDIS_DB)
+    )
+
+
+def probe_replica_health(endpoint_url: str, timeout: float) -> bool:
+    """
+    Returns whether the inference engine serving `endpoint_url` answers its health check.
+    """
+    url = urllib.parse.urlsplit(endpoint_url)
+    try:
+        response = requests.get(f"{url.scheme}://{url.netloc}/health", timeout=timeout)
+    except requests.exceptions.RequestException:
+        return False
+    return response.status_code == 200
 
 
 def is_model_deployed(endpoint_url: str) -> bool:
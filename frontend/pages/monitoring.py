@@ -1,4 +1,5 @@
 import os
+import time
 import pandas as pd
 import requests
 import streamlit as st
@@ -13,12 +14,17 @@ This page allows you to view and interact with the data stored in your databases
 
 ## 📋 User Instructions
 1. **Select a Table**: Choose a table from the dropdown list to view its data.
-2. **View Data**: The data from the selected table will be displayed in a table format.
+2. **View Data**: The data from the selected table will be displayed in a table format, a page at a time. Use the
+   **Previous page** and **Next page** buttons to page through it.
 3. **Download CSV**: You can download the data as a CSV file by clicking the download button.
 
 ## 👍 Additional Tips
 * You can refresh the data by re-selecting the table from the dropdown list.
 * Metrics data may not be stored correctly for locally or externally deployed models.
+* To export whole months of metrics, e.g. for billing, use the `/api/v1/metrics/export` endpoint, which streams them
+  as NDJSON, CSV or Parquet.
+* The usage chart of the metric table is served from rollups updated by the worker every minute, so the latest
+  requests may take a minute or two to appear.
 """
 
 
@@ -42,24 +48,69 @@ def fetch_data(endpoint):
     return response.json()
 
 
-def show_metrics_plot(df):
+# Rows per page of the tables
+PAGE_SIZES = [100, 500, 1000]
+# Columns shown of the tables with large columns, e.g. the payloads of the metrics
+TABLE_FIELDS = {
+    "metric": ",".join(
+        [
+            "api_key_id",
+            "created",
+            "model",
+            "prompt_tokens",
+            "completion_tokens",
+            "total_tokens",
+            "duration",
+            "retries",
+            "cache_hit",
+            "time_to_first_token",
+            "time_per_output_token",
+            "input_hash",
+        ]
+    ),
+    "file": "api_key_id,filename,purpose,bytes,created_at",
+}
+
+# Ranges of the usage chart, with the granularity of their buckets
+USAGE_RANGES = {
+    "Last hour": (60 * 60, "minute"),
+    "Last 24 hours": (24 * 60 * 60, "hour"),
+    "Last 7 days": (7 * 24 * 60 * 60, "hour"),
+    "Last 30 days": (30 * 24 * 60 * 60, "day"),
+}
+
+
+def show_usage_plot():
     """
-    Show a plot of the metrics data.
+    Show a plot of the usage of the models, from the metric rollups.
     """
-    cols = df.columns
-    numerical_cols = df.select_dtypes(include=["int64", "float64"]).columns
-    y_col = st.selectbox("Select Metric", numerical_cols)
-
-    # Group by the selected interval and fill missing intervals with zero
-    df.set_index("created_date_time", inplace=True)
-    df = df.resample("T").sum().fillna(0).reset_index()
+    col1, col2 = st.columns(2)
+    usage_range = col1.selectbox("Select Range", list(USAGE_RANGES), index=1)
+    seconds, granularity = USAGE_RANGES[usage_range]
+    end = int(time.time())
+    usage_response = fetch_data(
+        f"usage?granularity={granularity}&start={end - seconds}&end={end}&group_by=model"
+    )
+    if not usage_response or not usage_response["data"]:
+        st.info("No usage over this range yet.")
+        return
+
+    df = pd.json_normalize(usage_response["data"], sep="_")
+    df["bucket_date_time"] = pd.to_datetime(df["bucket"], unit="s")
+    numerical_cols = [
+        col
+        for col in df.select_dtypes(include=["int64", "float64"]).columns
+        if col != "bucket"
+    ]
+    y_col = col2.selectbox("Select Metric", numerical_cols)
 
     fig = px.line(
         df,
-        x="created_date_time",
+        x="bucket_date_time",
         y=y_col,
-        title=f"{y_col} over time",
-        line_shape="spline",
+        color="model",
+        title=f"{y_col} per {granularity}",
+        markers=True,
     )
     fig.update_yaxes(rangemode="tozero")
 
@@ -80,22 +131,37 @@ def main():
         selected_table = st.selectbox("Select Table", table_names)
 
         if selected_table:
-            table_data_response = fetch_data(f"tables/{selected_table}")
+            col1, col2 = st.columns([5, 1])
+            limit = col2.selectbox("Rows", PAGE_SIZES)
+            # IDs after which the pages seen so far start, to go back and forth
+            cursors = st.session_state.setdefault("table_cursors", {}).setdefault(
+                (selected_table, limit), [None]
+            )
+            query = f"limit={limit}"
+            if selected_table in TABLE_FIELDS:
+                query += f"&fields={TABLE_FIELDS[selected_table]}"
+            if cursors[-1] is not None:
+                query += f"&after_id={cursors[-1]}"
+
+            table_data_response = fetch_data(f"tables/{selected_table}?{query}")
             if table_data_response:
                 rows = table_data_response.get("data", [])
+                col1.caption(f"Page {len(cursors)}")
+                previous_col, next_col, _ = st.columns([1, 1, 4])
+                if previous_col.button("Previous page", disabled=len(cursors) == 1):
+                    cursors.pop()
+                    st.rerun()
+                if next_col.button(
+                    "Next page", disabled=not table_data_response.get("has_more")
+                ):
+                    cursors.append(table_data_response["next_after_id"])
+                    st.rerun()
                 if rows:
                     df = pd.DataFrame(rows)
 
                     if selected_table == "metric":
-                        st.markdown("### Chart")
-                        # created is an integer representing the timestamp
-                        df["created_date_time"] = pd.to_datetime(
-                            df["created"], unit="s"
-                        )
-
-                        show_metrics_plot(
-                            df,
-                        )
+                        st.markdown("### Usage")
+                        show_usage_plot()
 
                     st.markdown("### Table")
                     col1, col2 = st.columns([5, 1])